@@ -0,0 +1,176 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Replays a netsplit and the rejoin after it, cut into the chunks a 16 KB read
+would return, through three receive loops: the one from before batches, which
+parsed and hooked one line at a time and made the Users right away, the same
+loop with parse_irc_line, and the current one, which parses a whole chunk with
+parse_irc_lines and hooks runs of the same event together. The hooks read the
+source, target and message of every line. Run from the brobot directory with
+
+    python -m benchmarks.batches [users]
+"""
+
+from benchmarks import capture
+from core.irc.events import Events, EventManager, EventHook, ParsedLine
+from core.irc.structures import Server, User
+from core.irc.utils import parse_irc_line, parse_irc_lines
+from operator import attrgetter
+import itertools
+import sys
+import time
+
+def parse_split_line(server, line):
+    """parse_irc_line as it was before batches."""
+    raw_source, command, target, args, message = '', '', '', '', ''
+
+    split_line = line.split(' :', 1)
+    split_line_len = len(split_line)
+    if split_line_len == 1:
+        if line.startswith(':'):
+            split_prefix = line[1:].split()
+        else:
+            split_prefix = line.split()
+    elif split_line_len == 2:
+        irc_protocol_prefix, message = split_line
+        if irc_protocol_prefix.startswith(':'):
+            split_prefix = irc_protocol_prefix[1:].split()
+        else:
+            split_prefix = irc_protocol_prefix.split()
+
+    prefix_len = len(split_prefix)
+
+    if prefix_len == 3:
+        raw_source, command, target = split_prefix
+        if not server.actual_host:
+            server.actual_host = raw_source
+    elif prefix_len == 1:
+        command = split_prefix[0]
+    elif prefix_len == 2:
+        raw_source, command = split_prefix
+    elif prefix_len > 3:
+        (raw_source, command, target), args = (split_prefix[:3],
+                                               split_prefix[3:])
+
+    if not raw_source or raw_source == server.actual_host:
+        source = raw_source
+    else:
+        source = User.parse_user(raw_source, server.isupport.casemapping)
+
+    is_channel = target and target[0] in '#&+!'
+
+    if command == Events.PRIVMSG and is_channel:
+        command = Events.PUBMSG
+    elif command == Events.MODE and not is_channel:
+        command = Events.UMODE
+    elif command == Events.NOTICE:
+        if is_channel:
+            command = Events.PUBNOTICE
+        else:
+            command = Events.PRIVNOTICE
+
+    parsed = ParsedLine(server, raw_source, command, target, args, message)
+    # The users were made right away.
+    parsed._source = source
+    if server.actual_nick and target == server.actual_nick:
+        target = User.parse_user(target, server.isupport.casemapping)
+    parsed._target = target
+    return parsed
+
+def one_at_a_time(parse_line):
+    """Returns the parse and receive functions of a loop that parses and
+    hooks one line at a time, as the receive loop did before batches."""
+    def parse(server, chunk):
+        return [parse_line(server, line) for line in chunk]
+    def receive(server, manager, chunk):
+        for line in chunk:
+            parsed = parse_line(server, line)
+            manager.hook(parsed.command, None, parsed)
+    return parse, receive
+
+def receive_batch(server, manager, chunk):
+    """What Connection.process does with the lines of a read."""
+    for command, group in itertools.groupby(parse_irc_lines(server, chunk),
+                                            attrgetter('command')):
+        manager.hook_all(command, None, group)
+
+def chunks(lines, read_size=16384):
+    """Cuts lines into the runs of complete lines that reads of read_size
+    bytes would return."""
+    chunk, size = [], 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line) + 2
+        if size >= read_size:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+def event_manager():
+    """An EventManager with a hook that reads source, target and message for
+    each event of the netsplit."""
+    def hook(connection, source, target, message):
+        pass
+    return EventManager(dict((event, EventHook(hook, source=True, target=True,
+                                               message=True))
+                             for event in (Events.QUIT, Events.JOIN,
+                                           Events.MODE)))
+
+def replay(batches, receive, manager=None):
+    """Returns the best of five times of passing every chunk to receive,
+    along with an EventManager if one is given."""
+    best = None
+    for _ in xrange(5):
+        server = Server(capture.SERVER, 6667, capture.BOT)
+        server.actual_nick = capture.BOT
+        server.actual_host = capture.SERVER
+        User.identities.clear()
+        start = time.time()
+        if manager is None:
+            for chunk in batches:
+                receive(server, chunk)
+        else:
+            for chunk in batches:
+                receive(server, manager, chunk)
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+def main():
+    num_users = 20000
+    if len(sys.argv) > 1:
+        num_users = int(sys.argv[1])
+    lines = capture.netsplit(num_users)
+    batches = list(chunks(lines))
+    print 'Replaying %d lines in %d reads.' % (len(lines), len(batches))
+    print '%-28s %14s %14s' % ('receive loop', 'parse lines/s',
+                               '+hook lines/s')
+    loops = [('old, one line at a time',) + one_at_a_time(parse_split_line),
+             ('parse_irc_line',) + one_at_a_time(parse_irc_line),
+             ('parse_irc_lines', parse_irc_lines, receive_batch)]
+    for name, parse, receive in loops:
+        parse_only = replay(batches, parse)
+        parse_hook = replay(batches, receive, event_manager())
+        print '%-28s %14d %14d' % (name, len(lines) / parse_only,
+                                   len(lines) / parse_hook)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Made up IRC traffic for the benchmarks, shaped like what a bot sees on a busy
+network: most messages come from a small set of regulars, and the rest is
+numerics, NAMES replies, joins, parts and the odd netsplit. Everything is
+seeded, so that runs can be compared.
+"""
+
+import random
+
+SERVER = 'irc.example.net'
+BOT = 'brobot'
+
+WORDS = ('the', 'bot', 'is', 'down', 'again', 'lol', 'anyone', 'know', 'how',
+         'to', 'fix', 'this', 'python', 'http://example.com/some/page', 'ok',
+         'thanks', 'brb', 'what', 'about', 'ssl', 'works', 'for', 'me')
+
+def hostmasks(count, seed=0):
+    """Returns count distinct nick!user@host strings."""
+    rng = random.Random(seed)
+    masks = []
+    for i in xrange(count):
+        nick = 'user%d%s' % (i, rng.choice(('', '_', '|away', '[m]')))
+        host = '%d.%d.example.com' % (rng.randint(1, 254), rng.randint(1, 254))
+        masks.append('%s!~u%d@%s' % (nick, i, host))
+    return masks
+
+def nick(mask):
+    return mask.split('!', 1)[0]
+
+def sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in xrange(rng.randint(2, 14)))
+
+def channel_log(num_lines, num_users=2000, regulars=50, seed=0):
+    """PRIVMSG lines to a few channels, nine in ten of them from the
+    regulars."""
+    rng = random.Random(seed)
+    masks = hostmasks(num_users, seed)
+    channels = ['#chan%d' % i for i in xrange(5)]
+    lines = []
+    for _ in xrange(num_lines):
+        if rng.random() < 0.9:
+            mask = masks[int(rng.paretovariate(1.2)) % regulars]
+        else:
+            mask = rng.choice(masks)
+        lines.append(':%s PRIVMSG %s :%s' % (mask, rng.choice(channels),
+                                             sentence(rng)))
+    return lines
+
+def names_replies(channel, masks, per_line=20):
+    """The RPL_NAMREPLY lines listing masks in channel, and the end of the
+    list."""
+    lines = []
+    statuses = ('', '', '', '', '+', '@')
+    for i in xrange(0, len(masks), per_line):
+        names = ' '.join(statuses[j % len(statuses)] + nick(mask)
+                         for j, mask in enumerate(masks[i:i + per_line]))
+        lines.append(':%s 353 %s = %s :%s' % (SERVER, BOT, channel, names))
+    lines.append(':%s 366 %s %s :End of /NAMES list.' % (SERVER, BOT, channel))
+    return lines
+
+def netsplit(num_users=5000, channel='#chan0', seed=0):
+    """A netsplit and the rejoin that follows it: every user quits, joins
+    again and gets its status back from the server."""
+    masks = hostmasks(num_users, seed)
+    lines = []
+    for mask in masks:
+        lines.append(':%s QUIT :%s hub.example.net' % (mask, SERVER))
+    for mask in masks:
+        lines.append(':%s JOIN :%s' % (mask, channel))
+    ops = [nick(mask) for mask in masks[::10]]
+    for i in xrange(0, len(ops), 4):
+        batch = ops[i:i + 4]
+        lines.append(':%s MODE %s +%s %s' % (SERVER, channel, 'o' * len(batch),
+                                             ' '.join(batch)))
+    return lines
+
+def numerics(count, seed=0):
+    """Replies that nobody but the library reads, such as the MOTD."""
+    rng = random.Random(seed)
+    lines = []
+    for i in xrange(count):
+        lines.append(':%s %03d %s :- %s' % (SERVER, rng.choice((372, 251, 255,
+                                                                265, 266)),
+                                            BOT, sentence(rng)))
+    return lines
+
+def mixed(num_lines, seed=0):
+    """A bit of everything, in the proportions of a busy network."""
+    rng = random.Random(seed)
+    chat = channel_log(num_lines, seed=seed)
+    masks = hostmasks(2000, seed)
+    lines = []
+    for line in chat:
+        lines.append(line)
+        roll = rng.random()
+        if roll < 0.05:
+            lines.extend(numerics(1, rng.random()))
+        elif roll < 0.08:
+            lines.append(':%s JOIN :#chan%d' % (rng.choice(masks),
+                                                rng.randint(0, 4)))
+        elif roll < 0.11:
+            lines.append(':%s PART #chan%d :bye' % (rng.choice(masks),
+                                                    rng.randint(0, 4)))
+        elif roll < 0.12:
+            lines.append('PING :%s' % SERVER)
+        elif roll < 0.125:
+            lines.extend(names_replies('#chan%d' % rng.randint(0, 4),
+                                       rng.sample(masks, 100)))
+    return lines[:num_lines]
+
+def stream(lines):
+    """Joins lines the way they arrive on the wire."""
+    return '\r\n'.join(lines) + '\r\n'
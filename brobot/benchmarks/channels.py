@@ -0,0 +1,147 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Times find_channel, get_server_channels and a part and rejoin on a client in
+500 channels across 10 networks, through the Client that scanned a list of
+every channel, building a Channel with two Locks to compare against, and
+through the current one, which indexes its channels by server and name. Run
+from the brobot directory with
+
+    python -m benchmarks.channels [networks] [channels per network]
+"""
+
+from core.irc.clients import Client
+from core.irc.structures import Server, Channel
+from threading import Lock
+import random
+import sys
+import time
+
+class ListChannel(object):
+    """The Channel from before channels were indexed, as far as finding one
+    goes."""
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name.lower()
+        self.user_lock = Lock()
+        self.mode_lock = Lock()
+
+    def __eq__(self, other):
+        return self.server == other.server and self.name == other.name
+
+
+class ListClient(object):
+    """The channel bookkeeping of the Client from before the index."""
+    def __init__(self):
+        self.channels = []
+
+    def get_server_channels(self, server):
+        for channel in self.channels:
+            if channel.server == server:
+                yield channel
+
+    def add_channel(self, channel):
+        self.channels.append(channel)
+
+    def find_channel(self, server, name):
+        search_channel = ListChannel(server, name)
+        for channel in self.channels:
+            if search_channel == channel:
+                return channel
+        return None
+
+    def remove_channel(self, server, name):
+        channel = ListChannel(server, name)
+        try:
+            self.channels.remove(channel)
+        except ValueError:
+            pass
+
+
+def servers(count):
+    servers = []
+    for i in xrange(count):
+        server = Server('irc%d.example.net' % i, 6667, 'brobot',
+                        name='net%d' % i)
+        server.actual_host = server.host
+        server.actual_nick = server.nick
+        servers.append(server)
+    return servers
+
+def lookups(servers, per_server, count, seed=0):
+    """Returns count (server, name) pairs, with names in mixed case as users
+    type them."""
+    rng = random.Random(seed)
+    pairs = []
+    for _ in xrange(count):
+        name = '#Chan%d' % rng.randrange(per_server)
+        pairs.append((rng.choice(servers), name))
+    return pairs
+
+def time_find(client, pairs):
+    find_channel = client.find_channel
+    start = time.time()
+    for server, name in pairs:
+        find_channel(server, name)
+    return (time.time() - start) / len(pairs)
+
+def time_server_channels(client, servers, count):
+    get_server_channels = client.get_server_channels
+    start = time.time()
+    for i in xrange(count):
+        for channel in get_server_channels(servers[i % len(servers)]):
+            pass
+    return (time.time() - start) / count
+
+def time_rejoin(client, make_channel, pairs):
+    start = time.time()
+    for server, name in pairs:
+        client.remove_channel(server, name)
+        client.add_channel(make_channel(server, name))
+    return (time.time() - start) / len(pairs)
+
+def main():
+    num_servers, per_server = 10, 50
+    if len(sys.argv) > 1:
+        num_servers = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        per_server = int(sys.argv[2])
+    networks = servers(num_servers)
+    old, new = ListClient(), Client(networks)
+    for server in networks:
+        for i in xrange(per_server):
+            old.add_channel(ListChannel(server, '#chan%d' % i))
+            new.add_channel(Channel(server, '#chan%d' % i))
+    pairs = lookups(networks, per_server, 20000)
+    print '%d channels on %d networks, microseconds per call:' % (
+            num_servers * per_server, num_servers)
+    print '%-8s %14s %20s %14s' % ('client', 'find_channel',
+                                   'get_server_channels', 'part+join')
+    for name, client, make_channel in (('list', old, ListChannel),
+                                       ('index', new, Channel)):
+        times = [min(time_find(client, pairs) for _ in xrange(3)),
+                 min(time_server_channels(client, networks, 2000)
+                     for _ in xrange(3)),
+                 min(time_rejoin(client, make_channel, pairs[:2000])
+                     for _ in xrange(3))]
+        print '%-8s %14.2f %20.2f %14.2f' % tuple(
+                [name] + [seconds * 1e6 for seconds in times])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Times the dispatch of already parsed lines, per event type, through the
+EventManager that looked the arguments of every hook up with getattr and then
+called the plugins with keyword arguments, and through the compiled dispatch
+functions, with and without an inline plugin. The compiled functions are timed
+through hook, one line at a time through hook_all, and with runs of 50 lines
+of the same event, such as the JOINs after a netsplit. Run from the brobot
+directory with
+
+    python -m benchmarks.dispatch [dispatches]
+"""
+
+from benchmarks import capture
+from benchmarks.parser import parse_dict_line
+from core.irc.clients import PluginEventManager
+from core.irc.events import Events, EventManager, EventHook
+from core.irc.structures import Server
+from core.irc.utils import parse_irc_lines
+import sys
+import time
+
+class KeywordEventManager(object):
+    """The EventManager and PluginEventManager from before dispatch functions
+    were compiled."""
+    EVENT_ARGS = EventManager.EVENT_ARGS
+
+    def __init__(self, event_hooks, event_plugins):
+        self.event_hooks = event_hooks
+        self.event_plugins = event_plugins
+
+    def hook(self, event, connection, kwargs=None):
+        if event in self.event_hooks:
+            event_hook = self.event_hooks[event]
+            if kwargs is None:
+                kwargs = {}
+            args = (kwargs.get(arg, '') for arg in self.EVENT_ARGS
+                    if getattr(event_hook, arg))
+            event_hook.function(connection, *args)
+        if event in self.event_plugins:
+            for plugin in self.event_plugins[event]:
+                plugin.process(connection, **kwargs)
+
+
+class Plugin(object):
+    inline = True
+
+    def process(self, connection, source=None, target=None, message=None,
+                **kwargs):
+        pass
+
+
+def noop(connection, *args):
+    pass
+
+# event -> (a line raising it, the parts its hook asks for)
+EVENTS = [
+    (Events.PING, 'PING :%s' % capture.SERVER, ('message',)),
+    (Events.PUBMSG, ':nick!~user@host PRIVMSG #chan :hello there',
+     ('source', 'target', 'message')),
+    (Events.JOIN, ':nick!~user@host JOIN :#chan', ('source', 'message')),
+    (Events.RPL_NAMEREPLY, ':%s 353 %s = #chan :@op +voice plain' %
+     (capture.SERVER, capture.BOT), ('source', 'target', 'args', 'message')),
+    ('372', ':%s 372 %s :- message of the day' % (capture.SERVER,
+                                                  capture.BOT), None),
+]
+
+def managers(plugins):
+    hooks = {}
+    for event, _, parts in EVENTS:
+        if parts is not None:
+            hooks[event] = dict((part, True) for part in parts)
+    event_plugins = {}
+    if plugins:
+        event_plugins = {Events.PUBMSG: [Plugin()], Events.JOIN: [Plugin()]}
+    old = KeywordEventManager(dict((event, EventHook(noop, **parts))
+                                   for event, parts in hooks.iteritems()),
+                              event_plugins)
+    new = PluginEventManager(dict((event, EventHook(noop, **parts))
+                                  for event, parts in hooks.iteritems()),
+                             event_plugins)
+    return old, new
+
+def time_hook(manager, event, line, count):
+    hook = manager.hook
+    start = time.time()
+    for _ in xrange(count):
+        hook(event, None, line)
+    return time.time() - start
+
+def time_hook_all(manager, event, line, count, run):
+    """Dispatches count lines in runs of run lines, as Connection.process
+    does with the lines of a read that raise the same event."""
+    hook_all = manager.hook_all
+    lines = [line] * run
+    start = time.time()
+    for _ in xrange(count // run):
+        hook_all(event, None, lines)
+    return time.time() - start
+
+def main():
+    count = 200000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    server = Server(capture.SERVER, 6667, capture.BOT)
+    server.actual_nick = capture.BOT
+    server.actual_host = capture.SERVER
+    print 'Nanoseconds per line:'
+    print '%-8s %-8s %10s %10s %10s %10s' % ('event', 'plugin', 'getattr',
+                                             'hook', 'run of 1',
+                                             'run of 50')
+    for plugins in ('', 'inline'):
+        old, new = managers(plugins)
+        for event, raw, _ in EVENTS:
+            if plugins and event not in old.event_plugins:
+                continue
+            line_info = parse_dict_line(server, raw)
+            del line_info['command']
+            parsed = parse_irc_lines(server, [raw])[0]
+            parsed.message # decoded once, as the dict parser did
+            times = [min(time_hook(old, event, line_info, count)
+                         for _ in xrange(3)),
+                     min(time_hook(new, event, parsed, count)
+                         for _ in xrange(3))]
+            for run in (1, 50):
+                times.append(min(time_hook_all(new, event, parsed, count, run)
+                                 for _ in xrange(3)))
+            print '%-8s %-8s %10.0f %10.0f %10.0f %10.0f' % tuple(
+                [event, plugins or '-'] + [seconds * 1e9 / count
+                                           for seconds in times])
+
+if __name__ == '__main__':
+    main()
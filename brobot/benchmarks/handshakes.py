@@ -0,0 +1,132 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Times TLS handshakes against a local listener, as a flapping connection would
+pay them on every reconnect: with ssl.wrap_socket, which builds a new context
+for every socket, with the SSLContext shared by every reconnect, and with the
+shared context offering the previous session for resumption where the ssl
+module supports it. The listener uses a throwaway certificate made with the
+openssl command. Run from the brobot directory with
+
+    python -m benchmarks.handshakes [handshakes]
+"""
+
+from core.irc.connections import wrap_ssl_socket
+from core.irc.structures import Server
+from threading import Thread
+import subprocess
+import tempfile
+import shutil
+import socket
+import ssl
+import sys
+import os
+import time
+
+def make_certificate(directory):
+    """Returns the paths of a self-signed certificate for localhost and its
+    key, written to directory."""
+    certfile = os.path.join(directory, 'localhost.crt')
+    keyfile = os.path.join(directory, 'localhost.key')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey',
+                               'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=localhost',
+                               '-keyout', keyfile, '-out', certfile],
+                              stdout=devnull, stderr=devnull)
+    return certfile, keyfile
+
+def listen(certfile, keyfile):
+    """Starts a TLS listener on a free loopback port in a thread, which
+    shakes hands with every connection and waits for it to close. Returns
+    the port."""
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.load_cert_chain(certfile, keyfile)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    def serve():
+        while True:
+            client, _ = sock.accept()
+            try:
+                client = context.wrap_socket(client, server_side=True)
+                client.recv(1)
+            except (socket.error, ssl.SSLError):
+                pass
+            client.close()
+    thread = Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return sock.getsockname()[1]
+
+def legacy(server, sock):
+    """What Connection.__init__ used to do."""
+    return ssl.wrap_socket(sock)
+
+def shared(server, sock):
+    server.ssl_session = None
+    return wrap_ssl_socket(server, sock)
+
+def resumed(server, sock):
+    return wrap_ssl_socket(server, sock)
+
+def run(wrap, server, count):
+    """Connects count times, and returns the seconds taken and how many of the
+    handshakes resumed a session."""
+    reused = 0
+    start = time.time()
+    for _ in xrange(count):
+        sock = socket.create_connection(('127.0.0.1', server.port))
+        sock = wrap(server, sock)
+        if getattr(sock, 'session_reused', False):
+            reused += 1
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            server.ssl_session = session
+        sock.close()
+    return time.time() - start, reused
+
+def main():
+    count = 200
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    directory = tempfile.mkdtemp()
+    try:
+        certfile, keyfile = make_certificate(directory)
+        port = listen(certfile, keyfile)
+        print 'Timing %d handshakes with %s.' % (count, ssl.OPENSSL_VERSION)
+        print '%-24s %10s %14s %8s' % ('path', 'ms each', 'handshakes/s',
+                                       'resumed')
+        paths = [('ssl.wrap_socket', legacy), ('shared context', shared)]
+        if hasattr(ssl.SSLSocket, 'session'):
+            paths.append(('shared + resumption', resumed))
+        else:
+            print '(session resumption is not supported by this Python)'
+        for name, wrap in paths:
+            server = Server('localhost', port, 'bot', use_ssl=True,
+                            ssl_options={'ca_certs': certfile})
+            run(wrap, server, 5) # warm up
+            seconds, reused = run(wrap, server, count)
+            print '%-24s %10.2f %14.1f %8d' % (name, seconds * 1000 / count,
+                                               count / seconds, reused)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Times User.parse_user and parse_irc_lines on a channel log where a few
+regulars say most of the lines, with the hostmask cache at a few sizes and
+with no cache at all. Run from the brobot directory with
+
+    python -m benchmarks.hostmasks [lines]
+"""
+
+from benchmarks import capture
+from core.irc.caches import LRUCache
+from core.irc.structures import Server, User
+from core.irc.utils import parse_irc_lines
+import sys
+import time
+
+class NoCache(object):
+    """Stands in for the LRUCache so that every hostmask is parsed."""
+    def get(self, key, default=None):
+        return default
+
+    def put(self, key, value):
+        pass
+
+    def stats(self):
+        return {'hit_ratio': 0.0}
+
+
+def time_parse_user(masks):
+    parse_user = User.parse_user
+    start = time.time()
+    for mask in masks:
+        parse_user(mask)
+    return time.time() - start
+
+def time_parse_lines(lines, read_lines=100):
+    server = Server(capture.SERVER, 6667, capture.BOT)
+    server.actual_nick = capture.BOT
+    server.actual_host = capture.SERVER
+    start = time.time()
+    for i in xrange(0, len(lines), read_lines):
+        # The source is only parsed once a hook asks for it.
+        for line in parse_irc_lines(server, lines[i:i + read_lines]):
+            line.source
+    return time.time() - start
+
+def main():
+    num_lines = 200000
+    if len(sys.argv) > 1:
+        num_lines = int(sys.argv[1])
+    lines = capture.channel_log(num_lines)
+    masks = [line[1:line.index(' ')] for line in lines]
+    print '%d lines from %d distinct hostmasks.' % (len(lines),
+                                                    len(set(masks)))
+    print '%-16s %16s %18s %10s' % ('cache', 'parse_user/s',
+                                    'parse_irc_lines/s', 'hit ratio')
+    identities = User.identities
+    try:
+        for name, cache in (('none', NoCache()),
+                            ('LRU 256', LRUCache(256)),
+                            ('LRU 4096', LRUCache(4096))):
+            User.identities = cache
+            parse_user = min(time_parse_user(masks) for _ in xrange(3))
+            parse_lines = min(time_parse_lines(lines) for _ in xrange(3))
+            print '%-16s %16d %18d %10.3f' % (name, len(masks) / parse_user,
+                                              len(lines) / parse_lines,
+                                              cache.stats()['hit_ratio'])
+    finally:
+        User.identities = identities
+
+if __name__ == '__main__':
+    main()
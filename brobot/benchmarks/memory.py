@@ -0,0 +1,135 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Measures the memory it takes to track users in channels and to keep channels
+with a few modes set, with the structures from before they had __slots__ and
+with the current ones. Python 2 has no tracemalloc, so every run happens in a
+fresh child process, which reports how much its peak resident memory grew.
+The nicks and hostmasks are parsed beforehand and shared by both layouts, so
+only the objects themselves and their roster entries are counted. Run from
+the brobot directory with
+
+    python -m benchmarks.memory [users]
+"""
+
+from benchmarks import capture
+from core.irc.structures import Server, Channel, Mode, User
+from threading import Lock
+import resource
+import sys
+import os
+
+class DictUser(object):
+    """The User from before __slots__."""
+    def __init__(self, nick, username, host, status, casemapping):
+        self.nick = nick
+        self.key = casemapping.lower(nick)
+        self.username = username
+        self.host = host
+        self.status = User.STATUSES.get(status, 1)
+
+
+class DictMode(object):
+    """The Mode from before __slots__, which channels kept one of for every
+    set mode."""
+    def __init__(self, character, param='', on=True):
+        self.character = character
+        self.param = param
+        self.on = on
+
+
+class DictChannel(object):
+    """The Channel from before __slots__, with two Locks of its own and a
+    list of Modes."""
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+        self.key = server.lower(name)
+        self.user_lock = Lock()
+        self.mode_lock = Lock()
+        self.roster = {}
+        self.modes = []
+
+    def add_mode(self, mode):
+        self.modes.append(mode)
+
+
+def track_users(make_user, identities, per_channel=5000):
+    """Puts a user for every identity in channels of per_channel users, as
+    Channel.add_user does."""
+    server = Server(capture.SERVER, 6667, capture.BOT)
+    casemapping = server.isupport.casemapping
+    channels = []
+    for i, identity in enumerate(identities):
+        if i % per_channel == 0:
+            channel = Channel(server, '#chan%d' % len(channels))
+            channels.append(channel)
+        channel.add_user(make_user(*identity, casemapping=casemapping))
+    return channels
+
+def keep_channels(make_channel, make_mode, count):
+    """Makes count channels with +nt, a key and a limit set."""
+    server = Server(capture.SERVER, 6667, capture.BOT)
+    channels = []
+    for i in xrange(count):
+        channel = make_channel(server, '#chan%d' % i)
+        for character, param in (('n', ''), ('t', ''), ('k', 'secret'),
+                                 ('l', '50')):
+            channel.add_mode(make_mode(character, param))
+        channels.append(channel)
+    return channels
+
+def growth(build):
+    """Runs build in a child process, and returns how many bytes its peak
+    resident memory grew by."""
+    result_fd, report_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(result_fd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        build()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(report_fd, '%d' % ((after - before) * 1024))
+        os._exit(0)
+    os.close(report_fd)
+    report = os.read(result_fd, 1024)
+    os.close(result_fd)
+    os.waitpid(pid, 0)
+    return int(report)
+
+def main():
+    num_users = 200000
+    if len(sys.argv) > 1:
+        num_users = int(sys.argv[1])
+    identities = [User.parse_identity(mask)
+                  for mask in capture.hostmasks(num_users)]
+    num_channels = num_users // 10
+    print '%-12s %16s %16s' % ('layout', 'bytes per user',
+                               'bytes per channel')
+    for name, make_user, make_channel, make_mode in (
+            ('__dict__', DictUser, DictChannel, DictMode),
+            ('__slots__', User, Channel, Mode)):
+        users = growth(lambda: track_users(make_user, identities))
+        channels = growth(lambda: keep_channels(make_channel, make_mode,
+                                                num_channels))
+        print '%-12s %16.1f %16.1f' % (name, users / float(num_users),
+                                       channels / float(num_channels))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Times parse_irc_line on PRIVMSG, numeric and NAMES lines against the parser
+that returned a dict, both on its own and followed by reading the parts an
+event hook gets. Run from the brobot directory with
+
+    python -m benchmarks.parser [lines]
+"""
+
+from benchmarks import capture
+from core.irc.events import Events, EventManager
+from core.irc.structures import Server, User
+from core.irc.utils import parse_irc_line
+import sys
+import time
+
+class DictUser(object):
+    """The User that the dict parser made for every source."""
+    STATUSES = {'~': 5, '&': 4, '@': 3, '%': 2, '+': 1, '': 0}
+
+    def __init__(self, nick, username, host, status):
+        self.nick = nick.lower()
+        self.username = username
+        self.host = host
+        self.status = self.STATUSES.get(status, 0)
+
+    @classmethod
+    def parse_user(cls, user):
+        username, host = '', ''
+        if user[0] in cls.STATUSES:
+            status, nick = user[0], user[1:]
+        else:
+            status = ''
+            split_user = user.split('@')
+            if len(split_user) == 1:
+                nick = split_user[0]
+            else:
+                info, host = split_user
+                nick, username = info.split('!')
+        return cls(nick, username, host, status)
+
+
+def parse_dict_line(server, line):
+    """The parser as it was before ParsedLine."""
+    raw_source, command, target, args, message = '', '', '', [], ''
+
+    split_line = line.split(' :', 1)
+    split_line_len = len(split_line)
+    if split_line_len == 1:
+        if line.startswith(':'):
+            split_prefix = line[1:].split()
+        else:
+            split_prefix = line.split()
+    elif split_line_len == 2:
+        irc_protocol_prefix, message = split_line
+        if irc_protocol_prefix.startswith(':'):
+            split_prefix = irc_protocol_prefix[1:].split()
+        else:
+            split_prefix = irc_protocol_prefix.split()
+
+    prefix_len = len(split_prefix)
+
+    if prefix_len == 3:
+        raw_source, command, target = split_prefix
+        if not server.actual_host:
+            server.actual_host = raw_source
+    elif prefix_len == 1:
+        command = split_prefix[0]
+    elif prefix_len == 2:
+        raw_source, command = split_prefix
+    elif prefix_len > 3:
+        (raw_source, command, target), args = (split_prefix[:3],
+                                               split_prefix[3:])
+
+    if not raw_source or raw_source == server.actual_host:
+        source = raw_source
+    else:
+        source = DictUser.parse_user(raw_source)
+
+    is_channel = target and target[0] in '#&+!'
+
+    if command == Events.PRIVMSG and is_channel:
+        command = Events.PUBMSG
+    elif command == Events.MODE and not is_channel:
+        command = Events.UMODE
+    elif command == Events.NOTICE:
+        if is_channel:
+            command = Events.PUBNOTICE
+        else:
+            command = Events.PRIVNOTICE
+
+    if server.actual_nick and target == server.actual_nick:
+        target = DictUser.parse_user(target)
+
+    line_info = {
+        'source': source,
+        'command': command,
+        'target': target,
+        'args': args,
+        'message': message.decode('utf-8')
+    }
+    for name, value in line_info.items():
+        if not value:
+            del line_info[name]
+    return line_info
+
+def read_dict(line_info):
+    """What Connection.process and EventManager.hook did with the dict."""
+    del line_info['command']
+    return tuple(line_info.get(arg, '') for arg in EventManager.EVENT_ARGS)
+
+def read_parsed(parsed):
+    return parsed.source, parsed.target, parsed.args, parsed.message
+
+def run(parse, read, server, lines):
+    User.identities.clear()
+    start = time.time()
+    if read is None:
+        for line in lines:
+            parse(server, line)
+    else:
+        for line in lines:
+            read(parse(server, line))
+    return time.time() - start
+
+def best_of(repeat, *args):
+    return min(run(*args) for _ in xrange(repeat))
+
+def main():
+    num_lines = 100000
+    if len(sys.argv) > 1:
+        num_lines = int(sys.argv[1])
+    masks = capture.hostmasks(num_lines * 2)
+    workloads = [
+        ('PRIVMSG', capture.channel_log(num_lines)),
+        ('numeric', capture.numerics(num_lines)),
+        ('NAMES', capture.names_replies('#chan0', masks)),
+    ]
+    print '%-10s %-22s %14s %14s' % ('lines', 'parser', 'parse lines/s',
+                                     '+read lines/s')
+    for name, lines in workloads:
+        for parser, parse, read in (('dict', parse_dict_line, read_dict),
+                                    ('ParsedLine', parse_irc_line,
+                                     read_parsed)):
+            server = Server(capture.SERVER, 6667, capture.BOT)
+            server.actual_nick = capture.BOT
+            server.actual_host = capture.SERVER
+            parse_only = best_of(3, parse, None, server, lines)
+            parse_read = best_of(3, parse, read, server, lines)
+            print '%-10s %-22s %14d %14d' % (name, parser,
+                                             len(lines) / parse_only,
+                                             len(lines) / parse_read)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Measures what one tick of the main loop costs to poll 1, 100 and 2000
+connections, when they are all idle and when they all have data waiting, with
+every poller and with the select call on a rebuilt key list that the
+ConnectionManager used to make. Run from the brobot directory with
+
+    python -m benchmarks.pollers
+"""
+
+from core.irc.pollers import POLLERS, READ
+import select
+import socket
+import timeit
+
+SIZES = (1, 100, 2000)
+
+# select.select cannot watch descriptors past FD_SETSIZE.
+FD_SETSIZE = 1024
+
+def rebuilt_select(connections):
+    """The old tick: a fresh key list and a select call."""
+    def tick():
+        select.select(connections.keys(), [], [], 0)
+    return tick
+
+def poller_tick(poller):
+    def tick():
+        poller.poll(0)
+    return tick
+
+def time_tick(tick, number):
+    """Returns the best time of a tick in microseconds."""
+    return min(timeit.repeat(tick, repeat=5, number=number)) / number * 1e6
+
+def run(size, active):
+    pairs = [socket.socketpair() for _ in xrange(size)]
+    try:
+        if active:
+            for _, writer in pairs:
+                writer.send('x')
+        connections = dict((reader, None) for reader, _ in pairs)
+        number = max(10, 20000 // size)
+        results = []
+        fits_select = max(reader.fileno() for reader in connections) < \
+                FD_SETSIZE
+        if fits_select:
+            results.append(('select (rebuilt)',
+                            time_tick(rebuilt_select(connections), number)))
+        else:
+            results.append(('select (rebuilt)', None))
+        for name in sorted(POLLERS):
+            if name == 'select' and not fits_select:
+                results.append((name, None))
+                continue
+            try:
+                poller = POLLERS[name]()
+            except AttributeError:
+                # epoll is Linux only.
+                continue
+            for reader in connections:
+                poller.register(reader, READ)
+            results.append((name, time_tick(poller_tick(poller), number)))
+            poller.close()
+        return results
+    finally:
+        for reader, writer in pairs:
+            reader.close()
+            writer.close()
+
+def main():
+    print '%-12s %-8s %-18s %14s' % ('connections', 'state', 'poller',
+                                     'us per tick')
+    for size in SIZES:
+        for active in (False, True):
+            state = 'active' if active else 'idle'
+            for name, micros in run(size, active):
+                if micros is None:
+                    timing = 'n/a (FD_SETSIZE)'
+                else:
+                    timing = '%.1f' % micros
+                print '%-12d %-8s %-18s %14s' % (size, state, name, timing)
+
+if __name__ == '__main__':
+    main()
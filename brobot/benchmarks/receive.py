@@ -0,0 +1,115 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Replays a capture (100 MB by default) through a socket pair into the old
+receive path, which read 4096 bytes at a time and glued the partial line back
+on with string concatenation, and into the LineBuffer, at a few read sizes.
+Every run happens in a fresh child process, which reports its throughput, how
+many reads it took and its peak memory. Run from the brobot directory with
+
+    python -m benchmarks.receive [megabytes]
+"""
+
+from benchmarks import capture
+from core.irc.connections import LineBuffer
+import resource
+import socket
+import sys
+import os
+import time
+
+def old_path(sock):
+    """What Connection.process used to do with every read."""
+    prev_line = ''
+    num_lines = reads = 0
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        reads += 1
+        lines = [s.strip() for s in (prev_line + data).split('\n')]
+        prev_line = lines.pop()
+        for line in lines:
+            if line:
+                num_lines += 1
+    return num_lines, reads
+
+def line_buffer_path(read_size):
+    def receive(sock):
+        buf = LineBuffer(read_size)
+        num_lines = reads = 0
+        while buf.recv_from(sock):
+            reads += 1
+            num_lines += len(buf.lines())
+        return num_lines, reads
+    return receive
+
+def replay(receive, sample, size):
+    """Sends size bytes made of copies of sample from this process, and
+    receives them with receive in a child process. Returns (lines, reads,
+    seconds, peak memory in KB) as measured by the child."""
+    reader, writer = socket.socketpair()
+    result_fd, report_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        writer.close()
+        os.close(result_fd)
+        start = time.time()
+        num_lines, reads = receive(reader)
+        seconds = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(report_fd, '%d %d %f %d' % (num_lines, reads, seconds, peak))
+        os._exit(0)
+    reader.close()
+    os.close(report_fd)
+    sent = 0
+    while sent < size:
+        writer.sendall(sample)
+        sent += len(sample)
+    writer.close()
+    report = os.read(result_fd, 1024)
+    os.close(result_fd)
+    os.waitpid(pid, 0)
+    num_lines, reads, seconds, peak = report.split()
+    return int(num_lines), int(reads), float(seconds), int(peak)
+
+def main():
+    megabytes = 100
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    sample = capture.stream(capture.mixed(10000))
+    copies = megabytes * 2 ** 20 // len(sample) + 1
+    size = copies * len(sample)
+    print 'Replaying %.1f MB (%d lines).' % (size / 2.0 ** 20,
+                                             copies * sample.count('\n'))
+    print '%-24s %10s %10s %12s %10s' % ('path', 'MB/s', 'lines/s', 'reads',
+                                         'peak KB')
+    paths = [('old (recv 4096)', old_path)]
+    for read_size in (4096, 16384, 65536):
+        paths.append(('LineBuffer (%d)' % read_size,
+                      line_buffer_path(read_size)))
+    for name, receive in paths:
+        num_lines, reads, seconds, peak = replay(receive, sample, size)
+        print '%-24s %10.1f %10d %12d %10d' % (name,
+                                               size / 2.0 ** 20 / seconds,
+                                               num_lines / seconds, reads,
+                                               peak)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Loads a big channel and replays joins, parts and mode changes on it, through
+the Channel that kept its users in a list and compared them one by one, and
+through the current Channel, which keeps them in a dict keyed by nick. The
+list roster is quadratic, so it loads a tenth of the users and only replays a
+sample of the events on a full channel. Run from the brobot directory with
+
+    python -m benchmarks.roster [users] [events]
+"""
+
+from benchmarks import capture
+from core.irc.structures import Server, Channel, Mode, User
+import random
+import sys
+import time
+
+class ListUser(object):
+    """The User from before users were keyed, equal to another one with the
+    same nick, username and host."""
+    def __init__(self, nick, username, host, status=1):
+        self.nick = nick.lower()
+        self.username = username
+        self.host = host
+        self.status = status
+
+    def __eq__(self, other):
+        return self.nick == other.nick and \
+                self.username == other.username and \
+                self.host == other.host
+
+    def add_mode(self, mode):
+        self.status |= User.STATUSES[User.MODES[mode.character]]
+
+    def remove_mode(self, mode):
+        self.status &= ~User.STATUSES[User.MODES[mode.character]]
+
+
+class ListChannel(object):
+    """The Channel from before its users were kept in a dict. Hooks passed it
+    a User with only a nick, as JOIN, PART and NAMES did."""
+    def __init__(self, users=None):
+        self.users = list(users or ())
+
+    def add_user(self, user):
+        if user not in self.users:
+            self.users.append(user)
+
+    def remove_user(self, user):
+        try:
+            self.users.remove(user)
+        except ValueError:
+            pass
+
+    def find_user(self, nick):
+        search_user = ListUser(nick, '', '')
+        for user in self.users:
+            if user == search_user:
+                return user
+        return None
+
+
+def events(masks, count, seed=0):
+    """Returns count ('join', mask), ('part', mask) or ('mode', Mode) events,
+    for a channel that starts with every mask but the last half of them in
+    it, and keeps about as many users as it starts with."""
+    rng = random.Random(seed)
+    inside = masks[:len(masks) // 2]
+    outside = masks[len(masks) // 2:]
+    replay = []
+    for _ in xrange(count):
+        kind = rng.random()
+        i = rng.randrange(len(inside))
+        if kind < 0.3:
+            j = rng.randrange(len(outside))
+            inside[i], outside[j] = outside[j], inside[i]
+            replay.append(('part', outside[j]))
+            replay.append(('join', inside[i]))
+        else:
+            replay.append(('mode', Mode('o', capture.nick(inside[i]),
+                                        kind < 0.7)))
+    return replay[:count]
+
+def replay_list(channel, replay):
+    start = time.time()
+    for kind, value in replay:
+        if kind == 'mode':
+            user = channel.find_user(value.param)
+            if value.on:
+                user.add_mode(value)
+            else:
+                user.remove_mode(value)
+        elif kind == 'join':
+            channel.add_user(ListUser(capture.nick(value), '', ''))
+        else:
+            channel.remove_user(ListUser(capture.nick(value), '', ''))
+    return time.time() - start
+
+def replay_dict(channel, replay, users):
+    start = time.time()
+    for kind, value in replay:
+        if kind == 'mode':
+            user = channel.find_user(value.param)
+            if value.on:
+                user.add_mode(value)
+            else:
+                user.remove_mode(value)
+        elif kind == 'join':
+            channel.add_user(users[value])
+        else:
+            channel.remove_user(users[value])
+    return time.time() - start
+
+def load_list(masks):
+    channel = ListChannel()
+    start = time.time()
+    for mask in masks:
+        channel.add_user(ListUser(capture.nick(mask), '', ''))
+    return channel, time.time() - start
+
+def load_dict(masks, users):
+    channel = Channel(Server(capture.SERVER, 6667, capture.BOT), '#chan')
+    start = time.time()
+    for mask in masks:
+        channel.add_user(users[mask])
+    return channel, time.time() - start
+
+def main():
+    num_users, num_events = 50000, 100000
+    if len(sys.argv) > 1:
+        num_users = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        num_events = int(sys.argv[2])
+    masks = capture.hostmasks(num_users * 2)
+    users = dict((mask, User.parse_user(mask)) for mask in masks)
+    replay = events(masks, num_events)
+    sample = replay[:max(1, num_events // 100)]
+    small = masks[:num_users // 10]
+
+    print '%-8s %8s %10s %8s %12s' % ('roster', 'users', 'load s', 'events',
+                                      'us/event')
+    _, seconds = load_list(small)
+    print '%-8s %8d %10.3f %8s %12s' % ('list', len(small), seconds, '-', '-')
+    _, seconds = load_dict(small, users)
+    print '%-8s %8d %10.3f %8s %12s' % ('dict', len(small), seconds, '-', '-')
+
+    # Filled without the membership checks, which would take minutes.
+    channel = ListChannel(ListUser(capture.nick(mask), '', '')
+                          for mask in masks[:num_users])
+    seconds = replay_list(channel, sample)
+    print '%-8s %8d %10s %8d %12.1f' % ('list', num_users, '-', len(sample),
+                                        seconds * 1e6 / len(sample))
+    channel, load = load_dict(masks[:num_users], users)
+    seconds = replay_dict(channel, replay, users)
+    print '%-8s %8d %10.3f %8d %12.1f' % ('dict', num_users, load,
+                                          len(replay),
+                                          seconds * 1e6 / len(replay))
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,15 @@
 
 import sys
 import os
+import socket
+
+def read_settings(settings_path):
+    import yaml
+    f = open(settings_path)
+    try:
+        return yaml.load(f)
+    finally:
+        f.close()
 
 class Brobot(object):
     def __init__(self, brobot_path):
@@ -43,9 +52,15 @@ class Brobot(object):
         self.ircbot.exit()
     
     def load_settings(self):
-        import yaml
-        f = open(self.settings_path)
-        settings = yaml.load(f)
+        settings = read_settings(self.settings_path)
+        
+        shard = os.environ.get('BROBOT_SHARD')
+        if shard is not None:
+            from core.shards import shard_servers
+            settings['shard'] = int(shard)
+            settings['servers'] = shard_servers(settings['servers'],
+                                                settings['shards'],
+                                                settings['shard'])
         
         settings['brobot_path'] = self.brobot_path
         settings['base_path'] = self.brobot_dir
@@ -64,7 +79,27 @@ def main():
         brobot.exit()
     sys.exit(0)
 
+def restart_shards_with_reboot(num_shards):
+    """Runs every shard in its own process, restarting each one that exits
+    with code 3."""
+    from core.shards import Supervisor
+    import logging
+    logging.basicConfig(level=logging.INFO,
+                        format="%(levelname)-8s - %(message)s")
+    supervisor = Supervisor([sys.executable] + sys.argv, num_shards)
+    return supervisor.run()
+
 def restart_with_reboot():
+    import os.path
+    brobot_dir = os.path.dirname(os.path.abspath(__file__))
+    settings = read_settings(os.path.join(brobot_dir, 'settings.yml'))
+    num_shards = settings.get('shards', 1)
+    if num_shards > 1:
+        if not hasattr(socket, 'socketpair'):
+            sys.stderr.write('Shards are not supported on this platform.\n')
+        else:
+            return restart_shards_with_reboot(num_shards)
+    
     while True:
         args = [sys.executable] + sys.argv
         if sys.platform == 'win32':
@@ -20,9 +20,14 @@ from irc.clients import Client
 from irc.structures import Server
 from irc.events import Events
 from irc.connections import IRCError
-from threading import Thread
-import itertools
+from irc.pollers import get_poller
+from irc.flood import INTERACTIVE, BULK, KeyedBuckets
+from irc.workers import WorkerPool, DROP_OLDEST, REJECT
+from irc.caches import LRUCache
+from shards import ShardChannel
+from registry import CommandRegistry
 import logging
+import time
 import os
 
 log = logging.getLogger(__name__)
@@ -49,13 +54,60 @@ class Plugin(object):
     
 
 class CommandPlugin(Plugin):
-    """Abstract Plugin to be used for commands."""
+    """Abstract Plugin to be used for commands. Plugins whose answers only
+    depend on their arguments can set cache_ttl, and the answers are then
+    reused for that many seconds, keeping up to cache_size of them. What makes
+    two commands the same is decided by cache_key. Cached answers are thrown
+    away whenever the registered commands change."""
     class Action(object):
         PRIVMSG = staticmethod(lambda bot: bot.privmsg)
         NOTICE  = staticmethod(lambda bot: bot.notice)
     
-    def _process(self, connection, source, target, args):
+    cache_ttl = None
+    cache_size = 64
+    cache_hits = 0
+    cache_misses = 0
+    _cache = None
+    _cache_version = None
+    
+    def cache_key(self, connection, source, target, args):
+        return (connection.server.name, target, tuple(args))
+    
+    def cache_stats(self):
+        """Returns how often answers came from the cache."""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'size': len(self._cache) if self._cache is not None else 0,
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_ratio': self.cache_hits / float(lookups) if lookups else 0.0
+        }
+    
+    def _cached_process(self, connection, source, target, args):
+        if self.cache_ttl is None:
+            return self.process(connection, source, target, args)
+        
+        version = self.ircbot.commands.version
+        if self._cache is None:
+            self._cache = LRUCache(self.cache_size)
+        if self._cache_version != version:
+            self._cache.clear()
+            self._cache_version = version
+        
+        key = self.cache_key(connection, source, target, args)
+        now = time.time()
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > now:
+            self.cache_hits += 1
+            return entry[1]
+        
+        self.cache_misses += 1
         result = self.process(connection, source, target, args)
+        self._cache.put(key, (now + self.cache_ttl, result))
+        return result
+    
+    def _process(self, connection, source, target, args):
+        result = self._cached_process(connection, source, target, args)
         if not result:
             return
         
@@ -68,13 +120,17 @@ class CommandPlugin(Plugin):
         else:
             if isinstance(message, basestring):
                 message = (message,)
+            # The first line answers the user, the rest can wait behind other
+            # people's answers.
+            priority = INTERACTIVE
             for line in message:
                 try:
-                    action(connection, target, line)
+                    action(connection, target, line, priority)
                 except IRCError as e:
                     log.error(e)
                 except Exception as e:
                     log.error('Unexpected exception occurred: %s' % e)
+                priority = BULK
     
     def process(self, connection, source, target, args):
         raise NotImplementedError
@@ -92,7 +148,16 @@ class CommandPlugin(Plugin):
                 }
 
 class EventPlugin(Plugin):
-    """Abstract Plugin to be used for events."""
+    """Abstract Plugin to be used for events. Plugins run on the bot's worker
+    pool, at most max_concurrency at a time with up to queue_size events
+    waiting, and overflow decides whether a full queue drops its oldest event
+    or rejects the new one. Plugins that are trivially fast can be inline,
+    running right on the main loop instead."""
+    inline = False
+    max_concurrency = 1
+    queue_size = 100
+    overflow = DROP_OLDEST
+    
     def process(self, connection, source='', target='', args=None, message=''):
         raise NotImplementedError
     
@@ -100,6 +165,15 @@ class EventPlugin(Plugin):
 class IRCBot(Client):
     """Functional implementation of Client, which serves as an IRC bot as
     opposed to a fully function client."""
+    # Default command rate limits, per user@host, channel and plugin: rate is
+    # in commands per second and burst is how many may come at once.
+    COMMAND_LIMITS = {
+        'user': {'rate': 0.5, 'burst': 5},
+        'channel': {'rate': 2, 'burst': 10},
+        'plugin': None
+    }
+    LIMIT_NOTICE = u'You are sending commands too fast, slow down.'
+    
     def __init__(self, settings):
         self.settings = settings
         
@@ -113,17 +187,33 @@ class IRCBot(Client):
         
         self._register_loggers()
         
-        self.pid_path = os.path.join(self.data_path, settings['pid_filename'])
+        pid_filename = settings['pid_filename']
+        self.shard = settings.get('shard')
+        if self.shard is not None:
+            name, ext = os.path.splitext(pid_filename)
+            pid_filename = '%s.%d%s' % (name, self.shard, ext)
+        self.pid_path = os.path.join(self.data_path, pid_filename)
         self._save_pid(self.pid_path)
         
         self.admins = {}
+        self._admin_keys = {} # server -> (CaseMapping, set of admin keys)
         self.initial_channels = {}
         
         servers = []
         for server in settings['servers']:
+            # ssl is either a boolean or a dict of options for the SSLContext
+            ssl_options = server['ssl']
+            if isinstance(ssl_options, dict):
+                use_ssl = True
+            else:
+                use_ssl, ssl_options = bool(ssl_options), None
             irc_server = Server(server['host'], server['port'], server['nick'],
                                 owner=server['owner'], name=server['name'],
-                                use_ssl=server['ssl'])
+                                use_ssl=use_ssl, ssl_options=ssl_options,
+                                flood=server.get('flood'),
+                                recv_size=server.get('recv_size', 16384),
+                                reconnect=server.get('reconnect'),
+                                encodings=server.get('encodings'))
             servers.append(irc_server)
             self.admins[irc_server] = server['admins']
             self.initial_channels[irc_server] = server['channels']
@@ -151,18 +241,69 @@ class IRCBot(Client):
             
             event_plugins[name] = plugins
                 
-        super(IRCBot, self).__init__(servers, event_plugins)
+        poller = settings.get('poller')
+        if poller is not None:
+            poller = get_poller(poller)
         
-        self.command_plugins = {}
+        workers = WorkerPool(settings.get('plugin_workers', 4), name='plugin')
         
-        self.command_prefix = settings['command_prefix']
+        super(IRCBot, self).__init__(servers, event_plugins, poller, workers)
+        
+        self.shard_channel = None
+        if self.shard is not None:
+            self.shard_channel = ShardChannel.from_environment()
+            self.connection_manager.add_reader(self.shard_channel.socket,
+                                               self._on_shard_message)
+        
+        self.commands = CommandRegistry()
+        
+        # Commands for the same channel or user run one at a time and in
+        # order, each channel or user getting a lane of its own.
+        command_pool = settings.get('command_pool') or {}
+        self.command_workers = WorkerPool(command_pool.get('workers', 8),
+                                          name='command')
+        overflow = command_pool.get('overflow', DROP_OLDEST)
+        if overflow not in (DROP_OLDEST, REJECT):
+            raise ValueError(u'Unknown command_pool overflow "%s".' % overflow)
+        self.command_lane_limits = {
+            'queue_size': command_pool.get('queue_size', 10),
+            'overflow': overflow,
+            'group': 'commands',
+            'transient': True
+        }
+        
+        limits = settings.get('command_limits') or {}
+        self.command_limits = {} # 'user', 'channel' or 'plugin' -> buckets
+        for kind, default in self.COMMAND_LIMITS.iteritems():
+            limit = limits.get(kind, default)
+            if limit:
+                self.command_limits[kind] = KeyedBuckets(limit['rate'],
+                                                         limit.get('burst'))
+        # At most one notice a minute to a user who is being limited.
+        self.limit_notices = None
+        if not limits.get('silent', False):
+            self.limit_notices = KeyedBuckets(1 / 60.0, 1)
+        
+        # One prefix or a list of them. The longest are tried first, so that
+        # '!!' is not taken for '!' followed by a command starting with '!'.
+        prefixes = settings['command_prefix']
+        if isinstance(prefixes, basestring):
+            prefixes = [prefixes]
+        self.command_prefix = prefixes[0]
+        self.command_prefixes = tuple(sorted(prefixes, key=len, reverse=True))
         self.version = settings['version_string']
         
         self._restart = False
     
     def _register_loggers(self):
         root_logger = logging.getLogger('')
-        root_logger.setLevel(logging.DEBUG)
+        # Nothing below INFO reaches a handler without debug, so the root
+        # level says so too. Connection.process relies on it to skip logging
+        # every received line.
+        if self.settings['debug']:
+            root_logger.setLevel(logging.DEBUG)
+        else:
+            root_logger.setLevel(logging.INFO)
         
         fh = logging.FileHandler(os.path.join(self.data_path,
                                               self.settings['log_filename']),
@@ -192,7 +333,7 @@ class IRCBot(Client):
     def _register_command_plugins(self):
         items = self.settings['command_plugins'].iteritems()
         for msg_type, command_plugins in items:
-            self.command_plugins[msg_type] = plugins = {}
+            scope = CommandRegistry.SCOPES[msg_type]
             
             if command_plugins is None:
                 continue
@@ -207,35 +348,79 @@ class IRCBot(Client):
                 for part in split_path:
                     module = getattr(module, part)
                 
-                commands = tuple(command_plugin['commands'])
-                plugins[commands] = getattr(module, plugin_name)(self)
+                commands = command_plugin['commands']
+                plugin = getattr(module, plugin_name)(self)
+                if not self.commands.register(commands, plugin, scope):
+                    log.error(u'Plugin "%s" wants a command that is already '
+                              u'taken.' % plugin_name)
+                    continue
                 
                 log.debug('Loaded plugin "%s"!' % plugin_name)
     
     def start(self):
         super(IRCBot, self).start()
+        self.command_workers.join(self.JOIN_TIMEOUT)
         return self._restart
     
+    def exit(self, message=u'Bye!'):
+        super(IRCBot, self).exit(message)
+        self.command_workers.stop()
+    
     def restart(self):
-        self._restart = True
-        self.exit(message=u'Restarting!')
+        """Restarts the bot, and every other shard with it."""
+        if not self._broadcast('reboot'):
+            self._restart = True
+            self.exit(message=u'Restarting!')
+    
+    def shutdown(self):
+        """Exits the bot for good, and every other shard with it."""
+        if not self._broadcast('exit'):
+            self.exit()
+    
+    def connect_server(self, name):
+        """Connects to the server with the given name, in whichever shard it
+        belongs to."""
+        server = self.get_server_by_name(name)
+        if server is not None:
+            self._connect(server)
+        else:
+            self._broadcast('connect', name)
+    
+    def _broadcast(self, command, *args):
+        """Sends a command to every shard, this one included. Returns False if
+        the bot is not sharded."""
+        if self.shard_channel is None:
+            return False
+        return self.shard_channel.send(command, *args)
+    
+    def _on_shard_message(self):
+        messages = self.shard_channel.receive()
+        if messages is None:
+            log.error(u'Lost the connection to the supervisor.')
+            self.connection_manager.remove_reader(self.shard_channel.socket)
+            return
+        for message in messages:
+            command, args = message[0], message[1:]
+            if command == 'reboot':
+                self._restart = True
+                self.exit(message=u'Restarting!')
+            elif command == 'exit':
+                self.exit()
+            elif command == 'connect':
+                server = self.get_server_by_name(u' '.join(args))
+                if server is not None:
+                    self._connect(server)
     
     def register_command_plugin(self, command, plugin):
-        both = self.command_plugins['BOTH']
-        for commands in both.iterkeys():
-            if command in commands:
-                return False
-        self.command_plugins['BOTH'][(command,)] = plugin(self)
-        return True
+        """Registers a command plugin class under a command, in both public
+        and private messages. Returns False if the command is taken."""
+        return self.commands.register((command,), plugin(self))
     
     def unregister_command_plugin(self, command):
-        commands = (command,)
-        both = self.command_plugins['BOTH']
-        for cmds in both.iterkeys():
-            if cmds == commands:
-                del both[cmds]
-                return True
-        return False
+        """Unregisters the plugin of a command that answers in both public
+        and private messages, as register_command_plugin registers them,
+        along with its aliases. Returns False if there is none."""
+        return self.commands.unregister(command, CommandRegistry.BOTH)
     
     def on_connect(self, connection):
         pass
@@ -250,40 +435,116 @@ class IRCBot(Client):
     
     def is_admin(self, server, nick):
         """Returns whether a given nick is one of the administrators of the
-        bot."""
-        return nick in self.admins[server]
+        bot. Nicks are compared with the server's casemapping."""
+        casemapping = server.isupport.casemapping
+        cached = self._admin_keys.get(server)
+        if cached is None or cached[0] is not casemapping:
+            cached = (casemapping, set(casemapping.lower(admin)
+                                       for admin in self.admins[server]))
+            self._admin_keys[server] = cached
+        return casemapping.lower(nick) in cached[1]
     
     def get_version(self):
         """Returns the version of the bot."""
         return self.version
     
+    def strip_command_prefix(self, connection, message):
+        """Returns what follows the command prefix of a message, or follows
+        the bot's nick when the message is addressed to it, as in
+        'brobot: help' or 'brobot, help'. Returns None if the message is not a
+        command. Cheap enough to run on every message."""
+        if message.startswith(self.command_prefixes):
+            for prefix in self.command_prefixes:
+                if message.startswith(prefix):
+                    return message[len(prefix):]
+        server = connection.server
+        nick = server.actual_nick
+        if nick and message[len(nick):len(nick) + 1] in (u':', u',') and \
+                server.lower(message[:len(nick)]) == server.lower(nick):
+            return message[len(nick) + 1:].lstrip()
+        return None
+    
+    def find_command(self, connection, message, is_pubmsg):
+        """Returns (plugin, args) for a message that is a command the bot has
+        a plugin for, or None."""
+        if not message:
+            return None
+        rest = self.strip_command_prefix(connection, message)
+        if rest is None:
+            return None
+        
+        if rest[:1] == u' ':
+            command = u' '
+            args = rest[1:].strip().split(u' ')
+        else:
+            tokens = rest.strip().split(u' ')
+            command, args = tokens[0], tokens[1:]
+        
+        if is_pubmsg:
+            scope = CommandRegistry.PUBLIC
+        else:
+            scope = CommandRegistry.PRIVATE
+        
+        plugin = self.commands.find(command, scope)
+        if plugin is None:
+            return None
+        return plugin, args
+    
     def process_message(self, connection, source, target, message, is_pubmsg):
         """Processes a message, determining whether it is a bot command, and
         taking action if it is."""
-        if message and message[0] == self.command_prefix:
-            if message[1:2] == u' ':
-                command = u' '
-                args = message[2:].strip().split(u' ')
-            else:
-                tokens = message[1:].strip().split(u' ')
-                command, args = tokens[0], tokens[1:]
-            
-            both = self.command_plugins['BOTH'].iteritems()
-            if is_pubmsg:
-                either = self.command_plugins['PUBMSG'].iteritems()
-            else:
-                either = self.command_plugins['PRIVMSG'].iteritems()
-            
-            for commands, plugin in itertools.chain(both, either):
-                if command in commands:
-                    plugin._process(connection, source, target, args)
-                    break
+        found = self.find_command(connection, message, is_pubmsg)
+        if found is not None:
+            plugin, args = found
+            plugin._process(connection, source, target, args)
     
     def _on_msg(self, connection, source, target, message, is_pubmsg):
-        process = Thread(target=self.process_message,
-                            args=(connection, source, target, message,
-                                  is_pubmsg))
-        process.start()
+        """Finds out right away whether a message is a command, and if it is,
+        queues it for the command workers, in order with the other commands
+        from the same channel or user. Anything else is dropped here."""
+        found = self.find_command(connection, message, is_pubmsg)
+        if found is None:
+            return
+        plugin, args = found
+        if not self._allow_command(connection, source, target, plugin,
+                                   is_pubmsg):
+            return
+        lane = (connection.server.name, connection.server.lower(target))
+        if not self.command_workers.submit_to(lane, self.command_lane_limits,
+                                              plugin._process, connection,
+                                              source, target, args):
+            log.warning('Shed a message to %s, the queue is full.' % target)
+    
+    def command_cache_stats(self):
+        """Returns the cache stats of every command plugin that caches, by
+        plugin name."""
+        return dict((plugin.name, plugin.cache_stats())
+                    for plugin in self.commands.plugins()
+                    if plugin.cache_ttl is not None)
+    
+    def _allow_command(self, connection, source, target, plugin, is_pubmsg):
+        """Checks a command against the rate limits of its user, channel and
+        plugin, and spends a token from each if all of them allow it."""
+        server = connection.server.name
+        user = (server, source.username, source.host)
+        keys = [('user', user), ('plugin', plugin)]
+        if is_pubmsg:
+            keys.append(('channel', (server, connection.server.lower(target))))
+        
+        now = time.time()
+        limited = [(self.command_limits[kind], key) for kind, key in keys
+                   if kind in self.command_limits]
+        for buckets, key in limited:
+            if not buckets.allows(key, 1, now):
+                log.debug(u'Rate limited a command from %s.' % source)
+                if self.limit_notices is not None and \
+                        self.limit_notices.consume(user, 1, now):
+                    self.notice(connection, source.nick, self.LIMIT_NOTICE,
+                                BULK)
+                return False
+        for buckets, key in limited:
+            buckets.spend(key, 1, now)
+        return True
     
     def on_privmsg(self, connection, source, target, message):
         self._on_msg(connection, source, source.nick, message, False)
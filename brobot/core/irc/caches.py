@@ -0,0 +1,112 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Small bounded caches for values that are expensive to compute and asked for
+over and over, such as the parsed form of the hostmasks of the users who do
+most of the talking.
+"""
+
+from threading import Lock
+
+# Positions in a link of the circular doubly linked list kept by LRUCache.
+PREV, NEXT, KEY, VALUE, USED = 0, 1, 2, 3, 4
+
+class LRUCache(object):
+    """A cache of at most maxsize entries, which evicts an entry that has not
+    been used recently when it is full. The entries are kept in a dict of
+    links in a circular doubly linked list, oldest first. A hit only marks its
+    link as used, so that it takes no lock and does not touch the list. When
+    an entry has to go, the oldest links that were used since they were last
+    looked at get a second chance at the end of the list, and the first one
+    that was not is evicted. Counts hits and misses."""
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._links = {} # key -> [prev, next, key, value, used]
+        self._root = root = []
+        root[:] = [root, root, None, None, False]
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def get(self, key, default=None):
+        """Returns the value cached for key, marking it as used, or default if
+        there is none."""
+        link = self._links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        link[USED] = True
+        return link[VALUE]
+
+    def put(self, key, value):
+        """Caches value under key, evicting an entry if the cache is full."""
+        with self._lock:
+            links = self._links
+            link = links.get(key)
+            if link is not None:
+                link[VALUE] = value
+                link[USED] = True
+                return
+            root = self._root
+            if len(links) >= self.maxsize:
+                self._evict(links, root)
+            last = root[PREV]
+            link = [last, root, key, value, False]
+            last[NEXT] = root[PREV] = link
+            links[key] = link
+
+    def _evict(self, links, root):
+        while links:
+            oldest = root[NEXT]
+            oldest[PREV][NEXT] = oldest[NEXT]
+            oldest[NEXT][PREV] = oldest[PREV]
+            if not oldest[USED]:
+                del links[oldest[KEY]]
+                return
+            oldest[USED] = False
+            last = root[PREV]
+            oldest[PREV] = last
+            oldest[NEXT] = root
+            last[NEXT] = root[PREV] = oldest
+
+    def clear(self):
+        with self._lock:
+            self._links.clear()
+            root = self._root
+            root[:] = [root, root, None, None, False]
+
+    def stats(self):
+        """Returns a dict with the size of the cache and how often it has been
+        hit."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._links),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / float(lookups) if lookups else 0.0
+        }
+
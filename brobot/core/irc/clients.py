@@ -23,53 +23,115 @@ using this library would write.
 """
 
 from events import Events, EventManager, EventHook
-from connections import ConnectionManager, Connection, IRCError
+from connections import ConnectionManager, Connection, Connector, IRCError
 from structures import Channel, Server, User, Mode
+from workers import WorkerPool, DROP_OLDEST
 from datetime import datetime
-from threading import Lock, Thread, Timer
+from threading import Lock
+import inspect
 import logging
+import random
 import time
 
 log = logging.getLogger(__name__)
 
+def _mode_args(args, message):
+    """Returns the arguments of a mode line. Servers may send the last one as
+    the trailing message, as in 'MODE #channel :+i'."""
+    args = list(args) if args else []
+    if message:
+        args.append(message)
+    return args
+
 class PluginEventManager(EventManager):
     """An extension of EventManager that allows for plugins to hook into IRC
-    events."""
-    def __init__(self, event_hooks, event_plugins):
+    events. Plugin hooks come after the regular event hooks, and run on a
+    WorkerPool unless the plugin is marked inline, so that a slow plugin does
+    not hold up the main loop."""
+    def __init__(self, event_hooks, event_plugins, workers=None):
         super(PluginEventManager, self).__init__(event_hooks)
-        self.event_plugins = event_plugins
-    
-    def hook(self, event, connection, kwargs=None):
-        """Still performs the regular event hooks, and afterward, the plugin
-        hooks."""
-        super(PluginEventManager, self).hook(event, connection, kwargs)
-        if event in self.event_plugins:
-            for plugin in self.event_plugins[event]:
-                plugin.process(connection, **kwargs)
+        if workers is None:
+            workers = WorkerPool(name='plugin')
+        self.workers = workers
+        self.event_plugins = {} # event -> list of (plugin, EventHook)
+        for event, plugins in event_plugins.iteritems():
+            for plugin in plugins:
+                self.add_plugin(event, plugin)
+    
+    def plugin_hook(self, plugin):
+        """Returns an EventHook that calls the process method of a plugin with
+        the keyword arguments its signature accepts. Unless the plugin is
+        inline, the call is queued on the WorkerPool, on the lane of the
+        plugin's class, limited by its max_concurrency, queue_size and overflow
+        attributes."""
+        spec = inspect.getargspec(plugin.process)
+        accepted = dict((arg, spec.keywords is not None or arg in spec.args)
+                        for arg in EventManager.EVENT_ARGS)
+        if getattr(plugin, 'inline', False):
+            return EventHook(plugin.process, keywords=True, **accepted)
+        
+        # Keyed by class, since plugins that do not set a name all share
+        # the default one.
+        workers = self.workers
+        plugin_class = type(plugin)
+        lane = workers.lane('%s.%s' % (plugin_class.__module__,
+                                       plugin_class.__name__),
+                            max_concurrency=getattr(plugin, 'max_concurrency', 1),
+                            queue_size=getattr(plugin, 'queue_size', 100),
+                            overflow=getattr(plugin, 'overflow', DROP_OLDEST))
+        def process(connection, **kwargs):
+            if not workers.submit(lane, plugin.process, connection, **kwargs):
+                log.debug(u'Lane %s rejected an event.' % lane.name)
+        return EventHook(process, keywords=True, **accepted)
+    
+    def add_plugin(self, event, plugin):
+        event_hook = self.plugin_hook(plugin)
+        self.event_plugins.setdefault(event, []).append((plugin, event_hook))
+        self.add_hook(event, event_hook)
+    
+    def remove_plugin(self, event, plugin):
+        """Stops calling a plugin for an event, and fails silently if it was
+        not hooked into it."""
+        plugins = self.event_plugins.get(event, [])
+        for entry in list(plugins):
+            if entry[0] is plugin:
+                plugins.remove(entry)
+                self.remove_hook(event, entry[1])
     
 class Client(object):
     """The base IRC Client, which wraps a ConnectionManager and provides an
     interface to low level connection functions. It can be extended to make a
     full IRC client or an IRC bot."""
-    def __init__(self, servers, event_plugins=None):
-        self.channels = []
+    JOIN_TIMEOUT = 5 # seconds to wait for each plugin worker on exit
+    RECONNECT_DEFAULTS = {
+        'timeout': 20, # seconds for a whole connection attempt
+        'initial_delay': 2, # seconds before the first retry
+        'max_delay': 300,
+        'max_retries': None # retry forever
+    }
+    
+    def __init__(self, servers, event_plugins=None, poller=None, workers=None):
+        self._channels = {} # server -> channel name -> Channel
         self._servers = servers
         if event_plugins is None:
             event_plugins = {}
         self.connection_manager = ConnectionManager(PluginEventManager({
             Events.CONNECT: EventHook(self._on_connect),
+            Events.DISCONNECT: EventHook(self._on_disconnect),
             Events.RPL_WELCOME: EventHook(self._on_welcome, source=True,
                                           target=True, message=True),
             Events.PING: EventHook(self._on_ping, message=True),
             Events.PONG: EventHook(self._on_pong, message=True),
             Events.MODE: EventHook(self._on_mode, source=True, target=True,
-                                   args=True),
+                                   args=True, message=True),
             Events.UMODE: EventHook(self._on_umode, source=True, target=True,
                                     message=True),
             Events.JOIN: EventHook(self._on_join, source=True, message=True),
             Events.PART: EventHook(self._on_part, source=True, target=True,
                                    message=True),
             Events.QUIT: EventHook(self._on_quit, source=True, message=True),
+            Events.NICK: EventHook(self._on_nick, source=True, target=True,
+                                   message=True),
             Events.RPL_NAMEREPLY: EventHook(self._on_name_reply, source=True,
                                             target=True, args=True,
                                             message=True),
@@ -79,11 +141,15 @@ class Client(object):
                                      message=True),
             Events.RPL_CHANNELMODEIS: EventHook(self._on_channel_mode,
                                                 source=True, target=True,
-                                                args=True),
+                                                args=True, message=True),
+            Events.RPL_BOUNCE: EventHook(self._on_isupport, args=True),
             Events.ERR_NICKNAMEINUSE: EventHook(self.on_nickname_in_use),
             Events.ERROR: EventHook(self._on_error, message=True)
-        }, event_plugins))
-        self.ping_timers = {}
+        }, event_plugins, workers), poller)
+        self.ping_timers = {} # connection -> ScheduledCall
+        self._connecting = {} # server -> Connector or retry ScheduledCall
+        self._connect_failures = {} # server -> failed attempts in a row
+        self._exited = False
     
     def start(self):
         """Starts the Client by first connecting to all given servers and then
@@ -91,7 +157,9 @@ class Client(object):
         for server in self._servers:
             self._connect(server)
         while not self.connection_manager.running:
-            time.sleep(3)
+            if self._exited:
+                return
+            self.connection_manager.process()
         try:
             self.on_initial_connect()
         except NotImplementedError:
@@ -101,54 +169,93 @@ class Client(object):
         
         while self.connection_manager.running:
             self.connection_manager.process()
-    
-    def __connect(self, server):
-        connection = Connection(server)
-        connected = connection.connect()
-        if connected:
-            self.connection_manager.register(connection)
         
-        return connected
+        self.connection_manager.event_manager.workers.join(self.JOIN_TIMEOUT)
     
-    def _try_connect(self, server):
-        while True:
-            if self.__connect(server):
-                return
-            time.sleep(10)
+    def _reconnect_settings(self, server):
+        settings = dict(self.RECONNECT_DEFAULTS)
+        if server.reconnect:
+            settings.update(server.reconnect)
+        return settings
     
     def _connect(self, server):
-        """Performs a connection to the server by creating a Connection object,
-        connecting it, and then registering the new Connection with the
-        ConnectionManager."""
+        """Performs a connection to the server from the main loop, without
+        blocking it. The new Connection is registered with the
+        ConnectionManager once it is connected, and failed attempts are
+        retried with exponential backoff."""
+        pending = self._connecting.get(server)
+        if isinstance(pending, Connector):
+            return
+        if pending is not None:
+            # A retry was scheduled, but somebody wants to connect right now.
+            pending.cancel()
+        self._reset_server(server)
+        timeout = self._reconnect_settings(server)['timeout']
+        self._connecting[server] = self.connection_manager.connect(
+            server, self._on_connect_attempt, timeout)
+    
+    def _reset_server(self, server):
+        """Forgets everything learned on the last connection to a server. Its
+        Channels go too, since their users are in the old UserRegistry."""
         server.reset()
-        t = Thread(target=self._try_connect, args=(server,))
-        t.start()
+        self._channels.pop(server, None)
+    
+    def _on_connect_attempt(self, connector, connection):
+        server = connector.server
+        if self._connecting.get(server) is connector:
+            del self._connecting[server]
+        if connection is not None:
+            self.connection_manager.register(connection)
+        else:
+            self._retry(server)
+    
+    def _retry(self, server):
+        """Schedules the next attempt to connect to a server, unless it has
+        already failed too many times in a row."""
+        settings = self._reconnect_settings(server)
+        failures = self._connect_failures.get(server, 0) + 1
+        self._connect_failures[server] = failures
+        max_retries = settings['max_retries']
+        if max_retries is not None and failures > max_retries:
+            log.error(u'Giving up on %s after %d attempts.' % (server.host,
+                                                               failures))
+            return
+        
+        # Exponential backoff with jitter, so that a fleet of bots does not
+        # come back in lockstep when a network recovers.
+        delay = min(settings['max_delay'],
+                    settings['initial_delay'] * 2 ** (failures - 1))
+        delay = random.uniform(delay / 2.0, delay)
+        log.info(u'Retrying %s in %.1f seconds.' % (server.host, delay))
+        self._connecting[server] = self.connection_manager.call_later(
+            delay, self._connect, server)
     
     def _ping_disconnect(self, connection):
-        self.quit(connection)
-        if connection.socket in self.ping_timers:
-            del self.ping_timers[connection.socket]
+        # The server stopped answering, so nothing waits on its socket.
+        self.connection_manager.disconnect(connection, deadline=0)
+        self.ping_timers.pop(connection, None)
         self._connect(connection.server)
     
     def _connection_test(self):
-        while self.connection_manager.running:
-            connections = self.connection_manager.connections
-            for sock, connection in connections.items():
-                if not connection.welcomed or sock in self.ping_timers:
-                    continue
-                message = connection.server.host
-                try:
-                    self.ping(connection, message=message)
-                except IRCError:
-                    continue
-                t = Timer(60, self._ping_disconnect, args=(connection,))
-                self.ping_timers[sock] = t
-                t.start()
-            time.sleep(10)
+        """Pings every welcomed connection that is not already waiting on a
+        PONG, and schedules itself again on the main loop."""
+        if not self.connection_manager.running:
+            return
+        connections = self.connection_manager.connections
+        for connection in connections.values():
+            if not connection.welcomed or connection in self.ping_timers:
+                continue
+            message = connection.server.host
+            try:
+                self.ping(connection, message=message)
+            except IRCError:
+                continue
+            self.ping_timers[connection] = self.connection_manager.call_later(
+                60, self._ping_disconnect, connection)
+        self.connection_manager.call_later(10, self._connection_test)
     
     def _start_connection_test(self):
-        t = Thread(target=self._connection_test)
-        t.start()
+        self._connection_test()
     
     def on_initial_connect(self):
         """Function performed after all servers have been connected."""
@@ -157,7 +264,9 @@ class Client(object):
     def exit(self, message=u'Bye!'):
         """Disconnects from every connection in the ConnectionManager with the
         given QUIT message."""
+        self._exited = True
         self.connection_manager.exit(message)
+        self.connection_manager.event_manager.workers.stop()
     
     def get_server_by_name(self, name):
         for server in self._servers:
@@ -165,28 +274,39 @@ class Client(object):
                 return server
         return None
     
+    @property
+    def channels(self):
+        """Every Channel the client is in, on every server."""
+        return [channel for channels in self._channels.values()
+                for channel in channels.values()]
+    
+    def _channel_key(self, server, name):
+        return server.lower(name)
+    
     def get_server_channels(self, server):
-        for channel in self.channels:
-            if channel.server == server:
-                yield channel
+        return self._channels.get(server, {}).values()
+    
+    def add_channel(self, channel):
+        """Adds a Channel to the index, replacing any older Channel of the same
+        name on the same server."""
+        channels = self._channels.setdefault(channel.server, {})
+        channels[channel.key] = channel
     
     def find_channel(self, server, name):
         """Searches for a Channel based on the server and the name. Returns
         None if the Channel is not found."""
-        search_channel = Channel(server, name)
-        for channel in self.channels:
-            if search_channel == channel:
-                return channel
-        return None
+        return self._channels.get(server, {}).get(self._channel_key(server,
+                                                                    name))
     
     def remove_channel(self, server, name):
         """Tries to remove a Channel based on the server and the name, and fails
         silently."""
-        channel = Channel(server, name)
-        try:
-            self.channels.remove(channel)
-        except ValueError:
+        channels = self._channels.get(server, {})
+        channel = channels.pop(self._channel_key(server, name), None)
+        if channel is None:
             log.debug(u"Channel `%s' not in channels." % name)
+        else:
+            channel.clear_users()
     
     def find_connection(self, server):
         """Searches for a Connection based on the server and compares only the
@@ -213,13 +333,14 @@ class Client(object):
             mode_message += ' %s' % mode
         connection.send(mode_message)
     
-    def privmsg(self, connection, target, message):
-        """Sends a PRIVMSG to a target in the given connection."""
-        connection.send('PRIVMSG %s :%s' % (target, message))
+    def privmsg(self, connection, target, message, priority=None):
+        """Sends a PRIVMSG to a target in the given connection. Long or
+        unsolicited output should use the BULK priority."""
+        connection.send('PRIVMSG %s :%s' % (target, message), priority)
     
-    def notice(self, connection, target, message):
+    def notice(self, connection, target, message, priority=None):
         """Sends a NOTICE to a target in the given connection."""
-        connection.send('NOTICE %s :%s' % (target, message))
+        connection.send('NOTICE %s :%s' % (target, message), priority)
     
     def ctcp_reply(self, connection, target, command, reply):
         """Sends a CTCP reply to a target in a given connection."""
@@ -265,11 +386,29 @@ class Client(object):
         except NotImplementedError:
             pass
     
+    def _on_disconnect(self, connection):
+        """Reconnects, with the usual backoff, to a server that closed or
+        reset the connection."""
+        timer = self.ping_timers.pop(connection, None)
+        if timer is not None:
+            timer.cancel()
+        server = connection.server
+        if self._exited or server in self._connecting:
+            return
+        log.info(u'Lost the connection to %s.' % server.host)
+        self._retry(server)
+    
     def on_welcome(self, connection, source, target, message):
         raise NotImplementedError
     
     def _on_welcome(self, connection, source, target, message):
         connection.server.actual_nick = target
+        self._connect_failures.pop(connection.server, None)
+        if connection.connect_started is not None:
+            connection.server.welcome_delay = time.time() - \
+                    connection.connect_started
+            log.info(u'Welcomed by %s %.3f seconds after connecting.' %
+                     (connection.server.host, connection.server.welcome_delay))
         try:
             self.on_welcome(connection, source, target, message)
         except NotImplementedError:
@@ -280,39 +419,56 @@ class Client(object):
     def on_nickname_in_use(self, connection):
         self._on_connect(connection, nick=connection.server.nick + '_')
     
+    def _is_me(self, server, user):
+        return user.key == server.lower(server.actual_nick)
+    
     def _on_join(self, connection, source, message):
-        if source.nick == connection.server.actual_nick:
+        if self._is_me(connection.server, source):
             channel = Channel(connection.server, message)
-            self.channels.append(channel)
+            self.add_channel(channel)
             self.mode(connection, channel)
         else:
             channel = self.find_channel(connection.server, message)
             if channel is not None:
-                channel.add_user(User(source.nick, '', '', User.NORMAL))
+                channel.add_user(source)
     
     def _on_name_reply(self, connection, source, target, args, message):
         channel_name = args[-1]
         channel = self.find_channel(connection.server, channel_name)
         if channel is not None:
+            isupport = connection.server.isupport
+            casemapping, statuses = isupport.casemapping, isupport.statuses
             for user in message.split():
-                channel.add_user(User.parse_user(user))
+                channel.add_user(User.parse_user(user, casemapping, statuses))
     
     def _on_part(self, connection, source, target, message):
-        if source.nick == connection.server.actual_nick:
+        if self._is_me(connection.server, source):
             self.remove_channel(connection.server, target)
         else:
             channel = self.find_channel(connection.server, target)
             if channel is not None:
-                channel.remove_user(User(source.nick, '', '', User.NORMAL))
+                channel.remove_user(source)
     
     def _on_quit(self, connection, source, message):
-        user = User.channel_user(source.nick)
-        for channel in self.get_server_channels(connection.server):
-            channel.remove_user(user)
-        if user.nick == connection.server.nick:
+        server = connection.server
+        for channel in server.users.channels(source.key):
+            channel.remove_user(source)
+        if source.key == server.lower(server.nick):
             # TODO: Change nick to connection.server.nick
             pass
     
+    def _on_nick(self, connection, source, target, message):
+        # Some servers send the new nick as a parameter instead of a trailing
+        # message.
+        new_nick = message or target
+        if not new_nick:
+            return
+        server = connection.server
+        if self._is_me(server, source):
+            server.actual_nick = new_nick
+        for channel in server.users.rename(source.key, server.lower(new_nick)):
+            channel.rename_user(source.nick, new_nick)
+    
     def on_privmsg(self, connection, source, target, message):
         raise NotImplementedError
     
@@ -334,11 +490,18 @@ class Client(object):
         except NotImplementedError:
             pass
     
-    def _on_channel_mode(self, connection, source, target, args):
+    def _on_isupport(self, connection, args):
+        connection.server.isupport.update(args)
+    
+    def _on_channel_mode(self, connection, source, target, args, message):
+        args = _mode_args(args, message)
+        if len(args) < 2:
+            return
         (name, modes), mode_args = args[:2], args[2:]
         channel = self.find_channel(connection.server, name)
         if channel is not None:
-            channel_modes = Mode.parse_modes(modes, mode_args)
+            channel_modes = Mode.parse_modes(modes, mode_args,
+                                             connection.server.isupport)
             for mode in channel_modes:
                 if mode.on:
                     channel.add_mode(mode)
@@ -371,18 +534,24 @@ class Client(object):
         if reply:
             self.ctcp_reply(connection, source.nick, command, reply)
     
-    def _on_mode(self, connection, source, target, args):
+    def _on_mode(self, connection, source, target, args, message):
         channel = self.find_channel(connection.server, target)
-        if channel is not None:
+        args = _mode_args(args, message)
+        if channel is not None and args:
+            isupport = connection.server.isupport
             modes, mode_args = args[0], args[1:]
-            channel_modes = Mode.parse_modes(modes, mode_args)
+            channel_modes = Mode.parse_modes(modes, mode_args, isupport)
             for mode in channel_modes:
-                user = channel.find_user(mode.param)
-                if user is not None:
-                    if mode.on:
-                        user.add_mode(mode)
-                    else:
-                        user.remove_mode(mode)
+                if mode.character in isupport.prefixes:
+                    user = channel.find_user(mode.param)
+                    if user is not None:
+                        if mode.on:
+                            user.add_mode(mode, isupport.mode_statuses)
+                        else:
+                            user.remove_mode(mode, isupport.mode_statuses)
+                elif isupport.chanmodes.get(mode.character) == 'A':
+                    # List modes such as bans are not kept.
+                    continue
                 else:
                     if mode.on:
                         channel.add_mode(mode)
@@ -397,9 +566,9 @@ class Client(object):
                                          message))
     
     def _on_pong(self, connection, message):
-        if connection.socket in self.ping_timers:
-            self.ping_timers[connection.socket].cancel()
-            del self.ping_timers[connection.socket]
+        timer = self.ping_timers.pop(connection, None)
+        if timer is not None:
+            timer.cancel()
     
     def _on_error(self, connection, message):
         log.error(message)
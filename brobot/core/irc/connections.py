@@ -16,12 +16,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 #===============================================================================
 
-from events import Events
+from events import Events, IRCError
 from structures import User
-from time import sleep
-from utils import parse_irc_line
-from threading import Lock
+from time import sleep, time
+from utils import parse_irc_lines
+from pollers import get_poller, READ, WRITE
+from flood import OutputQueue, DEFAULT_LIMITS, would_block
+from workers import WorkerPool, REJECT
+from threading import Lock, current_thread
+from operator import attrgetter
 import socket, select
+import errno
+import heapq
+import itertools
 import logging
 
 log = logging.getLogger(__name__)
@@ -32,17 +39,300 @@ except ImportError:
     log.warning(u'Unable to import ssl module')
     ssl = None
 
-class IRCError(Exception):
-    """The error to use for low level IRC problems."""
-    pass
+def create_ssl_context(options=None):
+    """Creates the SSLContext shared by every connection to a server. Takes
+    the ssl options of a server entry in the settings: verify (defaults to
+    True), ca_certs, certfile, keyfile and ciphers. Returns None on Pythons
+    without SSLContext, where connections fall back to ssl.wrap_socket."""
+    if not hasattr(ssl, 'create_default_context'):
+        return None
+    if options is None:
+        options = {}
+    context = ssl.create_default_context(cafile=options.get('ca_certs'))
+    if not options.get('verify', True):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if options.get('certfile'):
+        context.load_cert_chain(options['certfile'], options.get('keyfile'))
+    if options.get('ciphers'):
+        context.set_ciphers(options['ciphers'])
+    return context
+
+def wrap_ssl_socket(server, sock, do_handshake_on_connect=True):
+    """Wraps a socket with the SSLContext of the server, which is created
+    once and shared by every reconnect. Where the ssl module supports it,
+    the session of the previous connection is offered for resumption so
+    that a reconnect can skip the full handshake."""
+    if server.ssl_context is None:
+        server.ssl_context = create_ssl_context(server.ssl_options)
+        if server.ssl_context is None:
+            return ssl.wrap_socket(sock,
+                do_handshake_on_connect=do_handshake_on_connect)
+    kwargs = {}
+    if server.ssl_session is not None:
+        kwargs['session'] = server.ssl_session
+    return server.ssl_context.wrap_socket(sock, server_hostname=server.host,
+        do_handshake_on_connect=do_handshake_on_connect, **kwargs)
+
+CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK,
+                       getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+def _interleave_families(addresses):
+    """Orders getaddrinfo results so that the address families alternate,
+    starting with the one the resolver preferred."""
+    families = []
+    by_family = {}
+    for address in addresses:
+        family = address[0]
+        if family not in by_family:
+            families.append(family)
+            by_family[family] = []
+        by_family[family].append(address)
+    ordered = []
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+    return ordered
+
+class ScheduledCall(object):
+    """A function call that the ConnectionManager will run from its own loop
+    once the given time has come, unless it is cancelled first."""
+    def __init__(self, when, function, args):
+        self.when = when
+        self.function = function
+        self.args = args
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+    
+    def __call__(self):
+        self.function(*self.args)
+    
+
+class Waker(object):
+    """A socket pair that lets other threads interrupt the main loop while it
+    is waiting in a poll."""
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(0)
+        self.writer.setblocking(0)
+    
+    def wake(self):
+        try:
+            self.writer.send('x')
+        except socket.error:
+            # The pipe is full, so the loop is going to wake up anyway.
+            pass
+    
+    def drain(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+    
+
+class Connector(object):
+    """Opens a connection to a server without ever blocking the main loop.
+    The host is resolved on a worker thread, and every address it resolves to
+    gets its own non-blocking socket. The attempts are started STAGGER
+    seconds apart, alternating between IPv4 and IPv6 (happy eyeballs), or
+    right away when the previous one fails, and the first socket to connect
+    wins. The TLS handshake of ssl servers is then driven by the poller as
+    well. The callback gets the Connector and the new Connection, or None if
+    every attempt failed or the timeout ran out."""
+    STAGGER = 0.25
+    
+    def __init__(self, manager, server, callback, timeout=20):
+        self.manager = manager
+        self.server = server
+        self.callback = callback
+        self.timeout = timeout
+        self.started = None
+        self.done = False
+        self._addresses = []
+        self._attempts = {} # socket -> address
+        self._calls = [] # staggered attempts
+        self._timeout_call = None
+        self._handshaking = None # ssl socket in the middle of its handshake
+    
+    def start(self):
+        self.started = time()
+        self._timeout_call = self.manager.call_later(self.timeout,
+                                                     self._time_out)
+        self.manager.resolve(self.server.host, self.server.port,
+                             self._resolved)
+    
+    def _resolved(self, addresses, error):
+        if self.done:
+            return
+        if error is not None:
+            log.error(u'Unable to resolve %s: %s' % (self.server.host, error))
+            self._finish(None)
+            return
+        self._addresses = _interleave_families(addresses)
+        self._next()
+    
+    def _next(self):
+        """Starts an attempt on the next address that can be tried."""
+        if self.done or self._handshaking is not None:
+            return
+        while self._addresses:
+            family, socktype, proto, _, address = self._addresses.pop(0)
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(0)
+                error = sock.connect_ex(address)
+            except socket.error as error:
+                log.debug(u'Unable to connect to %s: %s' % (address, error))
+                continue
+            if error not in CONNECT_IN_PROGRESS:
+                log.debug(u'Unable to connect to %s: %s' %
+                          (address, errno.errorcode.get(error, error)))
+                sock.close()
+                continue
+            self._attempts[sock] = address
+            self.manager._watch(sock, self)
+            if self._addresses:
+                self._calls.append(self.manager.call_later(self.STAGGER,
+                                                           self._next))
+            return
+        if not self._attempts:
+            log.error(u'Unable to connect to %s. Probably not connected to \
+the internet.' % self.server.host)
+            self._finish(None)
+    
+    def on_ready(self, sock, events):
+        """Called by the ConnectionManager once an attempt has completed, one
+        way or the other, or when the TLS handshake can go on."""
+        if sock is self._handshaking:
+            self._handshake()
+            return
+        address = self._attempts.pop(sock, None)
+        self.manager._unwatch(sock)
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            log.debug(u'Unable to connect to %s: %s' %
+                      (address, errno.errorcode.get(error, error)))
+            sock.close()
+            self._next()
+        elif self.server.use_ssl:
+            self._drop_attempts()
+            self._start_handshake(sock)
+        else:
+            self._finish(sock)
+    
+    def _start_handshake(self, sock):
+        try:
+            sock = wrap_ssl_socket(self.server, sock,
+                                   do_handshake_on_connect=False)
+        except (socket.error, IRCError) as error:
+            log.error(u'Unable to start TLS with %s: %s' %
+                      (self.server.host, error))
+            sock.close()
+            self._finish(None)
+            return
+        self._handshaking = sock
+        self._handshake()
+    
+    def _handshake(self):
+        """Takes the TLS handshake as far as it can go without blocking, and
+        waits for the socket to be ready for the next step."""
+        sock = self._handshaking
+        try:
+            sock.do_handshake()
+        except ssl.SSLError as error:
+            if error.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.manager._watch(sock, self, READ)
+            elif error.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.manager._watch(sock, self, WRITE)
+            else:
+                self._handshake_failed(error)
+        except (socket.error, ValueError) as error:
+            # A certificate that does not match the host raises
+            # ssl.CertificateError, which is a ValueError.
+            self._handshake_failed(error)
+        else:
+            self.manager._unwatch(sock)
+            self._handshaking = None
+            self._finish(sock)
+    
+    def _handshake_failed(self, error):
+        log.error(u'TLS handshake with %s failed: %s' % (self.server.host,
+                                                        error))
+        self._finish(None)
+    
+    def _time_out(self):
+        log.error(u'Connecting to %s timed out after %s seconds.' %
+                  (self.server.host, self.timeout))
+        self._finish(None)
+    
+    def _drop_attempts(self):
+        """Gives up on every attempt that is still in progress."""
+        for call in self._calls:
+            call.cancel()
+        del self._calls[:]
+        for other in self._attempts:
+            self.manager._unwatch(other)
+            other.close()
+        self._attempts.clear()
+    
+    def _finish(self, sock):
+        if self.done:
+            return
+        self.done = True
+        if self._timeout_call is not None:
+            self._timeout_call.cancel()
+        self._drop_attempts()
+        if self._handshaking is not None:
+            self.manager._unwatch(self._handshaking)
+            self._handshaking.close()
+            self._handshaking = None
+        
+        connection = None
+        if sock is not None:
+            try:
+                connection = Connection(self.server, sock)
+            except (socket.error, IRCError) as error:
+                log.error(u'Unable to set up the connection to %s: %s' %
+                          (self.server.host, error))
+                sock.close()
+            else:
+                connection.connect_started = self.started
+        self.callback(self, connection)
+    
 
 class ConnectionManager(object):
     """Manages all connections made."""
-    def __init__(self, event_manager):
+    RESOLVER_WORKERS = 2
+    RESOLVER_LANE = {'max_concurrency': RESOLVER_WORKERS, 'queue_size': 100,
+                     'overflow': REJECT}
+    
+    def __init__(self, event_manager, poller=None):
         self.connections = {} # socket -> connection
         self.connection_locks = {}
+        self._connecting = {} # socket -> Connector
+        self._readers = {} # socket -> callback, for sockets that are not IRC
         self.event_manager = event_manager
+        if poller is None:
+            poller = get_poller()
+        self.poller = poller
         self.queue = []
+        self._timers = [] # heap of (when, sequence, ScheduledCall)
+        self._timer_lock = Lock()
+        self._timer_sequence = itertools.count()
+        self._flushing = set() # connections with output waiting to be written
+        self._writing = set() # sockets waiting to become writable
+        self._flush_lock = Lock()
+        self._flush_delay = None
+        self._loop_thread = None
+        self._waker = None
+        if hasattr(socket, 'socketpair'):
+            self._waker = Waker()
+            self.poller.register(self._waker.reader, READ)
+        self._resolver = WorkerPool(self.RESOLVER_WORKERS, name='resolver')
         self._running = False
     
     @property
@@ -55,71 +345,339 @@ class ConnectionManager(object):
         self._running = True
         self.connections[connection.socket] = connection
         self.connection_locks[connection.socket] = Lock()
+        connection.manager = self
+        self.poller.register(connection.socket, READ)
         self.event_manager.hook(Events.CONNECT, connection)
     
+    def _forget(self, sock):
+        """Drops every trace of a socket whose connection has gone away."""
+        self.poller.unregister(sock)
+        self._writing.discard(sock)
+        self.connections.pop(sock, None)
+        self.connection_locks.pop(sock, None)
+    
+    def _closed(self, sock):
+        """Forgets a connection that was closed by the server or by an error
+        rather than by disconnect, and hooks in the DISCONNECT event so that
+        the client can reconnect."""
+        connection = self.connections.get(sock)
+        self._forget(sock)
+        if connection is not None:
+            self.event_manager.hook(Events.DISCONNECT, connection)
+    
+    def connect(self, server, callback, timeout=20):
+        """Starts connecting to a server from the main loop. The callback is
+        called from the main loop with the Connector and the new Connection,
+        or None if the attempt failed; registering the Connection is up to
+        the callback. Safe to call from any thread."""
+        connector = Connector(self, server, callback, timeout)
+        self.call_later(0, connector.start)
+        return connector
+    
+    def add_reader(self, sock, callback):
+        """Makes the main loop call callback whenever sock is readable. Meant
+        for sockets other than IRC connections."""
+        self._readers[sock] = callback
+        self.poller.register(sock, READ)
+    
+    def remove_reader(self, sock):
+        self._readers.pop(sock, None)
+        self.poller.unregister(sock)
+    
+    def resolve(self, host, port, callback):
+        """Looks up the addresses of a host on a worker thread, since
+        getaddrinfo blocks. The callback is called from the main loop with
+        the addresses and None, or None and the socket error."""
+        if not self._resolver.submit_to('resolve', self.RESOLVER_LANE,
+                                        self._resolve, host, port, callback):
+            self.call_later(0, callback, None,
+                            socket.error(u'Too many hosts being resolved'))
+    
+    def _resolve(self, host, port, callback):
+        try:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.error as error:
+            self.call_later(0, callback, None, error)
+        else:
+            self.call_later(0, callback, addresses, None)
+    
+    def _watch(self, sock, connector, events=WRITE):
+        if sock in self._connecting:
+            self.poller.modify(sock, events)
+        else:
+            self.poller.register(sock, events)
+        self._connecting[sock] = connector
+    
+    def _unwatch(self, sock):
+        self._connecting.pop(sock, None)
+        self.poller.unregister(sock)
+    
+    def call_later(self, delay, function, *args):
+        """Schedules a function to be called from the main loop after delay
+        seconds. Returns a ScheduledCall, which can be cancelled. Safe to call
+        from any thread."""
+        call = ScheduledCall(time() + delay, function, args)
+        with self._timer_lock:
+            heapq.heappush(self._timers,
+                           (call.when, next(self._timer_sequence), call))
+        if self._waker is not None and \
+                current_thread() is not self._loop_thread:
+            self._waker.wake()
+        return call
+    
+    def _run_timers(self):
+        now = time()
+        while True:
+            with self._timer_lock:
+                if not self._timers or self._timers[0][0] > now:
+                    return
+                call = heapq.heappop(self._timers)[2]
+            if call.cancelled:
+                continue
+            try:
+                call()
+            except Exception:
+                log.exception(u'Scheduled call %r failed.' % call.function)
+    
+    def schedule_flush(self, connection):
+        """Marks a connection as having output to write, and wakes up the main
+        loop if it is waiting in a poll. Safe to call from any thread."""
+        with self._flush_lock:
+            self._flushing.add(connection)
+            self._flush_delay = 0
+        if self._waker is not None and \
+                current_thread() is not self._loop_thread:
+            self._waker.wake()
+    
+    def _flush(self):
+        """Lets every connection with queued output write as much as its flood
+        limits allow, and remembers when the next one is due."""
+        with self._flush_lock:
+            pending, self._flushing = self._flushing, set()
+            self._flush_delay = None
+        for connection in pending:
+            sock = connection.socket
+            lock = self.connection_locks.get(sock)
+            if lock is None:
+                continue
+            with lock:
+                delay = connection.flush()
+            if connection.socket is None:
+                self._closed(sock)
+            elif connection.output.blocked:
+                self._wait_writable(sock)
+            elif delay is not None:
+                with self._flush_lock:
+                    self._flushing.add(connection)
+                    if self._flush_delay is None or delay < self._flush_delay:
+                        self._flush_delay = delay
+    
+    def _wait_writable(self, sock):
+        """Watches a connection whose socket is full for writability as well,
+        so that its output goes on as soon as there is room again."""
+        if sock not in self._writing:
+            self._writing.add(sock)
+            self.poller.modify(sock, READ | WRITE)
+    
+    def _writable(self, sock, connection):
+        self._writing.discard(sock)
+        self.poller.modify(sock, READ)
+        with self._flush_lock:
+            self._flushing.add(connection)
+    
+    def output_stats(self):
+        """Returns the output queue statistics of every connection, keyed by
+        server name."""
+        return dict((connection.server.name, connection.output.stats())
+                    for connection in self.connections.values())
+    
+    def _poll_timeout(self, timeout):
+        """Shortens the poll timeout so that the next timer or flush is not
+        late."""
+        with self._timer_lock:
+            if self._timers:
+                timeout = min(timeout, max(0, self._timers[0][0] - time()))
+        with self._flush_lock:
+            if self._flush_delay is not None:
+                timeout = min(timeout, self._flush_delay)
+        return timeout
+    
     def process(self, timeout=0.2):
-        keys = self.connections.keys()
-        if not keys:
+        self._loop_thread = current_thread()
+        timeout = self._poll_timeout(timeout)
+        if self._waker is None and \
+                not (self.connections or self._connecting or self._readers):
             sleep(timeout)
+            self._run_timers()
             return
         try:
-            in_sockets, _, _ = \
-                select.select(keys, [], [], timeout)
+            ready = self.poller.poll(timeout)
         except socket.error as error:
             log.debug(unicode(error))
             for sock, connection in self.connections.items():
                 if not connection.connected:
-                    del self.connections[sock]
-                    del self.connection_locks[sock]
-        except select.error:
+                    self._closed(sock)
+        except (select.error, IOError):
             pass
         else:
-            for sock in in_sockets:
+            for sock, events in ready:
+                if self._waker is not None and sock is self._waker.reader:
+                    self._waker.drain()
+                    continue
+                if sock in self._connecting:
+                    self._connecting[sock].on_ready(sock, events)
+                    continue
+                if sock in self._readers:
+                    self._readers[sock]()
+                    continue
                 try:
                     connection = self.connections[sock]
+                    lock = self.connection_locks[sock]
                 except KeyError:
                     continue
                 if connection.socket is None:
-                    del self.connections[sock]
-                    del self.connection_locks[sock]
-                else:
-                    with self.connection_locks[sock]:
+                    self._closed(sock)
+                    continue
+                if events & WRITE and sock in self._writing:
+                    self._writable(sock, connection)
+                if events & READ:
+                    with lock:
                         connection.process(self.event_manager)
+                if connection.socket is None:
+                    self._closed(sock)
+        self._run_timers()
+        self._flush()
     
-    def disconnect(self, connection, message=u''):
-        """Closes a connection with an optional message."""
+    def disconnect(self, connection, message=u'', deadline=None):
+        """Closes a connection with an optional message. The last lines may
+        wait on a full socket until deadline at the latest."""
         if connection.socket is not None and\
                 connection.socket in self.connections:
             lock = self.connection_locks[connection.socket]
-            del self.connection_locks[connection.socket]
-            del self.connections[connection.socket]
+            self._forget(connection.socket)
             with lock:
-                connection.disconnect(message)
+                connection.disconnect(message, deadline)
     
     def exit(self, message=u''):
-        """Closes all connections with an optional message."""
+        """Closes all connections with an optional message. The connections
+        share a single deadline for their last lines, so that a few stuck
+        ones do not hold up the exit one after the other."""
         if self._running:
+            deadline = time() + Connection.CLOSE_TIMEOUT
             for connection in self.connections.values():
-                self.disconnect(connection, message)
+                self.disconnect(connection, message, deadline)
+            for sock in self._connecting.keys():
+                self._unwatch(sock)
+                sock.close()
+            self._resolver.stop()
             self._running = False
     
 
+class LineBuffer(object):
+    """Receive buffer for a single connection. Data is read straight into a
+    preallocated bytearray with recv_into, line terminators are found in place,
+    and only complete lines are ever copied out. The partial line at the end
+    stays where it is until the next read completes it. The buffer grows if a
+    single line does not fit."""
+    def __init__(self, read_size=16384):
+        self.read_size = read_size
+        self._buffer = bytearray(read_size * 2)
+        self._start = 0 # first byte that has not been handed out yet
+        self._end = 0 # end of the received data
+    
+    def __len__(self):
+        return self._end - self._start
+    
+    def _reserve(self, size):
+        """Makes room for size more bytes after the received data, moving the
+        partial line to the front of the buffer, and growing it if needed."""
+        buf = self._buffer
+        if len(buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start:
+            buf[:pending] = buf[self._start:self._end]
+            self._start, self._end = 0, pending
+        missing = size - (len(buf) - self._end)
+        if missing > 0:
+            buf.extend(bytearray(missing))
+    
+    def recv_from(self, sock):
+        """Performs a single read from the socket into the buffer, returning
+        how many bytes were received. Zero means the peer hung up."""
+        self._reserve(self.read_size)
+        view = memoryview(self._buffer)[self._end:self._end + self.read_size]
+        received = sock.recv_into(view, self.read_size)
+        self._end += received
+        return received
+    
+    def lines(self):
+        """Returns the complete lines received so far, without their line
+        terminators and surrounding whitespace. Empty lines are skipped. All
+        of the complete lines are copied out as one block and split at once."""
+        buf = self._buffer
+        start, end = self._start, self._end
+        last = buf.rfind('\n', start, end)
+        if last < 0:
+            return []
+        block = memoryview(buf)[start:last].tobytes()
+        start = last + 1
+        if start == end:
+            start = end = 0
+        self._start, self._end = start, end
+        lines = []
+        for line in block.split('\n'):
+            line = line.strip()
+            if line:
+                lines.append(line)
+        return lines
+    
+
 class Connection(object):
     """The lowest level of the IRC library. Connection takes care of connecting,
     disconnecting, parsing messages, sending messages, and hooking into IRC
-    events."""
-    def __init__(self, server):
+    events. It can either connect its own socket with connect, or take over
+    one that the Connector has already connected, which is then kept in
+    non-blocking mode."""
+    CLOSE_TIMEOUT = 1 # seconds the last lines and the QUIT may wait to go out
+    
+    def __init__(self, server, sock=None):
         self._connected = False
         self._welcomed = False
         self.server = server
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if self.server.use_ssl:
-            if ssl is None:
-                error_msg = u'SSL connections require the python ssl library.'
-                log.critical(error_msg)
-                raise IRCError(error_msg)
-            self._socket = ssl.wrap_socket(self._socket)
-        self.prev_line = ''
+        self.connect_started = None
+        if self.server.use_ssl and ssl is None:
+            error_msg = u'SSL connections require the python ssl library.'
+            log.critical(error_msg)
+            raise IRCError(error_msg)
+        if sock is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.server.use_ssl:
+                self._socket = self._wrap_socket(self._socket)
+        else:
+            if self.server.use_ssl:
+                self._save_ssl_session(sock)
+            sock.setblocking(0)
+            self._socket = sock
+            self._connected = True
+        self.input = LineBuffer(server.recv_size)
+        self.manager = None
+        
+        limits = dict(DEFAULT_LIMITS)
+        if server.flood:
+            limits.update(server.flood)
+        self.output = OutputQueue(**limits)
+    
+    def _wrap_socket(self, sock):
+        return wrap_ssl_socket(self.server, sock)
+    
+    def _save_ssl_session(self, sock):
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            self.server.ssl_session = session
+            if getattr(sock, 'session_reused', False):
+                log.debug(u'Resumed the TLS session with %s.' %
+                          self.server.host)
     
     def set_welcomed(self):
         self._welcomed = True
@@ -145,26 +703,46 @@ internet.')
         
         return True
     
-    def disconnect(self, message=u''):
-        """Disconnects from the server with an optional message."""
+    def disconnect(self, message=u'', deadline=None):
+        """Disconnects from the server with an optional message. The partly
+        written line, the critical lines and the QUIT are sent, waiting on a
+        full socket until deadline at the latest, CLOSE_TIMEOUT from now by
+        default. Queued messages are dropped."""
         if not self._connected or self._socket is None:
             return
-        try:
-            if message:
-                self.send(u'QUIT :' + message)
-            else:
-                self.send(u'QUIT')
-        except IRCError:
-            pass
+        if message:
+            quit_line = u'QUIT :' + message
         else:
-            try:
-                self._socket.close()
-            except socket.error as error:
-                log.critical(unicode(error))
-                raise IRCError(error)
-        
-        self._socket = None
+            quit_line = u'QUIT'
+        if deadline is None:
+            deadline = time() + self.CLOSE_TIMEOUT
+        sock = self._socket
+        try:
+            sock.setblocking(0)
+            done = self.output.flush_final(sock,
+                                           quit_line.encode('utf-8') + '\r\n')
+            while not done:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                select.select([], [sock], [], remaining)
+                done = self.output.flush_final(sock)
+        except (IRCError, socket.error, select.error) as error:
+            log.debug(unicode(error))
+        self._close()
+    
+    def _close(self):
+        sock, self._socket = self._socket, None
         self._connected = False
+        if self.server.use_ssl:
+            # Servers may only hand out a resumable session after the
+            # handshake, so keep the latest one around for the reconnect.
+            self._save_ssl_session(sock)
+        try:
+            sock.close()
+        except socket.error as error:
+            log.critical(unicode(error))
+            raise IRCError(error)
     
     @property
     def connected(self):
@@ -177,44 +755,66 @@ internet.')
     def process(self, event_manager):
         """Processes new data received from the IRC server."""
         try:
-            data = self._socket.recv(4096)
+            received = self.input.recv_from(self._socket)
+            # Decrypted data left inside the SSL object would not wake up the
+            # poller, so it has to be read now.
+            while received and self.server.use_ssl and self._socket.pending():
+                self.input.recv_from(self._socket)
         except socket.error as error:
+            if would_block(error):
+                # Nothing to read after all, such as half of an SSL record.
+                return
             log.error(unicode(error))
             self.disconnect('Connection reset by peer')
         else:
-            if not data:
+            if not received:
                 log.error(u'No data received from server.')
                 self.disconnect('Connection reset by peer')
             else:
-                # I'm a little worried that the \r\n convention isn't strictly followed
-                # lines = (self.prev_line + data).split('\r\n')
-                lines = [s.strip() for s in (self.prev_line + data).split('\n')]
-                self.prev_line = lines.pop()
-                
-                for line in lines:
-                    if not line:
-                        continue
-                    line_info = parse_irc_line(self.server, line)
-                    command = line_info['command']
-                    del line_info['command']
-                    if command != Events.PONG:
-                        log.debug(unicode(line, 'utf-8'))
-                    try:
-                        event_manager.hook(command, self, line_info)
-                    except IRCError as e:
-                        log.error('%s resulted in IRCError "%s".' % (line_info, e))
+                # Lines are split on \n alone, in case a server does not
+                # strictly follow the \r\n convention.
+                lines = self.input.lines()
+                parsed_lines = parse_irc_lines(self.server, lines)
+                if log.isEnabledFor(logging.DEBUG):
+                    for line, parsed in itertools.izip(lines, parsed_lines):
+                        if parsed.command != Events.PONG:
+                            log.debug(line.decode('utf-8', 'replace'))
+                # Runs of the same event, such as the NAMES replies or JOINs
+                # after a netsplit, are dispatched together.
+                for command, group in itertools.groupby(parsed_lines,
+                                                        attrgetter('command')):
+                    event_manager.hook_all(command, self, group)
 
-    def send(self, message):
-        """Sends a message to the server."""
+    def send(self, message, priority=None, target=None):
+        """Queues a message for the server. It is written out by the
+        ConnectionManager as soon as the flood limits allow it. The priority
+        class (see the flood module) and target are guessed from the message
+        unless they are given."""
         if self._socket is None:
             raise IRCError('No socket :(')
         
         if isinstance(message, unicode):
             message = message.encode('utf-8')
         
+        self.output.put(message + '\r\n', priority, target)
+        if self.manager is not None:
+            self.manager.schedule_flush(self)
+        else:
+            self.flush()
+    
+    def flush(self):
+        """Writes out as much queued output as the flood limits allow. Returns
+        the number of seconds until more can be written, or None once nothing
+        is left or the socket is full (see OutputQueue.flush)."""
+        if self._socket is None:
+            return None
         try:
-            self._socket.send(message + '\r\n')
+            return self.output.flush(self._socket)
         except socket.error as error:
             log.error(unicode(error))
-            raise IRCError(u'Unable to send message.')
+            try:
+                self._close()
+            except IRCError:
+                pass
+            return None
     
@@ -16,37 +16,213 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 #===============================================================================
 
+from structures import DEFAULT_ENCODINGS, User
+from operator import attrgetter
+from threading import Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+class IRCError(Exception):
+    """The error to use for low level IRC problems."""
+    pass
+
+def decode(data, encodings=DEFAULT_ENCODINGS):
+    """Decodes data with the first of the encodings that fits it. If none of
+    them do, the last one is used with the undecodable bytes replaced."""
+    # unicode() takes a shortcut for the common encodings that str.decode
+    # does not, which makes it several times faster on short lines.
+    for encoding in encodings:
+        try:
+            return unicode(data, encoding)
+        except UnicodeDecodeError:
+            pass
+    return unicode(data, encodings[-1], 'replace')
+
+class ParsedLine(object):
+    """A line received from a server, split into its parts. Parts that the line
+    does not have are empty strings. The source and target are kept as they
+    were received, and only turned into Users the first time they are asked
+    for, which is when the line is dispatched. By then, the lines before it in
+    the same read have been dispatched too, so that a 001 or a 005 among them
+    has already set the nick and casemapping they are read with. The message is
+    only decoded the first time it is asked for."""
+    __slots__ = ('server', 'raw_source', 'command', 'raw_target', 'args',
+                 'raw_message', '_source', '_target', '_message')
+    
+    def __init__(self, server=None, raw_source='', command='', raw_target='',
+                 args='', raw_message=''):
+        self.server = server
+        self.raw_source = raw_source
+        self.command = command
+        self.raw_target = raw_target
+        self.args = args
+        self.raw_message = raw_message
+        self._source = None
+        self._target = None
+        self._message = None
+    
+    def __repr__(self):
+        return '<ParsedLine %s %r %r %r %r>' % (self.command, self.raw_source,
+                                                self.raw_target, self.args,
+                                                self.raw_message)
+    
+    @property
+    def source(self):
+        """The User the line came from, or the server's name, or an empty
+        string."""
+        source = self._source
+        if source is None:
+            source = raw_source = self.raw_source
+            server = self.server
+            if raw_source and raw_source != server.actual_host:
+                source = User.parse_user(raw_source,
+                                         server.isupport.casemapping)
+            self._source = source
+        return source
+    
+    @property
+    def target(self):
+        """The target of the line, which is a User when it is the client
+        itself."""
+        target = self._target
+        if target is None:
+            target = raw_target = self.raw_target
+            server = self.server
+            if raw_target and raw_target == server.actual_nick:
+                target = User.parse_user(raw_target,
+                                         server.isupport.casemapping)
+            self._target = target
+        return target
+    
+    @property
+    def message(self):
+        message = self._message
+        if message is None:
+            if self.server is None:
+                message = decode(self.raw_message)
+            else:
+                message = decode(self.raw_message, self.server.encodings)
+            self._message = message
+        return message
+    
+
+EMPTY_LINE = ParsedLine()
+
 class EventManager(object):
-    """Manages IRC event actions."""
+    """Manages IRC event actions. Every event has an ordered tuple of
+    EventHooks, which can be changed at any time with add_hook and
+    remove_hook. The tuples are replaced rather than changed in place, so
+    that dispatching never has to take the lock."""
     
     EVENT_ARGS = ('source', 'target', 'args', 'message')
     
     def __init__(self, event_hooks):
-        self.event_hooks = event_hooks
+        self.event_hooks = {} # event -> tuple of EventHooks
+        self._hooks_lock = Lock()
+        for event, event_hook in event_hooks.iteritems():
+            self.add_hook(event, event_hook)
     
-    def hook(self, event, connection, kwargs=None):
-        if event in self.event_hooks:
-            event_hook = self.event_hooks[event]
-            if kwargs is None:
-                kwargs = {}
-            args = (kwargs.get(arg, '') for arg in self.EVENT_ARGS \
-                    if getattr(event_hook, arg))
-            event_hook.function(connection, *args)
+    def add_hook(self, event, event_hook):
+        """Adds an EventHook, or a list of them, to the end of the hooks of an
+        event."""
+        if isinstance(event_hook, EventHook):
+            event_hook = (event_hook,)
+        with self._hooks_lock:
+            self.event_hooks[event] = self.event_hooks.get(event, ()) + \
+                    tuple(event_hook)
+    
+    def remove_hook(self, event, event_hook):
+        """Removes an EventHook from an event, and fails silently if it is not
+        there."""
+        with self._hooks_lock:
+            hooks = tuple(hook for hook in self.event_hooks.get(event, ())
+                          if hook is not event_hook)
+            if hooks:
+                self.event_hooks[event] = hooks
+            else:
+                self.event_hooks.pop(event, None)
+    
+    def hook(self, event, connection, line=None):
+        """Calls the hooks of an event with the parts of the ParsedLine they
+        asked for."""
+        if line is None:
+            line = EMPTY_LINE
+        self.hook_all(event, connection, (line,))
+    
+    def hook_all(self, event, connection, lines):
+        """Calls the hooks of an event for each of a run of ParsedLines that
+        all raised it, looking the hooks up only once. Each line goes through
+        all of the hooks, in order, before the next one. An IRCError is logged
+        and only skips the rest of the hooks for the line that raised it."""
+        event_hooks = self.event_hooks.get(event)
+        if event_hooks is None:
+            return
+        if len(event_hooks) == 1:
+            dispatch = event_hooks[0].dispatch
+            for line in lines:
+                try:
+                    dispatch(connection, line)
+                except IRCError as e:
+                    log.error('%s resulted in IRCError "%s".' % (line, e))
+        else:
+            for line in lines:
+                try:
+                    for event_hook in event_hooks:
+                        event_hook.dispatch(connection, line)
+                except IRCError as e:
+                    log.error('%s resulted in IRCError "%s".' % (line, e))
     
 
 class EventHook(object):
     """Communication object that describes which action to take for a given IRC
-    event."""
-    def __init__(self, function, source=False, target=False, args=False, message=False):
+    event, and which parts of the line it wants. The parts are passed
+    positionally, or, with keywords, as keyword arguments only when the line
+    has them. A dispatch function that pulls them out of a ParsedLine is
+    compiled once, when the hook is made."""
+    def __init__(self, function, source=False, target=False, args=False,
+                 message=False, keywords=False):
         self.function = function
         self.source = source
         self.target = target
         self.args = args
         self.message = message
+        self.keywords = keywords
+        self.dispatch = self._compile()
+    
+    def __repr__(self):
+        return '<EventHook %r>' % self.function
+    
+    def _compile(self):
+        function = self.function
+        names = tuple(arg for arg in EventManager.EVENT_ARGS
+                      if getattr(self, arg))
+        
+        if self.keywords:
+            def dispatch(connection, line):
+                kwargs = {}
+                for name in names:
+                    value = getattr(line, name)
+                    if value:
+                        kwargs[name] = value
+                function(connection, **kwargs)
+        elif not names:
+            def dispatch(connection, line):
+                function(connection)
+        elif len(names) == 1:
+            getter = attrgetter(names[0])
+            def dispatch(connection, line):
+                function(connection, getter(line))
+        else:
+            getter = attrgetter(*names)
+            def dispatch(connection, line):
+                function(connection, *getter(line))
+        return dispatch
     
 
 class Events(object):
     CONNECT = 'CONNECT'
+    DISCONNECT = 'DISCONNECT'
     PING = 'PING'
     PONG = 'PONG'
     MODE = 'MODE'
@@ -54,6 +230,7 @@ class Events(object):
     JOIN = 'JOIN'
     PART = 'PART'
     QUIT = 'QUIT'
+    NICK = 'NICK'
     PRIVMSG = 'PRIVMSG'
     PUBMSG = 'PUBMSG'
     NOTICE = 'NOTICE'
@@ -0,0 +1,450 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Flood control for outgoing messages. Every connection buffers its output in an
+OutputQueue, which the ConnectionManager drains from the main loop no faster
+than the server is willing to accept it.
+"""
+
+from collections import deque
+from threading import Lock
+import itertools
+import heapq
+import socket
+import errno
+import time
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+# RFC 1459 section 8.10: every message costs two seconds, and a client may run
+# up to ten seconds ahead of the clock before the server starts to penalize it.
+DEFAULT_LIMITS = {
+    'lines_per_second': 0.5,
+    'burst_lines': 5
+}
+
+# Priority classes, from most to least urgent. Critical lines keep the
+# connection alive and are never held back by the flood limits.
+CRITICAL = 0
+INTERACTIVE = 1
+BULK = 2
+
+CRITICAL_COMMANDS = frozenset(['PONG', 'PING', 'NICK', 'QUIT', 'USER', 'PASS'])
+TARGETED_COMMANDS = frozenset(['PRIVMSG', 'NOTICE'])
+
+RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def would_block(error):
+    """Returns whether a socket error only means that a non-blocking socket
+    is not ready yet."""
+    if ssl is not None and isinstance(error, ssl.SSLError):
+        return error.args and error.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                                ssl.SSL_ERROR_WANT_WRITE)
+    return error.args and error.args[0] in RETRY_ERRNOS
+
+def classify(line):
+    """Returns the default (priority, target) of an outgoing line: keepalive
+    and registration commands are critical, everything else is interactive,
+    and messages are queued per target."""
+    split_line = line.split(' ', 2)
+    command = split_line[0].upper()
+    if command in CRITICAL_COMMANDS:
+        return CRITICAL, None
+    if command in TARGETED_COMMANDS and len(split_line) > 1:
+        return INTERACTIVE, split_line[1].lower()
+    return INTERACTIVE, None
+
+class TokenBucket(object):
+    """A token bucket which refills at rate tokens per second, up to capacity
+    tokens. A rate of None means the bucket never runs dry."""
+    def __init__(self, rate=None, capacity=None, clock=time.time):
+        self.rate = rate
+        if capacity is None:
+            capacity = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.stamp = clock()
+
+    @property
+    def unlimited(self):
+        return not self.rate
+
+    def _refill(self, now):
+        if self.unlimited:
+            return
+        elapsed = now - self.stamp
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.stamp = now
+
+    def available(self, now=None):
+        """Returns how many tokens can be spent right now."""
+        if self.unlimited:
+            return float('inf')
+        if now is None:
+            now = self.clock()
+        self._refill(now)
+        return self.tokens
+
+    def consume(self, amount=1, now=None):
+        """Spends amount tokens if they are available, returning whether they
+        were."""
+        if self.unlimited:
+            return True
+        if self.available(now) < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def spend(self, amount=1, now=None):
+        """Spends amount tokens whether or not they are available, which may
+        leave the bucket in debt."""
+        if not self.unlimited:
+            self.available(now)
+            self.tokens -= amount
+
+    def allows(self, amount=1, now=None):
+        """Returns whether amount tokens could be spent right now. Amounts
+        larger than the capacity only need a full bucket."""
+        if self.unlimited:
+            return True
+        return self.available(now) >= min(amount, self.capacity)
+
+    def delay(self, amount=1, now=None):
+        """Returns how many seconds it will take before amount tokens are
+        available. Amounts larger than the capacity only wait for a full
+        bucket, so that they are not stuck forever."""
+        if self.unlimited:
+            return 0
+        amount = min(amount, self.capacity)
+        missing = amount - self.available(now)
+        if missing <= 0:
+            return 0
+        return missing / float(self.rate)
+
+
+class KeyedBuckets(object):
+    """Token buckets for any number of keys, such as hostmasks, that share one
+    rate and capacity. Each key only costs a [tokens, stamp] pair, and since a
+    full bucket is no different from a missing one, the keys whose buckets
+    have refilled are swept away every once in a while, so that memory stays
+    flat however many keys come and go. Not thread safe."""
+    def __init__(self, rate, capacity=None, clock=time.time):
+        self.rate = float(rate)
+        if capacity is None:
+            # A rate below one a second still lets a single token through.
+            capacity = max(1, rate)
+        self.capacity = capacity
+        self.clock = clock
+        self._buckets = {} # key -> [tokens, stamp]
+        # A bucket refills completely in this many seconds.
+        self.refill_time = capacity / self.rate
+        self._next_sweep = clock() + self.refill_time
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _tokens(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        tokens, stamp = bucket
+        return min(self.capacity, tokens + (now - stamp) * self.rate)
+
+    def allows(self, key, amount=1, now=None):
+        """Returns whether amount tokens could be spent from the bucket of a
+        key right now. Amounts larger than the capacity only need a full
+        bucket."""
+        if now is None:
+            now = self.clock()
+        return self._tokens(key, now) >= min(amount, self.capacity)
+
+    def spend(self, key, amount=1, now=None):
+        """Spends amount tokens from the bucket of a key, whether or not they
+        are there."""
+        if now is None:
+            now = self.clock()
+        self._buckets[key] = [self._tokens(key, now) - amount, now]
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+    def consume(self, key, amount=1, now=None):
+        """Spends amount tokens from the bucket of a key if they are there,
+        returning whether they were. Amounts larger than the capacity only
+        need a full bucket."""
+        if now is None:
+            now = self.clock()
+        if self._tokens(key, now) < min(amount, self.capacity):
+            return False
+        self.spend(key, amount, now)
+        return True
+
+    def sweep(self, now=None):
+        """Forgets the keys whose buckets are full again."""
+        if now is None:
+            now = self.clock()
+        capacity, rate = self.capacity, self.rate
+        for key, (tokens, stamp) in self._buckets.items():
+            if tokens + (now - stamp) * rate >= capacity:
+                del self._buckets[key]
+        self._next_sweep = now + self.refill_time
+
+
+class FairQueue(object):
+    """A self-clocked weighted fair queue, so that a target with a lot of
+    output cannot starve the others. Every line gets a virtual finish time
+    based on its size and the weight of its target, and lines leave the queue
+    in order of finish time, which keeps each target in FIFO order."""
+    def __init__(self, weights=None):
+        if weights is None:
+            weights = {}
+        self.weights = weights
+        self._heap = [] # (finish, sequence, target, line)
+        self._sequence = itertools.count()
+        self._last_finish = {} # target -> finish of its last queued line
+        self._counts = {} # target -> number of queued lines
+        self._virtual_time = 0.0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, line, target=None):
+        weight = self.weights.get(target, 1.0)
+        start = max(self._virtual_time, self._last_finish.get(target, 0.0))
+        finish = start + len(line) / float(weight)
+        self._last_finish[target] = finish
+        self._counts[target] = self._counts.get(target, 0) + 1
+        heapq.heappush(self._heap, (finish, next(self._sequence), target, line))
+
+    def peek(self):
+        return self._heap[0][3]
+
+    def pop(self):
+        finish, _, target, line = heapq.heappop(self._heap)
+        self._virtual_time = finish
+        count = self._counts[target] - 1
+        if count:
+            self._counts[target] = count
+        else:
+            del self._counts[target]
+            del self._last_finish[target]
+        return line
+
+    def clear(self):
+        del self._heap[:]
+        self._last_finish.clear()
+        self._counts.clear()
+
+
+class OutputQueue(object):
+    """Buffers the lines of a single connection and writes them out within the
+    limits of a pair of token buckets, one counting lines and one counting
+    bytes. Lines are scheduled by priority class: critical lines go first and
+    ignore the limits, then interactive replies, then bulk output, each class
+    being shared fairly between targets. Consecutive lines are coalesced into
+    a single send whenever the budget allows it, and short writes keep their
+    remainder for the next flush, once the socket is writable again."""
+
+    STATS_WINDOW = 10 # seconds over which the drain rate is measured
+
+    def __init__(self, lines_per_second=None, bytes_per_second=None,
+                 burst_lines=None, burst_bytes=None, max_write=4096,
+                 target_weights=None, clock=time.time):
+        self.clock = clock
+        self.lines = TokenBucket(lines_per_second, burst_lines, clock)
+        self.bytes = TokenBucket(bytes_per_second, burst_bytes, clock)
+        self.max_write = max_write
+
+        self._critical = deque()
+        self._classes = (self._critical, FairQueue(target_weights),
+                         FairQueue(target_weights))
+        self._queued_bytes = 0
+        self._buffer = '' # accepted from the queue, but not fully written
+        self._lock = Lock()
+        self.blocked = False # the socket could not take the whole buffer
+
+        self.sent_lines = 0
+        self.sent_bytes = 0
+        self.writes = 0
+        self.short_writes = 0
+        self._history = deque() # (time, lines, bytes) within STATS_WINDOW
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._classes)
+
+    @property
+    def pending(self):
+        return bool(self._buffer or len(self))
+
+    def put(self, line, priority=None, target=None):
+        """Queues an encoded line, which must already end in CRLF. The priority
+        class and target are guessed from the line unless they are given."""
+        if priority is None or target is None:
+            guessed_priority, guessed_target = classify(line)
+            if priority is None:
+                priority = guessed_priority
+            if target is None:
+                target = guessed_target
+        with self._lock:
+            if priority == CRITICAL:
+                self._critical.append(line)
+            else:
+                self._classes[priority].put(line, target)
+            self._queued_bytes += len(line)
+
+    def _head(self):
+        """Returns the priority class of the next line to go out, or None."""
+        for priority, queue in enumerate(self._classes):
+            if queue:
+                return priority
+        return None
+
+    def _take(self, now):
+        """Moves as many queued lines into the write buffer as the budget and
+        max_write allow."""
+        chunk = []
+        size = 0
+        while True:
+            priority = self._head()
+            if priority is None:
+                break
+            queue = self._classes[priority]
+            if priority == CRITICAL:
+                line = queue[0]
+            else:
+                line = queue.peek()
+            line_len = len(line)
+            if chunk and size + line_len > self.max_write:
+                break
+            if priority != CRITICAL and \
+                    not (self.lines.allows(1, now) and
+                         self.bytes.allows(line_len, now)):
+                break
+            self.lines.spend(1, now)
+            self.bytes.spend(line_len, now)
+            if priority == CRITICAL:
+                queue.popleft()
+            else:
+                queue.pop()
+            self._queued_bytes -= line_len
+            chunk.append(line)
+            size += line_len
+        if chunk:
+            self._buffer = ''.join(chunk)
+            self._record(now, len(chunk), 0)
+
+    def _write(self, sock, now):
+        """Writes the buffer once, and returns whether all of it went out."""
+        try:
+            written = sock.send(self._buffer)
+        except socket.error as error:
+            if would_block(error):
+                return False
+            raise
+        self.writes += 1
+        self._record(now, 0, written)
+        if written < len(self._buffer):
+            self.short_writes += 1
+            self._buffer = self._buffer[written:]
+            return False
+        self._buffer = ''
+        return True
+
+    def flush(self, sock):
+        """Writes out whatever the flood limits allow to a non-blocking socket.
+        Returns the number of seconds until the next flush is worthwhile, or
+        None if the queue is empty or the socket is full. In the latter case
+        blocked is set, and the next flush should wait until the socket is
+        writable. Socket errors are left to the caller."""
+        with self._lock:
+            now = self.clock()
+            self.blocked = False
+            while True:
+                if not self._buffer:
+                    self._take(now)
+                    if not self._buffer:
+                        break
+                if not self._write(sock, now):
+                    self.blocked = True
+                    return None
+            priority = self._head()
+            if priority is None:
+                return None
+            if priority == CRITICAL:
+                return 0
+            line_len = len(self._classes[priority].peek())
+            return max(self.lines.delay(1, now),
+                       self.bytes.delay(line_len, now))
+
+    def flush_final(self, sock, last_line=None):
+        """Drops the queued interactive and bulk lines, and writes out the rest
+        of the buffer, the critical lines and then last_line if one is given,
+        ignoring the flood limits. Used right before a connection is closed.
+        Nothing waits on a full socket: whatever it cannot take stays in the
+        buffer for another call once it is writable. Returns whether
+        everything went out."""
+        with self._lock:
+            chunk = [self._buffer]
+            chunk.extend(self._critical)
+            if last_line is not None:
+                chunk.append(last_line)
+            self._critical.clear()
+            for queue in self._classes[1:]:
+                queue.clear()
+            self._queued_bytes = 0
+            self._buffer = ''.join(chunk)
+            if not self._buffer:
+                return True
+            return self._write(sock, self.clock())
+
+    def _record(self, now, lines, num_bytes):
+        self.sent_lines += lines
+        self.sent_bytes += num_bytes
+        history = self._history
+        history.append((now, lines, num_bytes))
+        while history and history[0][0] < now - self.STATS_WINDOW:
+            history.popleft()
+
+    def stats(self):
+        """Returns a dict describing the queue depth and how fast the queue
+        has been draining over the last STATS_WINDOW seconds."""
+        with self._lock:
+            now = self.clock()
+            recent = [entry for entry in self._history
+                      if entry[0] >= now - self.STATS_WINDOW]
+            return {
+                'depth': len(self),
+                'critical_depth': len(self._classes[CRITICAL]),
+                'interactive_depth': len(self._classes[INTERACTIVE]),
+                'bulk_depth': len(self._classes[BULK]),
+                'queued_bytes': self._queued_bytes + len(self._buffer),
+                'sent_lines': self.sent_lines,
+                'sent_bytes': self.sent_bytes,
+                'writes': self.writes,
+                'short_writes': self.short_writes,
+                'lines_per_second': sum(e[1] for e in recent) / \
+                        float(self.STATS_WINDOW),
+                'bytes_per_second': sum(e[2] for e in recent) / \
+                        float(self.STATS_WINDOW)
+            }
+
@@ -0,0 +1,203 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2010  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Readiness backends used by the ConnectionManager to find out which sockets have
+something to say. Sockets are registered once and then polled, so the cost of a
+poll is proportional to the number of ready sockets wherever the platform allows
+it (epoll), with select kept around as the portable fallback.
+"""
+
+import select
+
+READ = 1
+WRITE = 2
+
+class Poller(object):
+    """Abstract readiness backend. Keeps track of which socket lives on which
+    file descriptor, since a socket that has already been closed can no longer
+    tell us its fileno."""
+    name = 'abstract'
+
+    def __init__(self):
+        self._sockets = {} # fd -> socket
+        self._fds = {} # socket -> fd
+
+    def __len__(self):
+        return len(self._fds)
+
+    def __contains__(self, sock):
+        return sock in self._fds
+
+    def register(self, sock, events=READ):
+        """Starts watching a socket for the given events."""
+        fd = sock.fileno()
+        self._sockets[fd] = sock
+        self._fds[sock] = fd
+        self._register(fd, events)
+
+    def modify(self, sock, events):
+        """Changes the events a registered socket is watched for."""
+        self._modify(self._fds[sock], events)
+
+    def unregister(self, sock):
+        """Stops watching a socket, and fails silently if it was never
+        registered. Safe to call after the socket has been closed."""
+        fd = self._fds.pop(sock, None)
+        if fd is None:
+            return
+        # The descriptor may already have been reused by a newer socket.
+        if self._sockets.get(fd) is sock:
+            del self._sockets[fd]
+            self._unregister(fd)
+
+    def poll(self, timeout=None):
+        """Waits up to timeout seconds and returns a list of (socket, events)
+        pairs for the sockets that are ready."""
+        ready = []
+        for fd, events in self._poll(timeout):
+            sock = self._sockets.get(fd)
+            if sock is not None:
+                ready.append((sock, events))
+        return ready
+
+    def close(self):
+        self._sockets.clear()
+        self._fds.clear()
+
+    def _register(self, fd, events):
+        raise NotImplementedError
+
+    def _modify(self, fd, events):
+        raise NotImplementedError
+
+    def _unregister(self, fd):
+        raise NotImplementedError
+
+    def _poll(self, timeout):
+        raise NotImplementedError
+
+
+class SelectPoller(Poller):
+    """Portable backend built on select.select. Still pays for every registered
+    socket on each poll and is bound by FD_SETSIZE."""
+    name = 'select'
+
+    def __init__(self):
+        super(SelectPoller, self).__init__()
+        self._readers = set()
+        self._writers = set()
+
+    def _register(self, fd, events):
+        self._modify(fd, events)
+
+    def _modify(self, fd, events):
+        if events & READ:
+            self._readers.add(fd)
+        else:
+            self._readers.discard(fd)
+        if events & WRITE:
+            self._writers.add(fd)
+        else:
+            self._writers.discard(fd)
+
+    def _unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+    def _poll(self, timeout):
+        readers, writers, _ = select.select(list(self._readers),
+                                            list(self._writers), [], timeout)
+        ready = dict.fromkeys(readers, READ)
+        for fd in writers:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return ready.iteritems()
+
+    def close(self):
+        super(SelectPoller, self).close()
+        self._readers.clear()
+        self._writers.clear()
+
+
+class EpollPoller(Poller):
+    """Linux backend built on select.epoll, where a poll only costs as much as
+    the sockets that are actually ready."""
+    name = 'epoll'
+
+    def __init__(self):
+        super(EpollPoller, self).__init__()
+        self._epoll = select.epoll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def _register(self, fd, events):
+        self._epoll.register(fd, self._mask(events))
+
+    def _modify(self, fd, events):
+        self._epoll.modify(fd, self._mask(events))
+
+    def _unregister(self, fd):
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            # Closing a descriptor already takes it out of the epoll set.
+            pass
+
+    def _poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        for fd, mask in self._epoll.poll(timeout):
+            events = 0
+            # Errors and hang ups are reported as readable so that the next
+            # recv can find out what happened.
+            if mask & (select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR |
+                       select.EPOLLHUP):
+                events |= READ
+            if mask & select.EPOLLOUT:
+                events |= WRITE
+            yield fd, events
+
+    def close(self):
+        super(EpollPoller, self).close()
+        self._epoll.close()
+
+
+POLLERS = {
+    SelectPoller.name: SelectPoller,
+    EpollPoller.name: EpollPoller
+}
+
+def get_poller(name=None):
+    """Returns a new poller by name, or the best one available on this platform
+    if no name is given."""
+    if name is None:
+        if hasattr(select, 'epoll'):
+            name = EpollPoller.name
+        else:
+            name = SelectPoller.name
+    try:
+        return POLLERS[name]()
+    except KeyError:
+        raise ValueError(u'Unknown poller "%s".' % name)
+
@@ -20,19 +20,81 @@
 Contains the core structures needed for IRC.
 """
 
+from caches import LRUCache
 from threading import Lock
+import string
+
+# Tried in order on every received message. cp1252 covers the latin-1 clients
+# that are still around.
+DEFAULT_ENCODINGS = ('utf-8', 'cp1252')
+
+_new = object.__new__
+
+class CaseMapping(object):
+    """One of the ways of lowercasing nicks and channel names that a server
+    can advertise with CASEMAPPING. rfc1459 also treats []\\~ as the
+    uppercase forms of {}|^, and strict-rfc1459 does so for all of them but ~.
+    The tables are built once, so lowercasing is a single translate call."""
+    __slots__ = ('name', 'table', 'unicode_table')
+    
+    def __init__(self, name, upper, lower):
+        self.name = name
+        self.table = string.maketrans(upper, lower)
+        self.unicode_table = dict((ord(u), ord(l)) for u, l in
+                                  zip(upper, lower))
+    
+    def __repr__(self):
+        return '<CaseMapping %s>' % self.name
+    
+    def lower(self, value):
+        if isinstance(value, unicode):
+            return value.translate(self.unicode_table)
+        return value.translate(self.table)
+    
+
+ASCII = CaseMapping('ascii', string.ascii_uppercase, string.ascii_lowercase)
+RFC1459 = CaseMapping('rfc1459', string.ascii_uppercase + '[]\\~',
+                      string.ascii_lowercase + '{}|^')
+STRICT_RFC1459 = CaseMapping('strict-rfc1459', string.ascii_uppercase + '[]\\',
+                             string.ascii_lowercase + '{}|')
+
+# CASEMAPPING value -> CaseMapping. Unknown values are treated as rfc1459,
+# which is what servers that do not send CASEMAPPING use.
+CASEMAPPINGS = dict((casemapping.name, casemapping) for casemapping in
+                    (ASCII, RFC1459, STRICT_RFC1459))
 
 class Server(object):
     """An IRC server represenation, which stores the host, port, and nick of the
-    user connected. Supports ssl (soon)."""
-    def __init__(self, host, port, nick, owner=None, name='unnamed', use_ssl=False):
+    user connected. Supports ssl, with one SSLContext per server that is
+    shared by every reconnect. Received messages are decoded with the first of
+    its encodings that fits."""
+    __slots__ = ('host', 'port', 'nick', 'name', 'use_ssl', 'ssl_options',
+                 'ssl_context', 'ssl_session', 'flood', 'recv_size',
+                 'reconnect', 'encodings', 'welcome_delay', 'actual_host',
+                 'actual_nick', 'isupport', 'users', 'owner')
+    
+    def __init__(self, host, port, nick, owner=None, name='unnamed', use_ssl=False,
+                 flood=None, recv_size=16384, reconnect=None, ssl_options=None,
+                 encodings=None):
         self.host = host
         self.port = port
         self.nick = nick
         self.name = name
         self.use_ssl = use_ssl
+        self.ssl_options = ssl_options
+        self.ssl_context = None
+        self.ssl_session = None
+        self.flood = flood
+        self.recv_size = recv_size
+        self.reconnect = reconnect
+        if encodings is None:
+            encodings = DEFAULT_ENCODINGS
+        self.encodings = tuple(encodings)
+        self.welcome_delay = None
         self.actual_host = ''
         self.actual_nick = ''
+        self.isupport = ISupport()
+        self.users = UserRegistry()
         if owner is None:
             self.owner = nick
         else:
@@ -41,6 +103,13 @@ class Server(object):
     def reset(self):
         self.actual_host = ''
         self.actual_nick = ''
+        self.isupport = ISupport()
+        self.users = UserRegistry()
+    
+    def lower(self, name):
+        """Lowercases a nick or a channel name with the server's
+        casemapping."""
+        return self.isupport.casemapping.lower(name)
     
     def __eq__(self, other):
         return self.actual_host == other.actual_host and\
@@ -48,72 +117,248 @@ class Server(object):
                 self.actual_nick == other.actual_nick
     
 
+class ISupport(object):
+    """The features a server advertises with RPL_ISUPPORT (005), along with the
+    lookup tables the mode parser needs. Until the server says otherwise, the
+    defaults that most servers use are assumed."""
+    DEFAULTS = {
+        'CHANMODES': 'beI,k,l,imnpst',
+        'PREFIX': '(qaohv)~&@%+',
+        'CASEMAPPING': 'rfc1459'
+    }
+    
+    def __init__(self, tokens=None):
+        self.tokens = {}
+        self.update(tokens or ())
+    
+    def update(self, tokens):
+        """Applies a list of 005 tokens, such as 'PREFIX=(ov)@+', 'EXCEPTS' or
+        '-EXCEPTS', and rebuilds the lookup tables."""
+        for token in tokens:
+            if token.startswith('-'):
+                self.tokens.pop(token[1:].upper(), None)
+            else:
+                name, _, value = token.partition('=')
+                self.tokens[name.upper()] = value
+        self._build()
+    
+    def get(self, name):
+        value = self.tokens.get(name)
+        if value is None:
+            value = self.DEFAULTS.get(name, '')
+        return value
+    
+    def _build(self):
+        # CHANMODES=A,B,C,D: A modes are lists and B modes always take a
+        # parameter, C modes only take one when they are set, and D modes
+        # never do.
+        types = (self.get('CHANMODES').split(',') + ['', '', ''])[:4]
+        self.chanmodes = {}
+        for kind, characters in zip('ABCD', types):
+            for character in characters:
+                self.chanmodes[character] = kind
+        
+        # PREFIX=(modes)symbols, from the highest status to the lowest.
+        self.prefixes = {} # mode character -> prefix symbol
+        prefix = self.get('PREFIX')
+        if prefix.startswith('(') and ')' in prefix:
+            characters, symbols = prefix[1:].split(')', 1)
+            self.prefixes = dict(zip(characters, symbols))
+        
+        # The User status bit of every prefix. Statuses that User has no bit
+        # for, such as InspIRCd's Y, get 0, so that their symbol is still
+        # stripped from the nicks in a NAMES reply.
+        self.mode_statuses = {} # mode character -> status bit
+        self.statuses = {} # prefix symbol -> status bit
+        for character, symbol in self.prefixes.iteritems():
+            status = User.STATUSES.get(User.MODES.get(character), 0)
+            self.mode_statuses[character] = status
+            self.statuses[symbol] = status
+        
+        self.casemapping = CASEMAPPINGS.get(self.get('CASEMAPPING').lower(),
+                                            RFC1459)
+        
+        # mode character -> (takes a parameter when set, when unset)
+        self.mode_params = {}
+        for character, kind in self.chanmodes.iteritems():
+            self.mode_params[character] = (kind in 'ABC', kind in 'AB')
+        for character in self.prefixes:
+            self.mode_params[character] = (True, True)
+    
+    def takes_param(self, character, on):
+        """Returns whether a mode takes a parameter when it is set (on) or
+        unset. Unknown modes are assumed not to."""
+        params = self.mode_params.get(character)
+        if params is None:
+            return False
+        return params[not on]
+    
+
+# Shared by every Channel, since each one only holds it for a dict operation or
+# two, and a pair of locks per channel adds up on big networks.
+_channel_lock = Lock()
+
+def _mode_bit(character):
+    return 1 << ord(character)
+
+def _mode_characters(bits):
+    """Returns the mode characters set in a bitset, in order."""
+    characters = []
+    while bits:
+        bit = bits & -bits
+        characters.append(chr(bit.bit_length() - 1))
+        bits ^= bit
+    return characters
+
+class UserRegistry(object):
+    """The channels every known user of a server is in, kept up to date by the
+    Channels themselves, so that a QUIT or a NICK only has to touch the
+    channels the user is actually in. Users are looked up by their key, the
+    nick lowercased with the server's casemapping."""
+    def __init__(self):
+        self.memberships = {} # user key -> channel key -> Channel
+        self._lock = Lock()
+    
+    def __contains__(self, key):
+        return key in self.memberships
+    
+    def __len__(self):
+        return len(self.memberships)
+    
+    def join(self, key, channel):
+        with self._lock:
+            self.memberships.setdefault(key, {})[channel.key] = channel
+    
+    def leave(self, key, channel):
+        """Forgets that a user is in a channel, and forgets the user once it
+        is in none of them."""
+        with self._lock:
+            channels = self.memberships.get(key)
+            if channels is not None:
+                channels.pop(channel.key, None)
+                if not channels:
+                    del self.memberships[key]
+    
+    def channels(self, key):
+        """Returns the Channels a user is in."""
+        return self.memberships.get(key, {}).values()
+    
+    def rename(self, key, new_key):
+        """Moves a user to a new key, and returns the Channels it is in."""
+        with self._lock:
+            channels = self.memberships.pop(key, None)
+            if channels is None:
+                return []
+            self.memberships.setdefault(new_key, {}).update(channels)
+            return channels.values()
+    
+
 class Channel(object):
-    """An IRC channel representation."""
+    """An IRC channel representation. Users are kept in a dict keyed by nick,
+    so that finding, adding or removing one takes the same time however big the
+    channel is. Modes are kept as a bitset of the set mode characters, along
+    with the parameters of the ones that have one. Nicks and the channel name
+    are compared by key, lowercased with the server's casemapping."""
+    __slots__ = ('server', 'name', 'key', 'roster', 'mode_bits', 'mode_params')
+    
+    user_lock = _channel_lock
+    mode_lock = _channel_lock
+    
     def __init__(self, server, name, users=None, modes=None):
         self.server = server
-        self.name = name.lower()
-        
-        self.user_lock = Lock()
-        self.mode_lock = Lock()
+        self.name = name
+        self.key = server.lower(name)
         
-        if users is None:
-            self.users = []
+        self.roster = {} # user key -> User
+        self.mode_bits = 0 # 1 << ord(mode character) for every set mode
+        self.mode_params = {} # mode character -> parameter
         
-        if modes is None:
-            self.modes = []
+        for user in users or ():
+            self.add_user(user)
+        for mode in modes or ():
+            self.add_mode(mode)
     
     def __eq__(self, other):
-        return self.server == other.server and self.name == other.name
+        return self.server == other.server and self.key == other.key
     
     def __repr__(self):
         return self.name
     
+    @property
+    def users(self):
+        return self.roster.values()
+    
+    @property
+    def modes(self):
+        params = self.mode_params
+        return [Mode(character, params.get(character, ''))
+                for character in _mode_characters(self.mode_bits)]
+    
+    def has_mode(self, character):
+        return bool(self.mode_bits & _mode_bit(character))
+    
+    def _key(self, nick):
+        return self.server.lower(nick)
+    
     def in_channel(self, nick):
-        user = User.channel_user(nick)
-        return user in self.users
+        return self._key(nick) in self.roster
     
     def add_user(self, user):
-        """Adds a user to the list of users if it is not already there."""
+        """Adds a user to the channel if it is not already there."""
         with self.user_lock:
-            if user not in self.users:
-                self.users.append(user)
+            self.roster.setdefault(user.key, user)
+        self.server.users.join(user.key, self)
     
     def remove_user(self, user):
-        """Tries to remove a user from the set of users in the channel, and
-        fails silently."""
+        """Tries to remove a user from the channel, and fails silently."""
+        with self.user_lock:
+            self.roster.pop(user.key, None)
+        self.server.users.leave(user.key, self)
+    
+    def rename_user(self, nick, new_nick):
+        """Keeps a user that changed its nick in the channel under the new
+        nick. The server's UserRegistry is renamed separately, once for every
+        channel."""
+        with self.user_lock:
+            user = self.roster.pop(self._key(nick), None)
+            if user is not None:
+                user.nick = new_nick
+                user.key = self._key(new_nick)
+                self.roster[user.key] = user
+    
+    def clear_users(self):
+        """Removes every user from the channel, such as when the client
+        leaves it."""
         with self.user_lock:
-            try:
-                self.users.remove(user)
-            except ValueError:
-                pass
+            roster, self.roster = self.roster, {}
+        for key in roster:
+            self.server.users.leave(key, self)
     
     def find_user(self, nick):
-        search_user = User.channel_user(nick)
-        for user in self.users:
-            if user == search_user:
-                return user
-        return None
+        return self.roster.get(self._key(nick))
     
     def add_mode(self, mode):
-        """Adds a mode to the list of modes if it is not already there."""
+        """Sets a mode on the channel, replacing its old parameter if it was
+        already set."""
         with self.mode_lock:
-            if mode not in self.modes:
-                self.modes.append(mode)
+            self.mode_bits |= _mode_bit(mode.character)
+            if mode.param:
+                self.mode_params[mode.character] = mode.param
+            else:
+                self.mode_params.pop(mode.character, None)
     
     def remove_mode(self, mode):
-        """Tries to remove a mode from the set of modes in the channel, and
-        fails silently."""
+        """Tries to remove a mode from the channel, and fails silently."""
         with self.mode_lock:
-            try:
-                self.modes.remove(mode)
-            except ValueError:
-                pass
+            self.mode_bits &= ~_mode_bit(mode.character)
+            self.mode_params.pop(mode.character, None)
     
 
 class Mode(object):
     """An IRC mode representation, which stores the mode character, the
     parameter, and whether it is on."""
+    __slots__ = ('character', 'param', 'on')
+    
     SWITCH = ('-', '+')
     def __init__(self, character, param='', on=True):
         self.character = character
@@ -131,53 +376,44 @@ class Mode(object):
         return mode
     
     @staticmethod
-    def parse_modes(modes, mode_args):
+    def parse_modes(modes, mode_args, isupport=None):
+        """Parses a mode string such as '+o-v+k' and its arguments into a list
+        of Modes in a single pass. Which modes take an argument is looked up
+        in the ISupport of the server."""
         if not modes.startswith('+') and not modes.startswith('-'):
             return []
         
-        on = modes[0] == '+'
-        
-        if '+' not in modes:
-            on_modes = ''
-            off_modes = modes[1:]
-        elif '-' not in modes:
-            on_modes = modes[1:]
-            off_modes = ''
-        else:
-            first_pass = modes.split('+')
-            if first_pass[0]:
-                second_pass = first_pass[0].split('-')
-                on_modes, off_modes = first_pass[1], second_pass[1]
-            else:
-                second_pass = first_pass[1].split('-')
-                on_modes, off_modes = second_pass
-        
-        arg_index = len(on_modes) + len(off_modes) - len(mode_args)
+        if isupport is None:
+            isupport = DEFAULT_ISUPPORT
+        mode_params = isupport.mode_params
         
         l = []
         i = 0
+        num_args = len(mode_args)
+        on = True
         
-        if on:
-            iterlist = (on_modes, off_modes)
-        else:
-            iterlist = (off_modes, on_modes)
-        
-        for j, mode_list in enumerate(iterlist):
-            switched_on = bool((j + on) % 2)
-            for mode in mode_list:
-                if i < arg_index:
-                    l.append(Mode(mode, on=switched_on))
+        for character in modes:
+            if character == '+':
+                on = True
+            elif character == '-':
+                on = False
+            else:
+                params = mode_params.get(character)
+                if params is not None and params[not on] and i < num_args:
+                    l.append(Mode(character, param=mode_args[i], on=on))
+                    i += 1
                 else:
-                    l.append(Mode(mode, param=mode_args[i - arg_index],
-                                  on=switched_on))
-                i += 1
+                    l.append(Mode(character, on=on))
         
         return l
     
 
 class User(object):
     """An IRC user represenation, storing nick, username, host, and channel
-    status."""
+    status. The status is a bitmask of STATUSES values, and the key is the nick
+    lowercased with the casemapping of the server the user was seen on."""
+    __slots__ = ('nick', 'key', 'username', 'host', 'status')
+    
     NORMAL = ' '
     VOICE = '+'
     HALFOP = '%'
@@ -202,51 +438,100 @@ class User(object):
         'q': FOUNDER
     }
     
-    def __init__(self, nick, username, host, status):
-        self.nick = nick.lower()
+    # raw user string -> (casemapping, nick, key, username, host, status),
+    # shared by every User parsed from the same string
+    identities = LRUCache(4096)
+    
+    def __init__(self, nick, username, host, status, casemapping=RFC1459):
+        """The status is either a prefix symbol, such as User.OP, or a bitmask
+        of STATUSES values."""
+        self.nick = nick
+        self.key = casemapping.lower(nick)
         self.username = username
         self.host = host
         
         if status in self.STATUSES:
             self.status = self.STATUSES[status]
+        elif isinstance(status, int) and status:
+            self.status = status
         else:
             self.status = self.STATUSES[self.NORMAL]
     
     def __eq__(self, other):
-        return self.nick == other.nick and \
+        return self.key == other.key and \
                 self.username == other.username and \
                 self.host == other.host
     
     def __repr__(self):
         return self.nick
     
-    def add_mode(self, mode):
-        status = self.STATUSES[self.MODES[mode.character]]
+    def add_mode(self, mode, statuses=None):
+        """Sets the status a mode gives, using the server's mode character to
+        status bit table (ISupport.mode_statuses) if one is given."""
+        status = self._mode_status(mode, statuses)
         self.status |= status
     
-    def remove_mode(self, mode):
-        status = self.STATUSES[self.MODES[mode.character]]
-        self.status -= status
+    def remove_mode(self, mode, statuses=None):
+        status = self._mode_status(mode, statuses)
+        self.status &= ~status
+    
+    def _mode_status(self, mode, statuses):
+        if statuses is None:
+            return self.STATUSES.get(self.MODES.get(mode.character), 0)
+        return statuses.get(mode.character, 0)
     
     @classmethod
-    def channel_user(cls, nick):
-        return cls(nick, '', '', User.NORMAL)
+    def channel_user(cls, nick, casemapping=RFC1459):
+        return cls(nick, '', '', User.NORMAL, casemapping)
     
     @classmethod
-    def parse_user(cls, user):
-        """Helper function that parses user information into a User object."""
-        username, host = '', ''
-        if user[0] in cls.STATUSES:
-            status, nick = user[0], user[1:]
+    def parse_identity(cls, user, statuses=None):
+        """Splits user information into an interned (nick, username, host,
+        status) tuple. The status is the bitmask of every prefix symbol in
+        front of the nick, as in '@+nick' from a server with multi-prefix,
+        looked up in the server's table (ISupport.statuses) if one is
+        given."""
+        if statuses is None:
+            statuses = cls.STATUSES
+        status = 0
+        start = 0
+        while start < len(user) and user[start] in statuses:
+            status |= statuses[user[start]]
+            start += 1
+        if start:
+            user = user[start:]
+        
+        info, at, host = user.partition('@')
+        if at:
+            nick, _, username = info.partition('!')
         else:
-            status = cls.NORMAL
-            split_user = user.split('@')
-            
-            if len(split_user) == 1:
-                nick = split_user[0]
-            else:
-                info, host = split_user
-                nick, username = info.split('!')
+            nick, username = user, ''
         
-        return cls(nick, username, host, status)
+        if isinstance(nick, str):
+            # intern only takes byte strings.
+            return (intern(nick), intern(username), intern(host), status)
+        return (nick, username, host, status)
+    
+    @classmethod
+    def parse_user(cls, user, casemapping=RFC1459, statuses=None):
+        """Helper function that parses user information into a User object.
+        The most recently seen users are only parsed once, unless a table of
+        the server's prefix symbols is given, as for the entries of a NAMES
+        reply, which are not cached."""
+        if statuses is not None:
+            return cls(*cls.parse_identity(user, statuses),
+                       casemapping=casemapping)
+        entry = cls.identities.get(user)
+        if entry is None or entry[0] is not casemapping:
+            nick, username, host, status = cls.parse_identity(user)
+            entry = (casemapping, nick, casemapping.lower(nick), username,
+                     host, status or cls.STATUSES[cls.NORMAL])
+            cls.identities.put(user, entry)
+        # Skips __init__, since everything it works out is in the entry.
+        parsed = _new(cls)
+        (_, parsed.nick, parsed.key, parsed.username, parsed.host,
+         parsed.status) = entry
+        return parsed
     
+
+DEFAULT_ISUPPORT = ISupport()
@@ -16,74 +16,58 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 #===============================================================================
 
-from events import Events
-from structures import User
+from events import Events, ParsedLine
 
 def parse_irc_line(server, line):
-    """Line format:
+    """Parses a line into a ParsedLine. Line format:
     [:][<source>] <command> [<target>] [<args> ...][ :<message>]"""
-    raw_source, command, target, args, message = '', '', '', [], ''
-    
-    split_line = line.split(' :', 1)
-    split_line_len = len(split_line)
-    if split_line_len == 1:
-        if line.startswith(':'):
-            split_prefix = line[1:].split()
-        else:
-            split_prefix = line.split()
-    elif split_line_len == 2:
-        irc_protocol_prefix, message = split_line
-        if irc_protocol_prefix.startswith(':'):
-            split_prefix = irc_protocol_prefix[1:].split()
+    return parse_irc_lines(server, (line,))[0]
+
+def parse_irc_lines(server, lines):
+    """Parses a batch of lines, such as everything a single read returned, into
+    a list of ParsedLines in the same order, looking up everything the loop
+    needs once for the whole batch. Nothing here depends on what the hooks of
+    earlier lines in the batch change, such as the casemapping: the source and
+    target are only read when the line is dispatched."""
+    PRIVMSG, MODE, NOTICE = Events.PRIVMSG, Events.MODE, Events.NOTICE
+    parsed_lines = []
+    append = parsed_lines.append
+    for line in lines:
+        prefix, _, message = line.partition(' :')
+        parts = prefix.split(None, 3)
+        num_parts = len(parts)
+        if num_parts == 3:
+            source, command, target = parts
+            args = ''
+        elif num_parts == 4:
+            source, command, target, args = parts
+            args = args.split()
+        elif num_parts == 2:
+            source, command = parts
+            target = args = ''
+        elif num_parts == 1:
+            source, command, target, args = '', parts[0], '', ''
+            if command[:1] == ':':
+                command = command[1:]
         else:
-            split_prefix = irc_protocol_prefix.split()
-    
-    prefix_len = len(split_prefix)
-    
-    if prefix_len == 3:
-        raw_source, command, target = split_prefix
+            source = command = target = args = ''
+        if source[:1] == ':':
+            source = source[1:]
+        if target and not server.actual_host:
+            server.actual_host = source
         
-        if not server.actual_host:
-            server.actual_host = raw_source
-    elif prefix_len == 1:
-        command = split_prefix[0]
-    elif prefix_len == 2:
-        raw_source, command = split_prefix
-    elif prefix_len > 3:
-        (raw_source, command, target), args = (split_prefix[:3],
-                                               split_prefix[3:])
-    
-    if not raw_source or raw_source == server.actual_host:
-        source = raw_source
-    else:
-        source = User.parse_user(raw_source)
-    
-    is_channel = target and target[0] in '#&+!'
-    
-    if command == Events.PRIVMSG and is_channel:
-        command = Events.PUBMSG
-    elif command == Events.MODE and not is_channel:
-        command = Events.UMODE
-    elif command == Events.NOTICE:
-        if is_channel:
-            command = Events.PUBNOTICE
-        else:
-            command = Events.PRIVNOTICE
-    
-    if server.actual_nick and target == server.actual_nick:
-        target = User.parse_user(target)
-    
-    line_info = {
-        'source': source,
-        'command': command,
-        'target': target,
-        'args': args,
-        'message': message.decode('utf-8')
-    }
-    
-    for name, value in line_info.items():
-        if not value:
-            del line_info[name]
-    
-    return line_info
+        is_channel = target and target[0] in '#&+!'
+        
+        if command == PRIVMSG and is_channel:
+            command = Events.PUBMSG
+        elif command == MODE and not is_channel:
+            command = Events.UMODE
+        elif command == NOTICE:
+            if is_channel:
+                command = Events.PUBNOTICE
+            else:
+                command = Events.PRIVNOTICE
+        
+        append(ParsedLine(server, source, command, target, args, message))
+    return parsed_lines
     
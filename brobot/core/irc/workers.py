@@ -0,0 +1,259 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+A small pool of worker threads for the work that must not hold up the main
+loop, such as event plugins fetching web pages or bot commands. Work is
+submitted to lanes: each lane has its own bounded queue and a limit on how many
+of its jobs may run at once, so that one slow plugin cannot take over every
+worker, and a lane that runs one job at a time keeps its jobs in order.
+"""
+
+from collections import deque
+from threading import Condition, Thread, current_thread
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# What a lane does with a new job when its queue is full.
+DROP_OLDEST = 'drop-oldest'
+REJECT = 'reject'
+
+class LaneStats(object):
+    """Counters describing what happened to the jobs of a group of lanes,
+    including how long they waited in the queue and how long they ran."""
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+
+    def record(self, wait_time, run_time, failed):
+        if failed:
+            self.failed += 1
+        else:
+            self.completed += 1
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.run_time += run_time
+        self.max_run_time = max(self.max_run_time, run_time)
+
+    def as_dict(self):
+        finished = self.completed + self.failed
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+            'average_wait_time': self.wait_time / finished if finished else 0.0,
+            'max_wait_time': self.max_wait_time,
+            'average_run_time': self.run_time / finished if finished else 0.0,
+            'max_run_time': self.max_run_time
+        }
+
+
+class Lane(object):
+    """A queue of jobs that share a concurrency limit and an overflow policy.
+    Lanes of the same group share their LaneStats. A transient lane is thrown
+    away as soon as it has nothing left to do."""
+    def __init__(self, name, max_concurrency=1, queue_size=100,
+                 overflow=DROP_OLDEST, group=None, transient=False):
+        if overflow not in (DROP_OLDEST, REJECT):
+            raise ValueError(u'Unknown overflow policy "%s".' % overflow)
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.overflow = overflow
+        if group is None:
+            group = name
+        self.group = group
+        self.transient = transient
+        self.jobs = deque() # (function, args, kwargs, time queued)
+        self.running = 0
+
+    def __repr__(self):
+        return '<Lane %s>' % self.name
+
+    @property
+    def ready(self):
+        return bool(self.jobs) and self.running < self.max_concurrency
+
+    @property
+    def idle(self):
+        return not self.jobs and not self.running
+
+
+class WorkerPool(object):
+    """A fixed number of daemon threads running the jobs of any number of
+    lanes. Lanes are served round-robin, skipping the ones that are already
+    running as many jobs as they may. The threads are started by the first
+    submit."""
+    def __init__(self, num_workers=4, name='worker', clock=time.time):
+        self.num_workers = num_workers
+        self.name = name
+        self.clock = clock
+        self.lanes = {} # name -> Lane
+        self.groups = {} # group -> LaneStats
+        self._order = deque() # lanes, in round-robin order
+        self._condition = Condition()
+        self._threads = []
+        self._stopped = False
+
+    def _lane(self, name, limits):
+        lane = self.lanes.get(name)
+        if lane is None:
+            lane = Lane(name, **limits)
+            self.lanes[name] = lane
+            self._order.append(lane)
+            if lane.group not in self.groups:
+                self.groups[lane.group] = LaneStats()
+        return lane
+
+    def lane(self, name, **limits):
+        """Returns the lane with the given name, creating it with the given
+        limits (see Lane) if it does not exist yet."""
+        with self._condition:
+            return self._lane(name, limits)
+
+    def submit(self, lane, function, *args, **kwargs):
+        """Queues function(*args, **kwargs) on a lane, and returns whether it
+        was accepted. A full lane either drops its oldest job to make room or
+        rejects the new one, depending on its overflow policy."""
+        with self._condition:
+            return self._submit(lane, function, args, kwargs)
+
+    def submit_to(self, name, limits, function, *args, **kwargs):
+        """Like submit, but takes the name of the lane, creating it with the
+        given limits if needed. Meant for transient lanes, which may go away
+        between a call to lane and a call to submit."""
+        with self._condition:
+            return self._submit(self._lane(name, limits), function, args,
+                                kwargs)
+
+    def _submit(self, lane, function, args, kwargs):
+        if self._stopped:
+            return False
+        stats = self.groups[lane.group]
+        if len(lane.jobs) >= lane.queue_size:
+            if lane.overflow == REJECT:
+                stats.rejected += 1
+                return False
+            lane.jobs.popleft()
+            stats.dropped += 1
+        lane.jobs.append((function, args, kwargs, self.clock()))
+        stats.submitted += 1
+        if not self._threads:
+            self._start()
+        self._condition.notify()
+        return True
+
+    def _discard(self, lane):
+        del self.lanes[lane.name]
+        self._order.remove(lane)
+
+    def _start(self):
+        for i in xrange(self.num_workers):
+            thread = Thread(target=self._work, name='%s-%d' % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self):
+        """Takes the next job from the first ready lane in round-robin order,
+        or returns None. Must be called with the condition held."""
+        for _ in xrange(len(self._order)):
+            lane = self._order[0]
+            self._order.rotate(-1)
+            if lane.ready:
+                lane.running += 1
+                return lane, lane.jobs.popleft()
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = None
+                while not self._stopped:
+                    job = self._next_job()
+                    if job is not None:
+                        break
+                    self._condition.wait()
+                if job is None:
+                    return
+
+            lane, (function, args, kwargs, queued) = job
+            started = self.clock()
+            try:
+                function(*args, **kwargs)
+            except Exception:
+                failed = True
+                log.exception(u'Job in lane %s failed.' % lane.name)
+            else:
+                failed = False
+            finished = self.clock()
+
+            with self._condition:
+                lane.running -= 1
+                self.groups[lane.group].record(started - queued,
+                                               finished - started, failed)
+                if lane.jobs:
+                    # The lane may have been at its limit with more jobs
+                    # waiting.
+                    self._condition.notify()
+                elif lane.transient and lane.idle:
+                    self._discard(lane)
+
+    def stop(self):
+        """Drops every queued job and lets the workers exit once they are done
+        with the jobs they are running."""
+        with self._condition:
+            self._stopped = True
+            for lane in self.lanes.itervalues():
+                lane.jobs.clear()
+            self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """Waits up to timeout seconds for each of the workers to exit after
+        stop, so that jobs still running can finish before the process
+        does."""
+        for thread in self._threads:
+            if thread is not current_thread():
+                thread.join(timeout)
+
+    def stats(self):
+        """Returns the stats of every group of lanes, by group, along with how
+        many of its jobs are waiting and running right now."""
+        with self._condition:
+            stats = {}
+            for group, lane_stats in self.groups.iteritems():
+                stats[group] = lane_stats.as_dict()
+                stats[group].update(lanes=0, depth=0, running=0)
+            for lane in self.lanes.itervalues():
+                group = stats[lane.group]
+                group['lanes'] += 1
+                group['depth'] += len(lane.jobs)
+                group['running'] += lane.running
+            return stats
+
@@ -0,0 +1,106 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+The registry of bot commands, which maps every command name to the plugin that
+handles it.
+"""
+
+from threading import Lock
+
+class CommandRegistry(object):
+    """Maps command names, aliases included, to command plugins along with the
+    scopes the plugins answer in, so that finding the plugin for a command is
+    a single dict lookup however many plugins there are. The version goes up
+    with every change, for anything that caches what the commands answer."""
+    PUBLIC = 1 # channel messages
+    PRIVATE = 2 # private messages
+    BOTH = PUBLIC | PRIVATE
+
+    # names used in the settings -> scope
+    SCOPES = {
+        'PUBMSG': PUBLIC,
+        'PRIVMSG': PRIVATE,
+        'BOTH': BOTH
+    }
+
+    def __init__(self):
+        self._commands = {} # name -> tuple of (scope, plugin)
+        self._names = {} # plugin -> tuple of its names, the first one first
+        self._lock = Lock()
+        self.version = 0
+
+    def __contains__(self, name):
+        return name in self._commands
+
+    def register(self, names, plugin, scope=BOTH):
+        """Registers a plugin under its names, the first one being its
+        command and the others aliases. Returns False, registering nothing,
+        if any of the names is already taken in one of the scopes."""
+        names = tuple(names)
+        with self._lock:
+            for name in names:
+                for other_scope, _ in self._commands.get(name, ()):
+                    if other_scope & scope:
+                        return False
+            # A name can still have one plugin for public messages and another
+            # for private ones.
+            for name in names:
+                self._commands[name] = self._commands.get(name, ()) + \
+                        ((scope, plugin),)
+            self._names[plugin] = self._names.get(plugin, ()) + names
+            self.version += 1
+            return True
+
+    def unregister(self, name, scope=None):
+        """Removes the plugins registered under a name, along with all of
+        their other names. Given a scope, only the plugins registered in
+        exactly that scope are removed. Returns whether there were any."""
+        with self._lock:
+            entries = [entry for entry in self._commands.get(name, ())
+                       if scope is None or entry[0] == scope]
+            if not entries:
+                return False
+            for _, plugin in entries:
+                for plugin_name in self._names.pop(plugin, ()):
+                    remaining = tuple(entry for entry in
+                                      self._commands.get(plugin_name, ())
+                                      if entry[1] is not plugin)
+                    if remaining:
+                        self._commands[plugin_name] = remaining
+                    else:
+                        self._commands.pop(plugin_name, None)
+            self.version += 1
+            return True
+
+    def find(self, name, scope=BOTH):
+        """Returns the plugin that answers a command in the given scope, or
+        None."""
+        for plugin_scope, plugin in self._commands.get(name, ()):
+            if plugin_scope & scope == scope:
+                return plugin
+        return None
+
+    def names(self, plugin):
+        """Returns the names of a plugin, its command first."""
+        return self._names.get(plugin, ())
+
+    def plugins(self):
+        """Returns every registered plugin once."""
+        return self._names.keys()
+
@@ -0,0 +1,220 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Support for running the servers of one settings file in several worker
+processes (shards), so that a busy network does not slow down the others. The
+supervisor starts every shard with one end of a socket pair, and relays each
+line a shard writes to all of the shards, which is how admin commands such as
+reboot reach every process.
+"""
+
+from irc.connections import LineBuffer
+import subprocess
+import select
+import fcntl
+import socket
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+SHARD_ENV = 'BROBOT_SHARD'
+IPC_FD_ENV = 'BROBOT_IPC_FD'
+
+def assign_shards(servers, num_shards):
+    """Returns the shard of every server entry in the settings. Entries can
+    pin themselves to a shard with 'shard', and the rest are dealt out to the
+    shards round-robin."""
+    assignments = []
+    i = 0
+    for server in servers:
+        shard = server.get('shard')
+        if shard is None:
+            shard = i % num_shards
+            i += 1
+        elif not 0 <= shard < num_shards:
+            raise ValueError(u'Server "%s" is assigned to shard %d, but there '
+                             u'are only %d shards.' % (server['name'], shard,
+                                                       num_shards))
+        assignments.append(shard)
+    return assignments
+
+def shard_servers(servers, num_shards, shard):
+    """Returns the server entries that belong to the given shard."""
+    assignments = assign_shards(servers, num_shards)
+    return [server for server, assigned in zip(servers, assignments)
+            if assigned == shard]
+
+def _open_fds():
+    try:
+        return [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        return xrange(subprocess.MAXFD)
+
+def _keep_only_fd(keep):
+    """Returns a preexec_fn that makes every descriptor other than the
+    standard streams and keep close when the shard is executed. Marking them
+    close-on-exec rather than closing them leaves the pipe subprocess uses to
+    report a failed exec alone."""
+    def preexec():
+        for fd in _open_fds():
+            if fd <= 2:
+                continue
+            try:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                if fd == keep:
+                    flags &= ~fcntl.FD_CLOEXEC
+                else:
+                    flags |= fcntl.FD_CLOEXEC
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+            except (IOError, OSError):
+                # Not open, such as the one listdir used.
+                pass
+    return preexec
+
+class ShardChannel(object):
+    """A line based message channel between a shard and the supervisor. Each
+    message is a command followed by its space separated arguments."""
+    def __init__(self, sock):
+        self.socket = sock
+        self.input = LineBuffer(4096)
+
+    @classmethod
+    def from_environment(cls):
+        """Returns the channel a shard was started with, or None if this
+        process is not a shard."""
+        fd = os.environ.get(IPC_FD_ENV)
+        if fd is None:
+            return None
+        fd = int(fd)
+        sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(fd)
+        return cls(sock)
+
+    def send(self, command, *args):
+        """Sends a message, returning whether it could be sent."""
+        message = u' '.join((command,) + args)
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        try:
+            self.socket.sendall(message + '\n')
+        except socket.error as error:
+            log.error(unicode(error))
+            return False
+        return True
+
+    def receive(self):
+        """Reads once from the channel and returns the complete messages as
+        lists of words, or None if the other end has gone away."""
+        try:
+            received = self.input.recv_from(self.socket)
+        except socket.error as error:
+            log.error(unicode(error))
+            return None
+        if not received:
+            return None
+        return [line.decode('utf-8').split(u' ')
+                for line in self.input.lines()]
+
+    def close(self):
+        self.socket.close()
+
+
+class Supervisor(object):
+    """Starts one worker process per shard, restarts any worker that exits
+    with the reboot exit code, and relays messages between the workers."""
+    REBOOT_EXIT_CODE = 3
+
+    def __init__(self, args, num_shards):
+        self.args = args
+        self.num_shards = num_shards
+        self.workers = {} # shard -> Popen
+        self.channels = {} # shard -> ShardChannel
+
+    def spawn(self, shard):
+        parent_sock, child_sock = socket.socketpair()
+        env = os.environ.copy()
+        env['RUN_MAIN'] = 'TRUE'
+        env[SHARD_ENV] = str(shard)
+        env[IPC_FD_ENV] = str(child_sock.fileno())
+        # close_fds would close the socket too, so the shard is only handed
+        # its own end of the pair and the standard streams.
+        preexec = _keep_only_fd(child_sock.fileno())
+        self.workers[shard] = subprocess.Popen(self.args, env=env,
+                                               preexec_fn=preexec)
+        child_sock.close()
+        self.channels[shard] = ShardChannel(parent_sock)
+        log.info(u'Started shard %d (pid %d).' % (shard,
+                                                  self.workers[shard].pid))
+
+    def broadcast(self, message):
+        for shard, channel in self.channels.items():
+            if not channel.send(*message):
+                log.error(u'Unable to reach shard %d.' % shard)
+
+    def _drop_channel(self, channel):
+        for shard, other in self.channels.items():
+            if other is channel:
+                del self.channels[shard]
+                channel.close()
+
+    def _reap(self):
+        exit_code = None
+        for shard, worker in self.workers.items():
+            code = worker.poll()
+            if code is None:
+                continue
+            channel = self.channels.pop(shard, None)
+            if channel is not None:
+                channel.close()
+            del self.workers[shard]
+            if code == self.REBOOT_EXIT_CODE:
+                self.spawn(shard)
+            else:
+                log.info(u'Shard %d exited with %d.' % (shard, code))
+                exit_code = code
+        return exit_code
+
+    def run(self):
+        """Runs the shards until every one of them has exited for good, and
+        returns the last exit code."""
+        for shard in xrange(self.num_shards):
+            self.spawn(shard)
+        exit_code = 0
+        while self.workers:
+            sockets = dict((channel.socket, channel)
+                           for channel in self.channels.itervalues())
+            try:
+                readable, _, _ = select.select(sockets.keys(), [], [], 1)
+            except select.error:
+                readable = []
+            for sock in readable:
+                channel = sockets[sock]
+                messages = channel.receive()
+                if messages is None:
+                    # The worker is on its way out; _reap will notice.
+                    self._drop_channel(channel)
+                    continue
+                for message in messages:
+                    self.broadcast(message)
+            code = self._reap()
+            if code is not None:
+                exit_code = code
+        return exit_code
+
@@ -44,10 +44,7 @@ class ConnectPlugin(bot.CommandPlugin):
     admin = True
     def process(self, connection, source, target, args):
         if self.ircbot.is_admin(connection.server, source.nick):
-            name = u' '.join(args)
-            server = self.ircbot.get_server_by_name(name)
-            if server is not None:
-                self.ircbot._connect(server)
+            self.ircbot.connect_server(u' '.join(args))
 
 class QuitPlugin(bot.CommandPlugin):
     name = 'quit'
@@ -66,6 +63,6 @@ class ExitPlugin(bot.CommandPlugin):
     admin = True
     def process(self, connection, source, target, args):
         if self.ircbot.is_admin(connection.server, source.nick):
-            self.ircbot.exit()
+            self.ircbot.shutdown()
         
     
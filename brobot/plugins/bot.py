@@ -20,6 +20,7 @@ from core import bot
 
 class BotPlugin(bot.CommandPlugin):
     name = 'bot'
+    cache_ttl = 3600
     def process(self, connection, source, target, args):
         return self.privmsg(target, ':)')
     
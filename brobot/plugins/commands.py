@@ -20,11 +20,9 @@ from core import bot
 
 class CommandsPlugin(bot.CommandPlugin):
     name = 'commands'
+    cache_ttl = 3600
     def process(self, connection, source, target, args):
-        names = []
-        for plugins in self.ircbot.command_plugins.itervalues():
-            for plugin in plugins.itervalues():
-                if not plugin.admin:
-                    names.append(plugin.name)
+        names = [plugin.name for plugin in self.ircbot.commands.plugins()
+                 if not plugin.admin]
         return self.privmsg(target, u'Commands: %s' % u' '.join(sorted(names)))
     
@@ -20,12 +20,7 @@ from core import bot
 
 class ComposePlugin(bot.CommandPlugin):
     name = 'compose'
-    def find_plugin(self, name, plugins):
-        for commands, plugin in plugins:
-            if name in commands:
-                return plugin
-        return None
-    
+
     def process(self, connection, source, target, args):
         args_len = len(args)
         if args_len < 2:
@@ -42,13 +37,12 @@ class ComposePlugin(bot.CommandPlugin):
         if args_len < num_args:
             return None
         
-        plugins = self.ircbot.command_plugins['BOTH'].items()
         funcs, func_args = args[:num_args], args[num_args:]
         
         plugin_stack = []
         
         for func in funcs:
-            plugin = self.find_plugin(func, plugins)
+            plugin = self.ircbot.commands.find(func)
             if plugin is None:
                 return None
             plugin_stack.insert(0, plugin)
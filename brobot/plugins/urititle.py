@@ -17,6 +17,7 @@
 #===============================================================================
 
 from core import bot
+from core.irc.flood import BULK
 import re
 import urllib
 import logging
@@ -32,6 +33,8 @@ urllib._urlopener = FirefoxURLopener()
 
 class URITitlePlugin(bot.EventPlugin):
     name = 'uri-title'
+    max_concurrency = 2
+    queue_size = 20
     URI_RE = re.compile(r'https?://[A-Za-z0-9:\-\.\'_/&%#!=?,+*;~\$\[\]]+')
     def get_title(self, uri):
         try:
@@ -48,5 +51,5 @@ class URITitlePlugin(bot.EventPlugin):
             
             if title is not None:
                 self.ircbot.privmsg(connection, target, '\x02Title:\x02 ' + \
-                                    title.encode('utf-8'))
+                                    title.encode('utf-8'), priority=BULK)
     
@@ -20,6 +20,7 @@ from core import bot
 
 class VersionPlugin(bot.CommandPlugin):
     name = 'version'
+    cache_ttl = 3600
     def process(self, connection, source, target, args):
         return self.privmsg(target, self.ircbot.get_version())
     
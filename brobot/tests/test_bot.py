@@ -0,0 +1,291 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Tests for the IRCBot's handling of commands, on a bot built from settings in
+a temporary directory that never connects.
+"""
+
+from core.bot import IRCBot, CommandPlugin
+from core import bot as bot_module
+from core.irc.structures import User
+from core.registry import CommandRegistry
+import logging
+import tempfile
+import shutil
+import unittest
+
+class FakeConnection(object):
+    def __init__(self, server):
+        self.server = server
+
+
+class Echo(CommandPlugin):
+    name = 'echo'
+
+    def process(self, connection, source, target, args):
+        return self.privmsg(target, u' '.join(args))
+
+
+class BotTestCase(unittest.TestCase):
+    """Builds a bot named Bot[ on a server named test, with an echo command.
+    Settings for the bot can be overridden by the settings attribute."""
+    settings = {}
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        root_logger = logging.getLogger('')
+        self.handlers = root_logger.handlers[:]
+        self.level = root_logger.level
+        settings = {
+            'base_path': self.path,
+            'data_path': 'data',
+            'pid_filename': 'brobot.pid',
+            'log_filename': 'brobot.log',
+            'debug': False,
+            'servers': [{
+                'name': 'test',
+                'host': 'irc.example.net',
+                'port': 6667,
+                'ssl': False,
+                'nick': 'Bot[',
+                'owner': 'Admin[',
+                'admins': ['Admin[', 'other'],
+                'channels': []
+            }],
+            'plugin_path': 'plugins',
+            'event_plugins': [],
+            'command_plugins': {},
+            'command_prefix': '!',
+            'version_string': 'brobot test'
+        }
+        settings.update(self.settings)
+        self.bot = IRCBot(settings)
+        self.server = self.bot.get_server_by_name('test')
+        self.server.actual_nick = self.server.nick
+        self.connection = FakeConnection(self.server)
+        self.echo = Echo(self.bot)
+        self.bot.commands.register(('echo',), self.echo)
+        self.submitted = [] # lanes of the commands given to the workers
+        self.bot.command_workers.submit_to = self.submit_to
+
+    def tearDown(self):
+        self.bot.exit()
+        root_logger = logging.getLogger('')
+        for handler in root_logger.handlers[:]:
+            if handler not in self.handlers:
+                root_logger.removeHandler(handler)
+                handler.close()
+        root_logger.setLevel(self.level)
+        shutil.rmtree(self.path)
+
+    def submit_to(self, lane, limits, function, *args):
+        self.submitted.append(lane)
+        return True
+
+    def pubmsg(self, target, message, source='Foo!u@h'):
+        self.bot.on_pubmsg(self.connection, User.parse_user(source), target,
+                           message)
+
+
+class CaseMappingTest(BotTestCase):
+    settings = {
+        'command_limits': {
+            'user': None,
+            'channel': {'rate': 0.001, 'burst': 1},
+            'silent': True
+        }
+    }
+
+    def test_addressed_by_nick(self):
+        strip = self.bot.strip_command_prefix
+        self.assertEqual(strip(self.connection, u'bot{: echo hi'),
+                         u'echo hi')
+        self.server.isupport.update(['CASEMAPPING=ascii'])
+        self.assertEqual(strip(self.connection, u'bot{: echo hi'), None)
+        self.assertEqual(strip(self.connection, u'BOT[, echo hi'),
+                         u'echo hi')
+
+    def test_channel_lane(self):
+        self.pubmsg('#Chan[', u'!echo one')
+        self.server.isupport.update(['CASEMAPPING=ascii'])
+        self.pubmsg('#Other[', u'!echo two')
+        self.assertEqual(self.submitted, [('test', '#chan{'),
+                                          ('test', '#other[')])
+
+    def test_channel_limit(self):
+        self.pubmsg('#Chan[', u'!echo one')
+        self.pubmsg('#chan{', u'!echo two')
+        self.assertEqual(len(self.submitted), 1)
+        self.server.isupport.update(['CASEMAPPING=ascii'])
+        self.pubmsg('#Other[', u'!echo three')
+        self.pubmsg('#other{', u'!echo four')
+        self.pubmsg('#OTHER[', u'!echo five')
+        self.assertEqual(self.submitted[1:], [('test', '#other['),
+                                              ('test', '#other{')])
+
+    def test_is_admin(self):
+        self.assertTrue(self.bot.is_admin(self.server, 'admin{'))
+        self.assertTrue(self.bot.is_admin(self.server, 'OTHER'))
+        self.assertFalse(self.bot.is_admin(self.server, 'foo'))
+        # The admin keys are rebuilt for the new casemapping.
+        self.server.isupport.update(['CASEMAPPING=ascii'])
+        self.assertFalse(self.bot.is_admin(self.server, 'admin{'))
+        self.assertTrue(self.bot.is_admin(self.server, 'ADMIN['))
+
+
+class CommandPrefixTest(BotTestCase):
+    settings = {'command_prefix': ['!', '!!']}
+
+    def find(self, message, is_pubmsg=True):
+        return self.bot.find_command(self.connection, message, is_pubmsg)
+
+    def test_prefixes(self):
+        self.assertEqual(self.bot.command_prefixes, ('!!', '!'))
+        self.assertEqual(self.find(u'!echo hi'), (self.echo, [u'hi']))
+        self.assertEqual(self.find(u'!!echo hi'), (self.echo, [u'hi']))
+        self.assertEqual(self.find(u'!!!echo hi'), None)
+        self.assertEqual(self.find(u'?echo hi'), None)
+
+    def test_addressed_by_nick(self):
+        for message in (u'Bot[: echo hi', u'bot{, echo hi', u'BOT[:echo hi'):
+            self.assertEqual(self.find(message), (self.echo, [u'hi']))
+        self.assertEqual(self.find(u'Bot[ echo hi'), None)
+        self.assertEqual(self.find(u'Bot: echo hi'), None)
+        self.assertEqual(self.find(u'bot{{: echo hi'), None)
+
+    def test_addressed_after_a_nick_change(self):
+        self.server.actual_nick = 'Other'
+        self.assertEqual(self.find(u'other: echo hi'), (self.echo, [u'hi']))
+        self.assertEqual(self.find(u'bot[: echo hi'), None)
+
+    def test_unknown_command(self):
+        self.assertEqual(self.find(u'!nothing'), None)
+        self.assertEqual(self.find(u''), None)
+
+    def test_chat_is_not_submitted(self):
+        for message in (u'hello there', u'bot is here', u'! echo',
+                        u'!nothing at all', u'Bot[ echo hi'):
+            self.pubmsg('#chan', message)
+        self.assertEqual(self.submitted, [])
+        self.pubmsg('#chan', u'!!echo hi')
+        self.bot.on_privmsg(self.connection, User.parse_user('Foo!u@h'),
+                            'Bot[', u'bot{: echo hi')
+        self.assertEqual(self.submitted, [('test', '#chan'), ('test', 'foo')])
+
+
+class RegisterTest(BotTestCase):
+    def test_register_command_plugin(self):
+        self.assertFalse(self.bot.register_command_plugin('echo', Echo))
+        self.assertTrue(self.bot.register_command_plugin('again', Echo))
+        plugin = self.bot.commands.find('again')
+        self.assertTrue(isinstance(plugin, Echo))
+        self.assertTrue(self.bot.unregister_command_plugin('again'))
+        self.assertFalse('again' in self.bot.commands)
+
+    def test_unregister_only_in_both_scopes(self):
+        self.bot.commands.register(('users',), Echo(self.bot),
+                                   CommandRegistry.PUBLIC)
+        self.assertFalse(self.bot.unregister_command_plugin('users'))
+        self.assertTrue('users' in self.bot.commands)
+
+
+class FakeTime(object):
+    """Stands in for the time module in core.bot."""
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class Counter(CommandPlugin):
+    name = 'counter'
+    cache_ttl = 10
+
+    def load(self):
+        self.calls = 0
+
+    def process(self, connection, source, target, args):
+        self.calls += 1
+        return self.privmsg(target, unicode(self.calls))
+
+
+class CachedProcessTest(BotTestCase):
+    def setUp(self):
+        super(CachedProcessTest, self).setUp()
+        self.time = bot_module.time
+        self.clock = bot_module.time = FakeTime()
+        self.counter = Counter(self.bot)
+        self.bot.commands.register(('count',), self.counter)
+        self.source = User.parse_user('Foo!u@h')
+
+    def tearDown(self):
+        bot_module.time = self.time
+        super(CachedProcessTest, self).tearDown()
+
+    def count(self, *args):
+        result = self.counter._cached_process(self.connection, self.source,
+                                              '#chan', list(args))
+        return result['message']
+
+    def test_hits(self):
+        self.assertEqual(self.count(u'a'), u'1')
+        self.assertEqual(self.count(u'a'), u'1')
+        self.assertEqual(self.count(u'b'), u'2')
+        self.assertEqual(self.count(u'a'), u'1')
+        stats = self.counter.cache_stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses']),
+                         (2, 2, 2))
+        self.assertAlmostEqual(stats['hit_ratio'], 0.5)
+        self.assertEqual(self.bot.command_cache_stats(), {'counter': stats})
+
+    def test_ttl(self):
+        self.assertEqual(self.count(), u'1')
+        self.clock.now += 9.5
+        self.assertEqual(self.count(), u'1')
+        self.clock.now += 1
+        self.assertEqual(self.count(), u'2')
+        self.assertEqual(self.count(), u'2')
+        stats = self.counter.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+
+    def test_registry_change_clears_the_cache(self):
+        self.assertEqual(self.count(), u'1')
+        self.bot.register_command_plugin('again', Echo)
+        self.assertEqual(self.count(), u'2')
+        self.assertEqual(self.count(), u'2')
+        self.bot.unregister_command_plugin('again')
+        self.assertEqual(self.count(), u'3')
+        stats = self.counter.cache_stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses']),
+                         (1, 1, 3))
+        self.assertAlmostEqual(stats['hit_ratio'], 0.25)
+
+    def test_without_ttl(self):
+        self.counter.cache_ttl = None
+        self.assertEqual(self.count(), u'1')
+        self.assertEqual(self.count(), u'2')
+        self.assertEqual(self.counter.cache_stats(),
+                         {'size': 0, 'hits': 0, 'misses': 0,
+                          'hit_ratio': 0.0})
+        self.assertEqual(self.bot.command_cache_stats(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
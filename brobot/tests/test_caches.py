@@ -0,0 +1,107 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Tests for the LRUCache and the hostmask cache of User.parse_user.
+"""
+
+from core.irc.caches import LRUCache
+from core.irc.structures import User, RFC1459, ASCII
+import unittest
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_the_oldest_unused_entry(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache.put(key, key.upper())
+        cache.put('d', 'D')
+        self.assertEqual(sorted(cache._links), ['b', 'c', 'd'])
+
+    def test_used_entries_get_a_second_chance(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache.put(key, key.upper())
+        self.assertEqual(cache.get('a'), 'A')
+        cache.put('d', 'D')
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        # a has used up its chance, and is the oldest again after c.
+        cache.put('e', 'E')
+        cache.put('f', 'F')
+        self.assertEqual(sorted(cache._links), ['d', 'e', 'f'])
+
+    def test_all_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.get('b')
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_put_replaces(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('a', 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_stats(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertAlmostEqual(stats['hit_ratio'], 2 / 3.0)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a'), None)
+
+
+class ParseUserTest(unittest.TestCase):
+    def setUp(self):
+        User.identities.clear()
+
+    def test_cached_users_are_not_shared(self):
+        first = User.parse_user('Nick!~user@host')
+        second = User.parse_user('Nick!~user@host')
+        self.assertFalse(first is second)
+        self.assertEqual((second.nick, second.key, second.username,
+                          second.host), ('Nick', 'nick', '~user', 'host'))
+        self.assertEqual(second.status, User.STATUSES[User.NORMAL])
+        first.status |= User.STATUSES[User.OP]
+        self.assertEqual(second.status, User.STATUSES[User.NORMAL])
+
+    def test_casemapping_is_part_of_the_entry(self):
+        self.assertEqual(User.parse_user('Nick[]!u@h', RFC1459).key,
+                         'nick{}')
+        self.assertEqual(User.parse_user('Nick[]!u@h', ASCII).key, 'nick[]')
+        self.assertEqual(User.parse_user('Nick[]!u@h', RFC1459).key,
+                         'nick{}')
+
+    def test_without_host(self):
+        user = User.parse_user('irc.example.net')
+        self.assertEqual((user.nick, user.username, user.host),
+                         ('irc.example.net', '', ''))
+
+
+if __name__ == '__main__':
+    unittest.main()
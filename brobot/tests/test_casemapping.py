@@ -0,0 +1,103 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Tests for the casemappings a server can advertise, and for looking channels
+and users up once one has been advertised.
+"""
+
+from core.irc.clients import Client
+from core.irc.connections import Connection
+from core.irc.structures import Server, User, ASCII, RFC1459, STRICT_RFC1459
+import socket
+import unittest
+
+class CaseMappingTest(unittest.TestCase):
+    def test_rfc1459(self):
+        self.assertEqual(RFC1459.lower('Nick[]\\~'), 'nick{}|^')
+        self.assertEqual(RFC1459.lower(u'Nick[]\\~'), u'nick{}|^')
+
+    def test_strict_rfc1459(self):
+        self.assertEqual(STRICT_RFC1459.lower('Nick[]\\~'), 'nick{}|~')
+        self.assertEqual(STRICT_RFC1459.lower(u'Nick[]\\~'), u'nick{}|~')
+
+    def test_ascii(self):
+        self.assertEqual(ASCII.lower('Nick[]\\~'), 'nick[]\\~')
+        self.assertEqual(ASCII.lower(u'Nick[]\\~'), u'nick[]\\~')
+
+    def test_isupport(self):
+        server = Server('irc.example.net', 6667, 'bot')
+        self.assertTrue(server.isupport.casemapping is RFC1459)
+        server.isupport.update(['CASEMAPPING=strict-rfc1459'])
+        self.assertTrue(server.isupport.casemapping is STRICT_RFC1459)
+        server.isupport.update(['CASEMAPPING=ascii'])
+        self.assertEqual(server.lower('#Chan[]'), '#chan[]')
+        # Unknown casemappings fall back to rfc1459.
+        server.isupport.update(['CASEMAPPING=unknown'])
+        self.assertTrue(server.isupport.casemapping is RFC1459)
+
+
+class LookupTest(unittest.TestCase):
+    """Channels and users are found by the keys of the server's casemapping,
+    as the 005 it sent set it."""
+    def setUp(self):
+        self.server = Server('irc.example.net', 6667, 'bot')
+        self.client = Client([self.server])
+        self.peer, sock = socket.socketpair()
+        self.connection = Connection(self.server, sock)
+        self.event_manager = self.client.connection_manager.event_manager
+
+    def tearDown(self):
+        self.client.exit()
+        self.connection.socket.close()
+        self.peer.close()
+
+    def read(self, *lines):
+        self.peer.sendall(''.join(line + '\r\n' for line in lines))
+        self.connection.process(self.event_manager)
+
+    def join(self, isupport):
+        self.read(':irc.example.net 001 bot :Welcome',
+                  ':irc.example.net 005 bot %s :are supported' % isupport,
+                  ':bot!~bot@host JOIN :#Chan[',
+                  ':irc.example.net 353 bot = #Chan[ :@Foo[ Bar\\',
+                  ':irc.example.net 366 bot #Chan[ :End of /NAMES list.')
+        return self.client.find_channel(self.server, '#Chan[')
+
+    def test_ascii(self):
+        channel = self.join('CASEMAPPING=ascii')
+        self.assertTrue(self.client.find_channel(self.server, '#CHAN[')
+                        is channel)
+        self.assertEqual(self.client.find_channel(self.server, '#chan{'),
+                         None)
+        self.assertEqual(channel.find_user('FOO[').nick, 'Foo[')
+        self.assertEqual(channel.find_user('foo{'), None)
+        self.assertEqual(channel.find_user('bar|'), None)
+        self.assertEqual([joined.key for joined in
+                          self.server.users.channels('foo[')], ['#chan['])
+
+    def test_rfc1459(self):
+        channel = self.join('PREFIX=(ov)@+')
+        self.assertTrue(self.client.find_channel(self.server, '#chan{')
+                        is channel)
+        self.assertEqual(channel.find_user('foo{').nick, 'Foo[')
+        self.assertEqual(channel.find_user('BAR|').nick, 'Bar\\')
+
+
+if __name__ == '__main__':
+    unittest.main()
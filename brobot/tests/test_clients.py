@@ -0,0 +1,141 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Tests for how the Client keeps its channels and the server's UserRegistry up
+to date as users join, part, quit and change nicks.
+"""
+
+from core.irc.clients import Client
+from core.irc.connections import Connection
+from core.irc.events import Events
+from core.irc.structures import Server, Channel
+import socket
+import unittest
+
+class MembershipTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server('irc.example.net', 6667, 'bot')
+        self.client = Client([self.server])
+        self.peer, sock = socket.socketpair()
+        self.connection = Connection(self.server, sock)
+        self.event_manager = self.client.connection_manager.event_manager
+        self.read(':irc.example.net 001 bot :Welcome')
+        for name, names in (('#a', 'Foo bar'), ('#b', 'Foo'), ('#c', 'bar')):
+            self.read(':bot!~bot@host JOIN :' + name,
+                      ':irc.example.net 353 bot = %s :bot %s' % (name, names),
+                      ':irc.example.net 366 bot %s :End of /NAMES list.' %
+                      name)
+
+    def tearDown(self):
+        self.client.exit()
+        self.connection.socket.close()
+        self.peer.close()
+
+    def read(self, *lines):
+        self.peer.sendall(''.join(line + '\r\n' for line in lines))
+        self.connection.process(self.event_manager)
+
+    def roster(self, name):
+        return sorted(self.client.find_channel(self.server, name).roster)
+
+    def channels(self, key):
+        return sorted(channel.key for channel in
+                      self.server.users.channels(key))
+
+    def test_quit_touches_only_member_channels(self):
+        touched = []
+        remove_user = Channel.remove_user
+        def record(channel, user):
+            touched.append(channel.key)
+            remove_user(channel, user)
+        Channel.remove_user = record
+        try:
+            self.read(':Foo!u@h QUIT :bye')
+        finally:
+            Channel.remove_user = remove_user
+        self.assertEqual(sorted(touched), ['#a', '#b'])
+        self.assertEqual(self.roster('#a'), ['bar', 'bot'])
+        self.assertEqual(self.roster('#b'), ['bot'])
+        self.assertFalse('foo' in self.server.users)
+
+    def test_nick_renames_in_every_channel(self):
+        self.read(':Foo!u@h NICK :Baz')
+        self.assertEqual(self.roster('#a'), ['bar', 'baz', 'bot'])
+        self.assertEqual(self.roster('#b'), ['baz', 'bot'])
+        self.assertEqual(self.channels('baz'), ['#a', '#b'])
+        self.assertFalse('foo' in self.server.users)
+
+    def test_nick_changes_case(self):
+        self.read(':Foo!u@h NICK :foo')
+        for name in ('#a', '#b'):
+            channel = self.client.find_channel(self.server, name)
+            self.assertEqual(channel.find_user('FOO').nick, 'foo')
+        self.assertEqual(self.channels('foo'), ['#a', '#b'])
+
+    def test_own_nick(self):
+        self.read(':bot!~bot@host NICK :Bot2')
+        self.assertEqual(self.server.actual_nick, 'Bot2')
+        self.assertEqual(self.roster('#c'), ['bar', 'bot2'])
+        self.assertEqual(self.channels('bot2'), ['#a', '#b', '#c'])
+        # Lines are addressed to the new nick from now on.
+        self.read(':Bot2!~bot@host PART #c')
+        self.assertEqual(self.client.find_channel(self.server, '#c'), None)
+
+    def test_own_part_clears_the_channel(self):
+        self.read(':bot!~bot@host PART #a', ':bot!~bot@host PART #c')
+        self.assertEqual(self.client.find_channel(self.server, '#a'), None)
+        self.assertEqual(self.channels('bar'), [])
+        self.assertEqual(self.channels('foo'), ['#b'])
+        self.read(':bot!~bot@host PART #b')
+        self.assertEqual(len(self.server.users), 0)
+
+    def test_reset_drops_the_channels(self):
+        self.client._reset_server(self.server)
+        self.assertEqual(self.client.get_server_channels(self.server), [])
+        self.assertEqual(self.client.find_channel(self.server, '#a'), None)
+        self.assertEqual(len(self.server.users), 0)
+
+
+class Unnamed(object):
+    name = 'unnamed'
+
+    def process(self, connection, message):
+        pass
+
+
+class AlsoUnnamed(Unnamed):
+    pass
+
+
+class PluginLaneTest(unittest.TestCase):
+    def test_lanes_are_keyed_by_class(self):
+        first, second = Unnamed(), AlsoUnnamed()
+        client = Client([Server('irc.example.net', 6667, 'bot')],
+                        {Events.PUBMSG: [first, second],
+                         Events.JOIN: [first]})
+        try:
+            lanes = client.connection_manager.event_manager.workers.lanes
+            self.assertEqual(sorted(lanes), ['tests.test_clients.AlsoUnnamed',
+                                             'tests.test_clients.Unnamed'])
+        finally:
+            client.exit()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,276 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Tests for connecting and reconnecting, against listeners on the loopback
+interface.
+"""
+
+from core.irc.clients import Client
+from core.irc.connections import Connection
+from core.irc.events import Events
+from core.irc.flood import BULK
+from core.irc.structures import Server
+from core.irc import clients
+from threading import Thread, Event
+import unittest
+import socket
+import time
+
+WELCOME = ':irc.test 001 bot :Welcome\r\n'
+
+class Listener(object):
+    """Accepts connections on a free loopback port from a thread, sending
+    each one the given lines and then closing it if close is set. With
+    answer unset, connections are accepted and left silent."""
+    def __init__(self, lines=WELCOME, close=False, answer=True):
+        self.lines = lines
+        self.close = close
+        self.answer = answer
+        self.accepted = []
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.accepted.append(client)
+            if self.answer:
+                client.sendall(self.lines)
+                if self.close:
+                    time.sleep(0.05)
+                    client.close()
+
+    def stop(self):
+        self.sock.close()
+        for client in self.accepted:
+            client.close()
+
+
+def free_port():
+    """Returns a loopback port that nothing listens on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ConnectTest(unittest.TestCase):
+    def setUp(self):
+        self.retries = [] # delays of the scheduled retries
+        # The largest delay the jitter allows, so that they can be compared.
+        self._uniform = clients.random.uniform
+        clients.random.uniform = lambda low, high: high
+
+    def tearDown(self):
+        clients.random.uniform = self._uniform
+        self.client.exit()
+
+    def connect(self, server):
+        self.client = client = Client([server])
+        manager = client.connection_manager
+        call_later = manager.call_later
+        def spy(delay, function, *args):
+            if function == client._connect:
+                self.retries.append(delay)
+            return call_later(delay, function, *args)
+        manager.call_later = spy
+        client._connect(server)
+        return client
+
+    def run_loop(self, until, timeout=5):
+        """Runs the main loop until the condition holds, and returns the
+        longest time a single pass took."""
+        worst = 0
+        deadline = time.time() + timeout
+        while not until() and time.time() < deadline:
+            started = time.time()
+            self.client.connection_manager.process(0.05)
+            worst = max(worst, time.time() - started)
+        return worst
+
+    def test_welcome(self):
+        listener = Listener()
+        self.addCleanup(listener.stop)
+        server = Server('127.0.0.1', listener.port, 'bot')
+        self.connect(server)
+        self.run_loop(lambda: server.welcome_delay is not None)
+        self.assertTrue(server.welcome_delay is not None)
+        self.assertTrue(server.welcome_delay < 1)
+        self.assertEqual(len(self.client.connection_manager.connections), 1)
+
+    def test_backoff(self):
+        server = Server('127.0.0.1', free_port(), 'bot',
+                        reconnect={'initial_delay': 0.05, 'max_delay': 0.15,
+                                   'max_retries': 3})
+        client = self.connect(server)
+        self.run_loop(lambda: client._connect_failures.get(server) == 4)
+        self.assertEqual(self.retries, [0.05, 0.1, 0.15])
+        self.assertEqual(client._connect_failures[server], 4)
+        self.assertFalse(server in client._connecting)
+
+    def test_reconnect_after_close(self):
+        listener = Listener(close=True)
+        self.addCleanup(listener.stop)
+        server = Server('127.0.0.1', listener.port, 'bot',
+                        reconnect={'initial_delay': 0.05})
+        self.connect(server)
+        self.run_loop(lambda: len(listener.accepted) >= 2)
+        self.assertTrue(len(listener.accepted) >= 2)
+        self.assertTrue(self.retries)
+
+    def test_slow_resolver(self):
+        listener = Listener()
+        self.addCleanup(listener.stop)
+        getaddrinfo = socket.getaddrinfo
+        def slow_getaddrinfo(*args):
+            time.sleep(0.5)
+            return getaddrinfo(*args)
+        socket.getaddrinfo = slow_getaddrinfo
+        self.addCleanup(setattr, socket, 'getaddrinfo', getaddrinfo)
+        server = Server('127.0.0.1', listener.port, 'bot')
+        self.connect(server)
+        worst = self.run_loop(lambda: server.welcome_delay is not None)
+        self.assertTrue(server.welcome_delay is not None)
+        self.assertTrue(worst < 0.25, worst)
+
+    def test_stalled_handshake(self):
+        listener = Listener(answer=False)
+        self.addCleanup(listener.stop)
+        server = Server('127.0.0.1', listener.port, 'bot', use_ssl=True,
+                        ssl_options={'verify': False},
+                        reconnect={'timeout': 0.5, 'max_retries': 0})
+        client = self.connect(server)
+        worst = self.run_loop(lambda: server in client._connect_failures)
+        self.assertEqual(client._connect_failures.get(server), 1)
+        self.assertTrue(worst < 0.25, worst)
+
+
+class DisconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server('irc.example.net', 6667, 'bot')
+        self.client = Client([self.server], {})
+        self.manager = self.client.connection_manager
+        self.peers = []
+
+    def tearDown(self):
+        self.client.exit()
+        for peer in self.peers:
+            peer.close()
+
+    def connect(self):
+        peer, sock = socket.socketpair()
+        self.peers.append(peer)
+        connection = Connection(self.server, sock)
+        self.manager.register(connection)
+        return connection, peer, sock
+
+    def test_backlog_is_dropped(self):
+        connection, peer, _ = self.connect()
+        for i in xrange(100):
+            connection.output.put('PRIVMSG #chan :%d\r\n' % i, BULK)
+        self.manager.disconnect(connection, u'bye')
+        peer.settimeout(5)
+        received = ''
+        while True:
+            data = peer.recv(4096)
+            if not data:
+                break
+            received += data
+        self.assertFalse('PRIVMSG' in received)
+        self.assertTrue(received.endswith('QUIT :bye\r\n'))
+
+    def test_full_sockets_share_one_deadline(self):
+        for _ in xrange(3):
+            connection, _, sock = self.connect()
+            sock.setblocking(0)
+            try:
+                while True:
+                    sock.send('x' * 65536)
+            except socket.error:
+                pass
+            connection.send('PONG :irc.example.net')
+        started = time.time()
+        self.manager.exit()
+        self.assertTrue(time.time() - started < Connection.CLOSE_TIMEOUT + 0.5)
+        self.assertEqual(len(self.manager.connections), 0)
+
+
+class SlowPlugin(object):
+    """Takes 5 seconds over every message, unless it is released."""
+    def __init__(self):
+        self.started = Event()
+        self.release = Event()
+
+    def process(self, connection, source, target, message):
+        self.started.set()
+        self.release.wait(5)
+
+
+class SlowPluginTest(unittest.TestCase):
+    def setUp(self):
+        self.plugin = SlowPlugin()
+        self.server = Server('irc.example.net', 6667, 'bot')
+        self.client = Client([self.server],
+                             {Events.PUBMSG: [self.plugin]})
+        self.peer, sock = socket.socketpair()
+        self.peer.settimeout(5)
+        self.client.connection_manager.register(Connection(self.server,
+                                                           sock))
+
+    def tearDown(self):
+        self.plugin.release.set()
+        self.client.exit()
+        self.peer.close()
+
+    def test_ping_is_answered_while_a_plugin_sleeps(self):
+        manager = self.client.connection_manager
+        self.peer.sendall(':nick!~user@host PRIVMSG #chan :hello\r\n')
+        deadline = time.time() + 2
+        while not self.plugin.started.is_set() and time.time() < deadline:
+            manager.process(0.05)
+        self.assertTrue(self.plugin.started.is_set())
+
+        started = time.time()
+        self.peer.sendall('PING :token\r\n')
+        received = ''
+        while 'PONG' not in received and time.time() - started < 2:
+            manager.process(0.05)
+            self.peer.setblocking(0)
+            try:
+                received += self.peer.recv(4096)
+            except socket.error:
+                pass
+            self.peer.settimeout(5)
+        self.assertTrue(':token' in received.split('PONG', 1)[-1])
+        self.assertTrue(time.time() - started < 1)
+        self.assertFalse(self.plugin.release.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Tests for parsing a batch of lines and dispatching it to the event hooks.
+"""
+
+from core.irc.clients import Client
+from core.irc.connections import Connection
+from core.irc.events import Events, EventManager, EventHook, IRCError
+from core.irc.structures import Server, User
+from core.irc.utils import parse_irc_lines
+import logging
+import socket
+import unittest
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server('irc.example.net', 6667, 'bot')
+        self.server.actual_nick = 'bot'
+        self.server.actual_host = 'irc.example.net'
+
+    def parse(self, line):
+        return parse_irc_lines(self.server, [line])[0]
+
+    def test_privmsg(self):
+        line = self.parse(':nick!~user@host PRIVMSG #chan :hi :there')
+        self.assertEqual(line.command, Events.PUBMSG)
+        self.assertEqual(line.source.nick, 'nick')
+        self.assertEqual(line.source.host, 'host')
+        self.assertEqual(line.target, '#chan')
+        self.assertEqual(line.message, u'hi :there')
+
+    def test_args(self):
+        line = self.parse(':irc.example.net 005 bot PREFIX=(ov)@+ '
+                          'CHANTYPES=# :are supported by this server')
+        self.assertEqual(line.source, 'irc.example.net')
+        self.assertEqual(line.command, Events.RPL_BOUNCE)
+        self.assertEqual(line.target.nick, 'bot')
+        self.assertEqual(line.args, ['PREFIX=(ov)@+', 'CHANTYPES=#'])
+
+    def test_without_source(self):
+        line = self.parse('PING :irc.example.net')
+        self.assertEqual(line.source, '')
+        self.assertEqual(line.command, Events.PING)
+        self.assertEqual(line.message, u'irc.example.net')
+
+    def test_without_message(self):
+        line = self.parse(':nick!~user@host MODE #chan +o-v a b')
+        self.assertEqual(line.command, Events.MODE)
+        self.assertEqual(line.args, ['+o-v', 'a', 'b'])
+        self.assertEqual(line.raw_message, '')
+
+    def test_batch(self):
+        lines = parse_irc_lines(self.server, [
+            ':a!u@h JOIN :#chan',
+            ':b!u@h JOIN :#chan',
+            ':irc.example.net NOTICE bot :hello',
+        ])
+        self.assertEqual([line.command for line in lines],
+                         [Events.JOIN, Events.JOIN, Events.PRIVNOTICE])
+        self.assertEqual([line.source.nick for line in lines[:2]], ['a', 'b'])
+
+
+class HookAllTest(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger('core.irc.events').disabled = True
+        self.addCleanup(setattr, logging.getLogger('core.irc.events'),
+                        'disabled', False)
+        self.server = Server('irc.example.net', 6667, 'bot')
+        self.lines = parse_irc_lines(self.server, [
+            ':a!u@h JOIN :#one',
+            ':b!u@h JOIN :#two',
+            ':c!u@h JOIN :#three',
+        ])
+
+    def fail_on_two(self, connection, message):
+        if message == u'#two':
+            raise IRCError('no such channel')
+
+    def test_error_skips_only_its_line(self):
+        seen = []
+        manager = EventManager({
+            Events.JOIN: EventHook(lambda connection, message:
+                                   seen.append(message), message=True),
+        })
+        manager.add_hook(Events.JOIN, EventHook(self.fail_on_two,
+                                                message=True))
+        manager.add_hook(Events.JOIN, EventHook(lambda connection, message:
+                                                seen.append(message.upper()),
+                                                message=True))
+        manager.hook_all(Events.JOIN, None, self.lines)
+        self.assertEqual(seen, [u'#one', u'#ONE', u'#two', u'#three',
+                                u'#THREE'])
+
+    def test_single_hook(self):
+        seen = []
+        def hook(connection, message):
+            self.fail_on_two(connection, message)
+            seen.append(message)
+        manager = EventManager({Events.JOIN: EventHook(hook, message=True)})
+        manager.hook_all(Events.JOIN, None, self.lines)
+        self.assertEqual(seen, [u'#one', u'#three'])
+
+
+class BatchStateTest(unittest.TestCase):
+    """Lines that change the server's state, such as 001 and 005, must be
+    seen by the lines after them in the same read."""
+    def setUp(self):
+        self.server = Server('irc.example.net', 6667, 'bot')
+        self.client = Client([self.server])
+        self.peer, sock = socket.socketpair()
+        self.connection = Connection(self.server, sock)
+        self.targets = []
+        self.event_manager = self.client.connection_manager.event_manager
+        self.event_manager.add_hook(Events.RPL_YOURHOST,
+                                    EventHook(self.record_target, target=True))
+
+    def tearDown(self):
+        self.client.exit()
+        self.connection.socket.close()
+        self.peer.close()
+
+    def record_target(self, connection, target):
+        self.targets.append(target)
+
+    def read(self, *lines):
+        """Makes the connection read all of the lines at once."""
+        self.peer.sendall(''.join(line + '\r\n' for line in lines))
+        self.connection.process(self.event_manager)
+
+    def test_isupport_and_join_in_one_read(self):
+        self.read(':irc.example.net 001 bot :Welcome',
+                  ':irc.example.net 002 bot :Your host is irc.example.net',
+                  ':irc.example.net 005 bot CASEMAPPING=ascii PREFIX=(ov)@+ '
+                  ':are supported by this server',
+                  ':bot!~bot@host JOIN :#chan',
+                  ':irc.example.net 353 bot = #chan :@Foo[ bar',
+                  ':irc.example.net 366 bot #chan :End of /NAMES list.',
+                  ':Foo[!u@h JOIN :#chan')
+        self.assertEqual(len(self.targets), 1)
+        self.assertTrue(isinstance(self.targets[0], User))
+        self.assertEqual(self.targets[0].nick, 'bot')
+        channel = self.client.find_channel(self.server, '#chan')
+        self.assertEqual(sorted(channel.roster), ['bar', 'foo['])
+        self.assertTrue(channel.find_user('Foo[').status &
+                        User.STATUSES[User.OP])
+
+        self.read(':Foo[!u@h PART #chan')
+        self.assertEqual(sorted(channel.roster), ['bar'])
+        self.assertFalse('foo[' in self.server.users)
+        self.assertFalse('foo{' in self.server.users)
+
+
+if __name__ == '__main__':
+    unittest.main()
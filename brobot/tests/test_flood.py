@@ -0,0 +1,326 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Tests for the outgoing message scheduler, driven by a fake clock and a fake
+socket so that they do not depend on timing.
+"""
+
+from core.irc.flood import OutputQueue, FairQueue, KeyedBuckets, \
+                            CRITICAL, BULK
+import unittest
+import socket
+import errno
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeSocket(object):
+    """Takes at most limit bytes per send, and none once full is set."""
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.full = False
+        self.data = ''
+        self.sends = 0
+
+    def send(self, data):
+        if self.full:
+            raise socket.error(errno.EAGAIN, 'Resource temporarily '
+                                             'unavailable')
+        if self.limit is not None:
+            data = data[:self.limit]
+        self.data += data
+        self.sends += 1
+        return len(data)
+
+    def sendall(self, data):
+        self.data += data
+
+    def lines(self):
+        return self.data.split('\r\n')[:-1]
+
+
+def privmsg(target, text):
+    return 'PRIVMSG %s :%s\r\n' % (target, text)
+
+class OutputQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sock = FakeSocket()
+
+    def queue(self, **limits):
+        return OutputQueue(clock=self.clock, **limits)
+
+    def test_priority_order(self):
+        queue = self.queue()
+        queue.put(privmsg('#a', 'bulk'), BULK)
+        queue.put(privmsg('#a', 'reply'))
+        queue.put('PONG irc.test :123\r\n')
+        self.assertEqual(queue.flush(self.sock), None)
+        self.assertEqual(self.sock.lines(), ['PONG irc.test :123',
+                                             'PRIVMSG #a :reply',
+                                             'PRIVMSG #a :bulk'])
+
+    def test_lines_are_coalesced(self):
+        queue = self.queue()
+        for i in xrange(3):
+            queue.put(privmsg('#a', i))
+        queue.flush(self.sock)
+        self.assertEqual(self.sock.sends, 1)
+        self.assertEqual(len(self.sock.lines()), 3)
+
+    def test_rate_limit(self):
+        queue = self.queue(lines_per_second=0.5, burst_lines=2)
+        for i in xrange(3):
+            queue.put(privmsg('#a', i))
+        self.assertEqual(queue.flush(self.sock), 2.0)
+        self.assertEqual(len(self.sock.lines()), 2)
+        self.clock.advance(1)
+        self.assertEqual(queue.flush(self.sock), 1.0)
+        self.assertEqual(len(self.sock.lines()), 2)
+        self.clock.advance(1)
+        self.assertEqual(queue.flush(self.sock), None)
+        self.assertEqual(len(self.sock.lines()), 3)
+
+    def test_pong_bypasses_the_buckets(self):
+        queue = self.queue(lines_per_second=0.5, burst_lines=1,
+                           bytes_per_second=10, burst_bytes=100)
+        queue.put(privmsg('#a', 'first'))
+        queue.put(privmsg('#a', 'second'))
+        self.assertEqual(queue.flush(self.sock), 2.0)
+        queue.put('PONG irc.test :123\r\n', CRITICAL)
+        queue.flush(self.sock)
+        self.assertEqual(self.sock.lines(), ['PRIVMSG #a :first',
+                                             'PONG irc.test :123'])
+        # The PONG still counts against the budget, as it does on the server.
+        self.clock.advance(2)
+        self.assertEqual(queue.flush(self.sock), 2.0)
+        self.assertEqual(len(self.sock.lines()), 2)
+        self.clock.advance(2)
+        self.assertEqual(queue.flush(self.sock), None)
+        self.assertEqual(self.sock.lines()[-1], 'PRIVMSG #a :second')
+
+    def test_targets_share_the_rate(self):
+        queue = self.queue(lines_per_second=1, burst_lines=1)
+        for i in xrange(5):
+            queue.put(privmsg('#busy', i))
+        queue.put(privmsg('#quiet', 'hi'))
+        for _ in xrange(3):
+            queue.flush(self.sock)
+            self.clock.advance(1)
+        # The quiet channel does not wait for the whole backlog of the busy
+        # one.
+        self.assertEqual(self.sock.lines(), ['PRIVMSG #busy :0',
+                                             'PRIVMSG #quiet :hi',
+                                             'PRIVMSG #busy :1'])
+
+    def test_short_writes(self):
+        queue = self.queue()
+        self.sock.limit = 10
+        line = privmsg('#a', 'x' * 20)
+        queue.put(line)
+        queue.put(line)
+        # A short write means the socket is full, so the rest waits until it
+        # is writable again.
+        self.assertEqual(queue.flush(self.sock), None)
+        self.assertTrue(queue.blocked)
+        self.assertEqual(self.sock.data, line[:10])
+        while queue.blocked:
+            queue.flush(self.sock)
+        self.assertFalse(queue.pending)
+        self.assertEqual(self.sock.data, line * 2)
+        self.assertEqual(queue.short_writes, self.sock.sends - 1)
+
+    def test_full_socket_blocks(self):
+        queue = self.queue()
+        self.sock.limit = 10
+        queue.put(privmsg('#a', 'x' * 20))
+        self.sock.full = True
+        self.assertEqual(queue.flush(self.sock), None)
+        self.assertTrue(queue.blocked)
+        self.assertTrue(queue.pending)
+        self.sock.full = False
+        self.sock.limit = None
+        self.assertEqual(queue.flush(self.sock), None)
+        self.assertFalse(queue.blocked)
+        self.assertFalse(queue.pending)
+        self.assertEqual(self.sock.lines(), ['PRIVMSG #a :' + 'x' * 20])
+
+    def test_short_write_keeps_the_rest_first(self):
+        queue = self.queue()
+        self.sock.limit = 5
+        queue.put(privmsg('#a', 'bulk'), BULK)
+        queue.flush(self.sock)
+        queue.put('PONG irc.test :1\r\n')
+        self.sock.limit = None
+        queue.flush(self.sock)
+        # The half written line is finished before anything else goes out.
+        self.assertEqual(self.sock.lines(), ['PRIVMSG #a :bulk',
+                                             'PONG irc.test :1'])
+
+    def test_flush_final(self):
+        queue = self.queue(lines_per_second=0.5, burst_lines=1)
+        for i in xrange(3):
+            queue.put(privmsg('#a', i))
+        queue.put(privmsg('#a', 'bulk'), priority=BULK)
+        self.sock.limit = 10
+        queue.flush(self.sock)
+        self.sock.limit = None
+        queue.put('PONG irc.test :1\r\n')
+        self.assertTrue(queue.flush_final(self.sock, 'QUIT :bye\r\n'))
+        # The half written line and the PONG go out, the backlog does not.
+        self.assertEqual(self.sock.lines(), ['PRIVMSG #a :0',
+                                             'PONG irc.test :1',
+                                             'QUIT :bye'])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.stats()['queued_bytes'], 0)
+
+    def test_flush_final_does_not_wait(self):
+        queue = self.queue()
+        queue.put('PONG irc.test :1\r\n')
+        self.sock.full = True
+        self.assertFalse(queue.flush_final(self.sock, 'QUIT\r\n'))
+        self.assertEqual(self.sock.data, '')
+        self.sock.full = False
+        self.sock.limit = 4
+        self.assertFalse(queue.flush_final(self.sock))
+        self.sock.limit = None
+        self.assertTrue(queue.flush_final(self.sock))
+        self.assertEqual(self.sock.lines(), ['PONG irc.test :1', 'QUIT'])
+
+    def test_stats(self):
+        queue = self.queue(lines_per_second=0.5, burst_lines=1)
+        queue.put(privmsg('#a', 0))
+        queue.put(privmsg('#a', 1), BULK)
+        queue.flush(self.sock)
+        stats = queue.stats()
+        self.assertEqual(stats['depth'], 1)
+        self.assertEqual(stats['bulk_depth'], 1)
+        self.assertEqual(stats['sent_lines'], 1)
+        self.assertEqual(stats['writes'], 1)
+
+
+class FairQueueTest(unittest.TestCase):
+    def drain(self, queue):
+        lines = []
+        while queue:
+            lines.append(queue.pop())
+        return lines
+
+    def test_each_target_stays_in_order(self):
+        queue = FairQueue()
+        for i in xrange(3):
+            queue.put('a%d' % i, '#a')
+            queue.put('b%d' % i, '#b')
+        lines = self.drain(queue)
+        self.assertEqual([line for line in lines if line[0] == 'a'],
+                         ['a0', 'a1', 'a2'])
+        self.assertEqual([line for line in lines if line[0] == 'b'],
+                         ['b0', 'b1', 'b2'])
+
+    def test_targets_interleave(self):
+        queue = FairQueue()
+        for i in xrange(4):
+            queue.put('a%d' % i, '#a')
+        queue.put('b0', '#b')
+        queue.put('c0', '#c')
+        self.assertEqual(self.drain(queue), ['a0', 'b0', 'c0', 'a1', 'a2',
+                                             'a3'])
+
+    def test_late_target_does_not_jump_ahead_forever(self):
+        queue = FairQueue()
+        for i in xrange(4):
+            queue.put('a%d' % i, '#a')
+        queue.pop()
+        queue.pop()
+        # A target that shows up later starts at the current virtual time,
+        # not at zero, so it cannot claim the time it was idle.
+        for i in xrange(3):
+            queue.put('b%d' % i, '#b')
+        self.assertEqual(self.drain(queue), ['a2', 'b0', 'a3', 'b1', 'b2'])
+
+    def test_weights(self):
+        queue = FairQueue({'#a': 2.0})
+        for i in xrange(4):
+            queue.put('a%d' % i, '#a')
+        for i in xrange(4):
+            queue.put('b%d' % i, '#b')
+        # #a gets two lines out for every one of #b.
+        self.assertEqual(self.drain(queue), ['a0', 'a1', 'b0', 'a2', 'a3',
+                                             'b1', 'b2', 'b3'])
+
+    def test_size_counts(self):
+        queue = FairQueue()
+        queue.put('a' * 10, '#a')
+        queue.put('a' * 10, '#a')
+        queue.put('b' * 40, '#b')
+        queue.put('c' * 5, '#c')
+        self.assertEqual([len(line) for line in self.drain(queue)],
+                         [5, 10, 10, 40])
+
+
+class KeyedBucketsTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_rate_below_one(self):
+        # Half a command a second, with the default capacity.
+        buckets = KeyedBuckets(0.5, clock=self.clock)
+        self.assertTrue(buckets.consume('nick'))
+        self.assertFalse(buckets.consume('nick'))
+        self.assertTrue(buckets.consume('other'))
+        self.clock.advance(1)
+        self.assertFalse(buckets.allows('nick'))
+        self.clock.advance(1)
+        self.assertTrue(buckets.consume('nick'))
+
+    def test_default_capacity_is_the_rate(self):
+        buckets = KeyedBuckets(3, clock=self.clock)
+        self.assertEqual([buckets.consume('nick') for _ in xrange(4)],
+                         [True, True, True, False])
+
+    def test_amount_above_capacity(self):
+        buckets = KeyedBuckets(1, 2, clock=self.clock)
+        self.assertTrue(buckets.allows('nick', 5))
+        self.assertTrue(buckets.consume('nick', 5))
+        # The bucket is in debt until it has refilled.
+        self.clock.advance(3.5)
+        self.assertFalse(buckets.allows('nick'))
+        self.clock.advance(0.5)
+        self.assertTrue(buckets.allows('nick'))
+
+    def test_full_buckets_are_swept(self):
+        buckets = KeyedBuckets(1, 2, clock=self.clock)
+        for i in xrange(10):
+            buckets.consume(i)
+        self.assertEqual(len(buckets), 10)
+        self.clock.advance(2)
+        buckets.consume('nick')
+        self.assertEqual(len(buckets), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
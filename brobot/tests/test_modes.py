@@ -0,0 +1,168 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Tests for channel and user modes, replaying NAMES and MODE lines as a few
+common servers send them through the client's hooks.
+"""
+
+from core.irc.clients import Client
+from core.irc.structures import Server, Channel, User, Mode, ISupport
+from core.irc.utils import parse_irc_lines
+from itertools import groupby
+from operator import attrgetter
+import unittest
+
+# 005 tokens of a few servers
+CHARYBDIS = ['CHANTYPES=#', 'CHANMODES=eIbq,k,flj,CFLMPQScgimnprstz',
+             'PREFIX=(ov)@+', 'CASEMAPPING=rfc1459']
+UNREAL = ['CHANMODES=beI,kLf,l,psmntirzMQNRTOVKDdGPZSCc',
+          'PREFIX=(qaohv)~&@%+', 'CASEMAPPING=ascii']
+INSPIRCD = ['CHANMODES=IXbegw,k,FHJLfjl,ACKMNOPQRSTUcimnprstz',
+            'PREFIX=(Yqaohv)!~&@%+', 'CASEMAPPING=rfc1459']
+
+class FakeConnection(object):
+    def __init__(self, server):
+        self.server = server
+        self.sent = []
+
+    def send(self, message, priority=None, target=None):
+        self.sent.append(message)
+
+
+class ModeCorpusTest(unittest.TestCase):
+    def start(self, tokens, names):
+        """Joins #chan on a server with the given 005 tokens, and replays a
+        NAMES reply listing names."""
+        self.server = Server('irc.example.net', 6667, 'bot')
+        self.client = Client([self.server])
+        self.connection = FakeConnection(self.server)
+        self.server.actual_nick = 'bot'
+        self.replay(':irc.example.net 005 bot %s :are supported by this '
+                    'server' % ' '.join(tokens),
+                    ':bot!~bot@host JOIN :#chan',
+                    ':irc.example.net 353 bot = #chan :%s' % names,
+                    ':irc.example.net 366 bot #chan :End of /NAMES list.')
+        self.channel = self.client.find_channel(self.server, '#chan')
+
+    def replay(self, *lines):
+        event_manager = self.client.connection_manager.event_manager
+        parsed_lines = parse_irc_lines(self.server, lines)
+        for command, group in groupby(parsed_lines, attrgetter('command')):
+            event_manager.hook_all(command, self.connection, group)
+
+    def status(self, nick):
+        return self.channel.find_user(nick).status
+
+    def test_charybdis(self):
+        self.start(CHARYBDIS, '@op +voiced @+both plain')
+        self.assertEqual(self.status('op'), User.STATUSES[User.OP])
+        self.assertEqual(self.status('voiced'), User.STATUSES[User.VOICE])
+        self.assertEqual(self.status('both'), User.STATUSES[User.OP] |
+                                              User.STATUSES[User.VOICE])
+        self.assertEqual(self.status('plain'), User.STATUSES[User.NORMAL])
+        self.assertTrue(self.channel.in_channel('both'))
+
+        # q is a list mode (quiet) here, not founder, and takes a mask.
+        self.replay(':ChanServ!ChanServ@services. MODE #chan +qo *!*@spam '
+                    'plain',
+                    ':op!~op@host MODE #chan +b-v *!*@bad voiced',
+                    ':op!~op@host MODE #chan +lk 50 secret')
+        self.assertTrue(self.status('plain') & User.STATUSES[User.OP])
+        self.assertFalse(self.status('voiced') & User.STATUSES[User.VOICE])
+        self.assertFalse(self.channel.has_mode('q'))
+        self.assertFalse(self.channel.has_mode('b'))
+        self.assertEqual(self.channel.mode_params,
+                         {'l': '50', 'k': 'secret'})
+
+        self.replay(':op!~op@host MODE #chan -l+f-k #overflow secret')
+        self.assertFalse(self.channel.has_mode('l'))
+        self.assertFalse(self.channel.has_mode('k'))
+        self.assertEqual(self.channel.mode_params, {'f': '#overflow'})
+
+    def test_unreal(self):
+        self.start(UNREAL, '~owner &admin %half Plain')
+        self.assertEqual(self.status('owner'), User.STATUSES[User.FOUNDER])
+        self.assertEqual(self.status('admin'), User.STATUSES[User.PROTECTED])
+        self.assertEqual(self.status('half'), User.STATUSES[User.HALFOP])
+
+        self.replay(':owner!~o@host MODE #chan +qah-q Plain Plain Plain '
+                    'Plain',
+                    ':owner!~o@host MODE #chan +beI a!*@* b!*@* c!*@*',
+                    ':owner!~o@host MODE #chan +nt')
+        self.assertEqual(self.status('plain'), User.STATUSES[User.NORMAL] |
+                                               User.STATUSES[User.PROTECTED] |
+                                               User.STATUSES[User.HALFOP])
+        self.assertTrue(self.channel.has_mode('n'))
+        self.assertTrue(self.channel.has_mode('t'))
+        for character in 'beI':
+            self.assertFalse(self.channel.has_mode(character))
+
+    def test_inspircd(self):
+        self.start(INSPIRCD, '!~oper ~owner @op')
+        self.assertTrue(self.channel.in_channel('oper'))
+        self.assertFalse(self.channel.in_channel('!~oper'))
+        self.assertEqual(self.status('oper'), User.STATUSES[User.FOUNDER])
+        self.assertEqual(self.status('op'), User.STATUSES[User.OP])
+
+        self.replay(':op!~op@host MODE #chan +Yo-o owner owner op',
+                    ':op!~op@host MODE #chan +w o:*!*@trusted',
+                    ':op!~op@host MODE #chan :+m')
+        self.assertTrue(self.status('owner') & User.STATUSES[User.OP])
+        self.assertFalse(self.status('op') & User.STATUSES[User.OP])
+        self.assertFalse(self.channel.has_mode('w'))
+        self.assertTrue(self.channel.has_mode('m'))
+
+
+class ParseModesTest(unittest.TestCase):
+    def parse(self, modes, *args):
+        return [(mode.on, mode.character, mode.param)
+                for mode in Mode.parse_modes(modes, list(args),
+                                             ISupport(CHARYBDIS))]
+
+    def test_unset_key_takes_param(self):
+        self.assertEqual(self.parse('-k', 'secret'),
+                         [(False, 'k', 'secret')])
+
+    def test_unset_limit_takes_none(self):
+        self.assertEqual(self.parse('-l+o', 'nick'),
+                         [(False, 'l', ''), (True, 'o', 'nick')])
+
+    def test_missing_param(self):
+        self.assertEqual(self.parse('+ov', 'nick'),
+                         [(True, 'o', 'nick'), (True, 'v', '')])
+
+    def test_not_a_mode_string(self):
+        self.assertEqual(self.parse('o', 'nick'), [])
+
+
+class ChannelModesTest(unittest.TestCase):
+    def test_modes(self):
+        channel = Channel(Server('irc.example.net', 6667, 'bot'), '#chan')
+        for character, param in ((u't', u''), (u'n', u''), (u'l', u'50'),
+                                 (u'k', u'secret'), (u'l', u'10')):
+            channel.add_mode(Mode(character, param))
+        channel.remove_mode(Mode(u'n'))
+        modes = [(mode.character, mode.param) for mode in channel.modes]
+        self.assertEqual(modes, [('k', u'secret'), ('l', u'10'), ('t', u'')])
+        self.assertTrue(all(type(mode.character) is str
+                            for mode in channel.modes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#===============================================================================
+# brobot
+# Copyright (C) 2012  Michael Keselman
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#===============================================================================
+
+"""
+Tests for the CommandRegistry.
+"""
+
+from core.registry import CommandRegistry
+import unittest
+
+PUBLIC = CommandRegistry.PUBLIC
+PRIVATE = CommandRegistry.PRIVATE
+BOTH = CommandRegistry.BOTH
+
+class CommandRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = CommandRegistry()
+
+    def test_aliases(self):
+        self.assertTrue(self.registry.register(('help', 'h', '?'), 'help'))
+        for name in ('help', 'h', '?'):
+            self.assertEqual(self.registry.find(name), 'help')
+        self.assertEqual(self.registry.names('help'), ('help', 'h', '?'))
+        self.assertEqual(self.registry.plugins(), ['help'])
+
+    def test_find_by_scope(self):
+        self.registry.register(('users',), 'users', PUBLIC)
+        self.assertEqual(self.registry.find('users', PUBLIC), 'users')
+        self.assertEqual(self.registry.find('users', PRIVATE), None)
+        # A plugin only answers BOTH if it answers in both scopes.
+        self.assertEqual(self.registry.find('users', BOTH), None)
+        self.registry.register(('bot',), 'bot', BOTH)
+        self.assertEqual(self.registry.find('bot', PUBLIC), 'bot')
+        self.assertEqual(self.registry.find('bot', PRIVATE), 'bot')
+
+    def test_conflicting_scopes(self):
+        self.assertTrue(self.registry.register(('users',), 'public', PUBLIC))
+        self.assertFalse(self.registry.register(('users',), 'both', BOTH))
+        self.assertFalse(self.registry.register(('who', 'users'), 'other',
+                                                PUBLIC))
+        # Nothing of a rejected plugin is registered, not even its free names.
+        self.assertFalse('who' in self.registry)
+        self.assertTrue(self.registry.register(('users',), 'private',
+                                               PRIVATE))
+        self.assertEqual(self.registry.find('users', PUBLIC), 'public')
+        self.assertEqual(self.registry.find('users', PRIVATE), 'private')
+
+    def test_unregister_removes_every_alias(self):
+        self.registry.register(('help', 'h'), 'help')
+        self.registry.register(('other',), 'other')
+        self.assertTrue(self.registry.unregister('h'))
+        self.assertFalse('help' in self.registry)
+        self.assertFalse('h' in self.registry)
+        self.assertEqual(self.registry.names('help'), ())
+        self.assertEqual(self.registry.find('other'), 'other')
+        self.assertFalse(self.registry.unregister('help'))
+
+    def test_unregister_keeps_the_other_scope(self):
+        self.registry.register(('users',), 'public', PUBLIC)
+        self.registry.register(('users', 'u'), 'private', PRIVATE)
+        self.assertTrue(self.registry.unregister('u'))
+        self.assertEqual(self.registry.find('users', PUBLIC), 'public')
+        self.assertEqual(self.registry.find('users', PRIVATE), None)
+
+    def test_unregister_in_a_scope(self):
+        self.registry.register(('users',), 'public', PUBLIC)
+        self.assertFalse(self.registry.unregister('users', BOTH))
+        self.assertEqual(self.registry.find('users', PUBLIC), 'public')
+        self.assertTrue(self.registry.unregister('users', PUBLIC))
+        self.assertFalse('users' in self.registry)
+
+    def test_version(self):
+        version = self.registry.version
+        self.registry.register(('help',), 'help')
+        self.assertEqual(self.registry.version, version + 1)
+        self.registry.register(('help',), 'other')
+        self.registry.unregister('nothing')
+        self.assertEqual(self.registry.version, version + 1)
+        self.registry.unregister('help')
+        self.assertEqual(self.registry.version, version + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()